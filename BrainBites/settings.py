@@ -45,13 +45,55 @@ CELERY_TIMEZONE = 'UTC'
 
 from celery.schedules import crontab
 
+# How often the Leaderboard table is recomputed, and how old it may get before
+# UsersView stops trusting it and ranks from the live Redis sets instead (seconds).
+LEADERBOARD_SNAPSHOT_INTERVAL = 60 * 5
+LEADERBOARD_SNAPSHOT_MAX_AGE = 60 * 15
+
+# Buffer XP, read-card, quiz and daily counters in Redis and flush them to Postgres
+# every WRITE_BEHIND_FLUSH_INTERVAL seconds. Set WRITE_BEHIND_COUNTERS=False to write through.
+WRITE_BEHIND_COUNTERS = os.environ.get('WRITE_BEHIND_COUNTERS', 'True') == 'True'
+WRITE_BEHIND_FLUSH_INTERVAL = 5
+
+# Below LIVES_REGEN_CAP a user gets one life back every LIVES_REGEN_INTERVAL seconds,
+# computed on read from CustomUser.lives and last_life_lost_time (see app/lives.py).
+LIVES_REGEN_CAP = 5
+LIVES_REGEN_INTERVAL = 60 * 12
+
+# Keep the XP, lives and purchased subtitles of active users in Redis and run purchases
+# as Lua scripts there (see app/economy.py). Needs WRITE_BEHIND_COUNTERS. Off by default:
+# while it is on, purchases are refused with 503 whenever Redis is unavailable.
+REDIS_ECONOMY = os.environ.get('REDIS_ECONOMY', 'False') == 'True'
+
 CELERY_BEAT_SCHEDULE = {
-    'restore-lives-every-minute': {
-        'task': 'app.tasks.restore_lives',
-        'schedule': crontab(),
+    'snapshot-leaderboards': {
+        'task': 'app.tasks.snapshot_leaderboards',
+        'schedule': LEADERBOARD_SNAPSHOT_INTERVAL,
+    },
+    'flush-write-behind-counters': {
+        'task': 'app.tasks.flush_write_behind',
+        'schedule': WRITE_BEHIND_FLUSH_INTERVAL,
     },
 }
 
+CARD_QUEUE_SIZE = 100
+CARD_QUEUE_LOW_WATER = 40
+CARD_QUEUE_TTL = 60 * 60 * 24
+
+PROFILE_CACHE_TTL = 60 * 60 * 24
+
+CARD_PAYLOAD_TTL = 60 * 60 * 24 * 7
+
+CATALOG_CACHE_TTL = 60 * 60 * 24 * 7
+
+# Cache rebuilds coalesced by app.single_flight (see there): entries stay readable as stale
+# for SINGLE_FLIGHT_STALE_TTL seconds past their TTL, workers without a stale copy wait up to
+# SINGLE_FLIGHT_WAIT seconds, and the rebuild lock expires after SINGLE_FLIGHT_LOCK_TIMEOUT.
+SINGLE_FLIGHT_STALE_TTL = 60
+SINGLE_FLIGHT_WAIT = 2
+SINGLE_FLIGHT_POLL_INTERVAL = 0.05
+SINGLE_FLIGHT_LOCK_TIMEOUT = 60
+
 INSTALLED_APPS = [
     'django.contrib.admin',
     'django.contrib.auth',
@@ -68,10 +110,21 @@ INSTALLED_APPS = [
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'app.authentication.CachedTokenAuthentication',
     ],
 }
 
+# Resolved tokens are cached for TOKEN_CACHE_TTL seconds in Redis and TOKEN_CACHE_LOCAL_TTL
+# seconds in each process. Logout and account deletion clear Redis and the local copy;
+# other processes may accept a revoked token until their copy expires.
+TOKEN_CACHE_TTL = 60 * 5
+TOKEN_CACHE_LOCAL_TTL = 30
+TOKEN_CACHE_LOCAL_SIZE = 10000
+
+# Ids of existing users remembered per process by app.users (see there).
+USER_CACHE_TTL = 60
+USER_CACHE_SIZE = 10000
+
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -1,19 +1,28 @@
 from django.contrib import admin
 from django import forms
 
-from .models import CustomUser, Topic, Card, Quiz, Badge, Leaderboard, EarnedBadge, UserBadgeProgress, UserSubtitle
+from .models import CustomUser, Topic, Card, Quiz, Badge, Leaderboard, EarnedBadge, UserBadgeProgress, UserSubtitle, \
+    UserGameState
+
+
+class UserGameStateInline(admin.StackedInline):
+    model = UserGameState
+    can_delete = False
 
 
 @admin.register(CustomUser)
 class CustomUserAdmin(admin.ModelAdmin):
     list_display = ['username', 'xp', 'email', 'date_joined']
+    list_select_related = ['game_state']
     search_fields = ['username', 'email']
+    inlines = [UserGameStateInline]
 
 
 @admin.register(Topic)
 class TopicAdmin(admin.ModelAdmin):
-    list_display = ['title']
+    list_display = ['title', 'card_count', 'active_card_count']
     search_fields = ['title']
+    readonly_fields = ['card_count', 'active_card_count']
 
 
 @admin.register(Card)
@@ -51,7 +60,7 @@ class BadgeAdmin(admin.ModelAdmin):
 
 @admin.register(Leaderboard)
 class LeaderboardAdmin(admin.ModelAdmin):
-    list_display = ['user', 'category', 'rank']
+    list_display = ['user', 'category', 'rank', 'score', 'snapshot_at']
     search_fields = ['user__username', 'category']
     list_filter = ['category']
 
@@ -0,0 +1,92 @@
+import hashlib
+import json
+import logging
+import threading
+
+import redis
+from cachetools import TTLCache
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+from app.models import CustomUser
+from app.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+# Columns kept for an authenticated user, in model order as from_db() expects; the rest load
+# on first access like deferred fields. The password hash is never cached.
+USER_FIELDS = tuple(
+    field.attname for field in CustomUser._meta.concrete_fields
+    if field.attname in {'id', 'username', 'email', 'is_active', 'is_staff', 'is_superuser', 'avatar_url',
+                         'everyday_cards'}
+)
+
+_local = TTLCache(maxsize=settings.TOKEN_CACHE_LOCAL_SIZE, ttl=settings.TOKEN_CACHE_LOCAL_TTL)
+_local_lock = threading.Lock()
+
+
+def cache_key(key):
+    # Tokens are credentials, so Redis only sees their digest.
+    return f"auth_token_{hashlib.sha256(key.encode()).hexdigest()}"
+
+
+def _user(values):
+    return CustomUser.from_db(DEFAULT_DB_ALIAS, USER_FIELDS, values)
+
+
+def _load(key):
+    """USER_FIELDS values of the token's user, from Redis or the database; None for an unknown token."""
+    try:
+        cached = get_redis().get(cache_key(key))
+    except redis.RedisError:
+        logger.exception('Failed to read a cached token')
+        cached = None
+    if cached is not None:
+        return json.loads(cached)
+
+    values = Token.objects.filter(key=key).values_list(*(f'user__{field}' for field in USER_FIELDS)).first()
+    if values is None:
+        return None
+    try:
+        get_redis().set(cache_key(key), json.dumps(values), ex=settings.TOKEN_CACHE_TTL)
+    except redis.RedisError:
+        logger.exception('Failed to cache a token')
+    return list(values)
+
+
+def forget(*keys):
+    """Drop tokens from the caches, e.g. on logout. Other processes keep theirs for TOKEN_CACHE_LOCAL_TTL."""
+    if not keys:
+        return
+    with _local_lock:
+        for key in keys:
+            _local.pop(key, None)
+    try:
+        get_redis().delete(*(cache_key(key) for key in keys))
+    except redis.RedisError:
+        logger.exception('Failed to forget cached tokens')
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    TokenAuthentication resolving keys through a short in-process TTL cache, then Redis,
+    then one Token/CustomUser query. request.user is a CustomUser with USER_FIELDS loaded.
+    """
+
+    def authenticate_credentials(self, key):
+        with _local_lock:
+            values = _local.get(key)
+        if values is None:
+            values = _load(key)
+            if values is None:
+                raise exceptions.AuthenticationFailed('Invalid token.')
+            with _local_lock:
+                _local[key] = values
+
+        user = _user(values)
+        if not user.is_active:
+            raise exceptions.AuthenticationFailed('User inactive or deleted.')
+        return user, key
@@ -0,0 +1,206 @@
+from collections import Counter
+
+from django.db import transaction
+from django.db.models import F, Q, Count
+from django.db.models.functions import Greatest
+from django.dispatch import receiver
+
+from app import events, leaderboard, profiles, write_behind
+from app.models import Badge, UserBadgeProgress, EarnedBadge, Card, Subtitle, UserQuizStatistics, ViewedCard
+
+READ_CARDS = 'read_cards'
+CORRECT_QUIZ_ANSWERS = 'correct_quiz_answers'
+COMPLETE_SUBTOPICS = 'complete_subtopics'
+COMPLETE_TOPIC = 'complete_topic'
+READ_SPECIFIC_TOPIC = 'read_specific_topic'
+QUIZ_SPECIFIC_TOPIC = 'quiz_specific_topic'
+
+
+def criterion(badge):
+    """Return (kind, topic_id, threshold) for a badge, or None if its criteria are not recognised."""
+    criteria = badge.criteria
+    if criteria.get(READ_CARDS, False):
+        return READ_CARDS, None, criteria[READ_CARDS]
+    if CORRECT_QUIZ_ANSWERS in criteria:
+        return CORRECT_QUIZ_ANSWERS, None, criteria[CORRECT_QUIZ_ANSWERS]
+    if criteria.get(COMPLETE_SUBTOPICS, False):
+        return COMPLETE_SUBTOPICS, None, criteria[COMPLETE_SUBTOPICS]
+    if COMPLETE_TOPIC in criteria:
+        return COMPLETE_TOPIC, None, criteria[COMPLETE_TOPIC]
+    for kind in (READ_SPECIFIC_TOPIC, QUIZ_SPECIFIC_TOPIC):
+        if kind in criteria:
+            return kind, criteria[kind]['topic_id'], criteria[kind]['count']
+    return None
+
+
+def badge_criteria():
+    criteria = {}
+    for badge in Badge.objects.all():
+        badge_criterion = criterion(badge)
+        if badge_criterion:
+            criteria[badge.id] = badge_criterion
+    return criteria
+
+
+def advance(user_id, deltas):
+    """
+    Apply counter deltas keyed by (kind, topic_id) to the progress of every badge
+    they concern, then award the badges whose threshold has been crossed.
+    """
+    deltas = {key: delta for key, delta in deltas.items() if delta}
+    affected = {
+        badge_id: (deltas[(kind, topic_id)], threshold)
+        for badge_id, (kind, topic_id, threshold) in badge_criteria().items()
+        if (kind, topic_id) in deltas
+    }
+    if not affected:
+        return
+
+    UserBadgeProgress.objects.bulk_create(
+        [UserBadgeProgress(user_id=user_id, badge_id=badge_id) for badge_id in affected],
+        ignore_conflicts=True
+    )
+    badges_by_delta = {}
+    for badge_id, (delta, _) in affected.items():
+        badges_by_delta.setdefault(delta, []).append(badge_id)
+    for delta, badge_ids in badges_by_delta.items():
+        UserBadgeProgress.objects.filter(user_id=user_id, badge_id__in=badge_ids).update(
+            progress_number=Greatest(F('progress_number') + delta, 0)
+        )
+
+    award(user_id, {badge_id: threshold for badge_id, (_, threshold) in affected.items()})
+
+
+def award(user_id, thresholds):
+    progress = UserBadgeProgress.objects.filter(user_id=user_id, badge_id__in=thresholds)
+    reached = [
+        badge_id for badge_id, progress_number in progress.values_list('badge_id', 'progress_number')
+        if progress_number >= thresholds[badge_id]
+    ]
+    if not reached:
+        return
+    EarnedBadge.objects.bulk_create(
+        [EarnedBadge(user_id=user_id, badge_id=badge_id, notified=False) for badge_id in reached],
+        ignore_conflicts=True
+    )
+    leaderboard.record_badges(user_id)
+    profiles.invalidate(user_id)
+
+
+def pop_pending_awards(user_id):
+    with transaction.atomic():
+        pending = list(
+            EarnedBadge.objects.select_for_update(of=('self',))
+            .filter(user_id=user_id, notified=False)
+            .select_related('badge')
+        )
+        EarnedBadge.objects.filter(id__in=[earned.id for earned in pending]).update(notified=True)
+    return [{'name': earned.badge.name} for earned in pending]
+
+
+def subtitle_catalog():
+    """(subtitle_id, topic_id, total_cards) for every subtitle; shared by all users in a backfill."""
+    return list(Subtitle.objects.values_list('id', 'topic_id', 'card_count'))
+
+
+def evaluate(user_id, criteria, catalog=None):
+    """
+    Compute the current value of every badge counter of a user. The viewed/passed
+    counters come from a single grouped ViewedCard aggregate with conditional
+    counts, so the number of queries does not depend on how many badges exist.
+    """
+    kinds = {kind for kind, _, _ in criteria.values()}
+
+    passed_total = 0
+    passed_by_topic, viewed_by_subtitle = Counter(), Counter()
+    rows = (
+        ViewedCard.objects.filter(user_id=user_id)
+        .values('card__topic_id', 'card__subtitle_id')
+        .annotate(viewed=Count('id'), passed=Count('id', filter=Q(test_passed=True)))
+    )
+    for row in rows:
+        passed_total += row['passed']
+        passed_by_topic[row['card__topic_id']] += row['passed']
+        if row['card__subtitle_id'] is not None:
+            viewed_by_subtitle[row['card__subtitle_id']] += row['viewed']
+
+    values = {(READ_CARDS, None): passed_total}
+    for kind, topic_id, _ in criteria.values():
+        if topic_id is not None:
+            values[(kind, topic_id)] = passed_by_topic[topic_id]
+
+    if CORRECT_QUIZ_ANSWERS in kinds:
+        stats = UserQuizStatistics.objects.filter(user_id=user_id).values_list('correct_attempts', flat=True).first()
+        pending = write_behind.pending(write_behind.QUIZ_STATS, (user_id,), ['correct_attempts'])
+        values[(CORRECT_QUIZ_ANSWERS, None)] = (stats or 0) + pending['correct_attempts']
+
+    if COMPLETE_SUBTOPICS in kinds or COMPLETE_TOPIC in kinds:
+        if catalog is None:
+            catalog = subtitle_catalog()
+        completed_subtitles = 0
+        topic_touched = {}
+        for subtitle_id, topic_id, total_cards in catalog:
+            viewed = viewed_by_subtitle[subtitle_id]
+            if viewed and viewed >= total_cards:
+                completed_subtitles += 1
+            topic_touched[topic_id] = topic_touched.get(topic_id, True) and viewed > 0
+        values[(COMPLETE_SUBTOPICS, None)] = completed_subtitles
+        values[(COMPLETE_TOPIC, None)] = sum(1 for touched in topic_touched.values() if touched)
+
+    return values
+
+
+def recompute(user_id, notify=True, criteria=None, catalog=None):
+    """Rebuild every badge counter of a user from scratch; used to backfill existing users."""
+    if criteria is None:
+        criteria = badge_criteria()
+    if not criteria:
+        return
+    values = evaluate(user_id, criteria, catalog)
+
+    UserBadgeProgress.objects.bulk_create(
+        [
+            UserBadgeProgress(user_id=user_id, badge_id=badge_id, progress_number=values[(kind, topic_id)])
+            for badge_id, (kind, topic_id, _) in criteria.items()
+        ],
+        update_conflicts=True,
+        unique_fields=['user', 'badge'],
+        update_fields=['progress_number']
+    )
+    reached = [
+        badge_id for badge_id, (kind, topic_id, threshold) in criteria.items()
+        if values[(kind, topic_id)] >= threshold
+    ]
+    EarnedBadge.objects.bulk_create(
+        [EarnedBadge(user_id=user_id, badge_id=badge_id, notified=not notify) for badge_id in reached],
+        ignore_conflicts=True
+    )
+    leaderboard.record_badges(user_id)
+    profiles.invalidate(user_id)
+
+
+@receiver(events.cards_passed)
+def on_cards_passed(sender, user_id, card_ids, passed, **kwargs):
+    if not card_ids:
+        return
+    sign = 1 if passed else -1
+    deltas = {(READ_CARDS, None): sign * len(card_ids)}
+    per_topic = Counter(Card.objects.filter(id__in=card_ids).values_list('topic_id', flat=True))
+    for topic_id, count in per_topic.items():
+        deltas[(READ_SPECIFIC_TOPIC, topic_id)] = deltas[(QUIZ_SPECIFIC_TOPIC, topic_id)] = sign * count
+    advance(user_id, deltas)
+
+
+@receiver(events.correct_answers_recorded)
+def on_correct_answers_recorded(sender, user_id, count, **kwargs):
+    advance(user_id, {(CORRECT_QUIZ_ANSWERS, None): count})
+
+
+@receiver(events.subtitles_completed)
+def on_subtitles_completed(sender, user_id, subtitle_ids, **kwargs):
+    advance(user_id, {(COMPLETE_SUBTOPICS, None): len(subtitle_ids)})
+
+
+@receiver(events.topics_completed)
+def on_topics_completed(sender, user_id, topic_ids, **kwargs):
+    advance(user_id, {(COMPLETE_TOPIC, None): len(topic_ids)})
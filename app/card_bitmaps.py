@@ -0,0 +1,221 @@
+import logging
+import uuid
+
+import redis
+
+from app.models import Card, ViewedCard
+from app.redis_client import get_redis, pipeline
+
+logger = logging.getLogger(__name__)
+
+CATALOG_BUILT_KEY = 'card_bitmaps_catalog_built'
+
+
+def viewed_key(user_id):
+    return f"user_{user_id}_viewed_cards_bitmap"
+
+
+def passed_key(user_id):
+    return f"user_{user_id}_passed_cards_bitmap"
+
+
+def user_built_key(user_id):
+    return f"user_{user_id}_card_bitmaps_built"
+
+
+def topic_key(topic_id):
+    return f"topic_{topic_id}_cards_bitmap"
+
+
+def subtitle_key(subtitle_id):
+    return f"subtitle_{subtitle_id}_cards_bitmap"
+
+
+def to_bitmap(card_ids):
+    # Same layout as SETBIT: bit 0 is the most significant bit of the first byte.
+    card_ids = list(card_ids)
+    if not card_ids:
+        return b''
+    data = bytearray(max(card_ids) // 8 + 1)
+    for card_id in card_ids:
+        data[card_id // 8] |= 0x80 >> (card_id % 8)
+    return bytes(data)
+
+
+def from_bitmap(data):
+    card_ids = set()
+    for index, byte in enumerate(data or b''):
+        if byte:
+            for bit in range(8):
+                if byte & (0x80 >> bit):
+                    card_ids.add(index * 8 + bit)
+    return card_ids
+
+
+def _set_bits(pipe, key, card_ids, value):
+    for card_id in card_ids:
+        pipe.setbit(key, card_id, value)
+
+
+def _write(user_id, fn):
+    try:
+        with pipeline() as pipe:
+            fn(pipe)
+    except redis.RedisError:
+        logger.exception('Failed to update card bitmaps for user %s', user_id)
+        invalidate_user(user_id)
+
+
+def record_viewed(user_id, card_ids, passed_ids=(), unpassed_ids=()):
+    def apply(pipe):
+        _set_bits(pipe, viewed_key(user_id), card_ids, 1)
+        _set_bits(pipe, passed_key(user_id), passed_ids, 1)
+        _set_bits(pipe, passed_key(user_id), unpassed_ids, 0)
+
+    _write(user_id, apply)
+
+
+def record_all_passed(user_id):
+    # MarkCardsAsTestPassed flips every viewed card, so the passed bitmap becomes a copy of the viewed one.
+    _write(user_id, lambda pipe: pipe.bitop('OR', passed_key(user_id), viewed_key(user_id)))
+
+
+def invalidate_user(user_id):
+    try:
+        get_redis().delete(user_built_key(user_id))
+    except redis.RedisError:
+        logger.exception('Failed to invalidate card bitmaps for user %s', user_id)
+
+
+def rebuild_user(user_id, attempts=5):
+    # Bits are written after their rows commit. Watching the bitmaps before reading
+    # ViewedCard means a bit for a row the read missed aborts the EXEC instead of being
+    # overwritten, and the rebuild reads again.
+    keys = [viewed_key(user_id), passed_key(user_id)]
+    with get_redis(binary=True).pipeline() as pipe:
+        for _ in range(attempts):
+            try:
+                pipe.watch(*keys)
+                viewed, passed = [], []
+                rows = ViewedCard.objects.filter(user_id=user_id).values_list('card_id', 'test_passed')
+                for card_id, test_passed in rows:
+                    viewed.append(card_id)
+                    if test_passed:
+                        passed.append(card_id)
+
+                pipe.multi()
+                pipe.set(viewed_key(user_id), to_bitmap(viewed))
+                pipe.set(passed_key(user_id), to_bitmap(passed))
+                pipe.set(user_built_key(user_id), 1)
+                pipe.execute()
+                return True
+            except redis.WatchError:
+                continue
+    # Left unbuilt, so the next reader tries again.
+    logger.warning('Gave up rebuilding card bitmaps for user %s after %s attempts', user_id, attempts)
+    return False
+
+
+def rebuild_catalog():
+    topics, subtitles = {}, {}
+    for card_id, topic_id, subtitle_id in Card.objects.values_list('id', 'topic_id', 'subtitle_id').iterator():
+        topics.setdefault(topic_id, []).append(card_id)
+        if subtitle_id is not None:
+            subtitles.setdefault(subtitle_id, []).append(card_id)
+
+    r = get_redis(binary=True)
+    stale_keys = list(r.scan_iter('topic_*_cards_bitmap')) + list(r.scan_iter('subtitle_*_cards_bitmap'))
+    with r.pipeline() as pipe:
+        if stale_keys:
+            pipe.delete(*stale_keys)
+        for topic_id, card_ids in topics.items():
+            pipe.set(topic_key(topic_id), to_bitmap(card_ids))
+        for subtitle_id, card_ids in subtitles.items():
+            pipe.set(subtitle_key(subtitle_id), to_bitmap(card_ids))
+        pipe.set(CATALOG_BUILT_KEY, 1)
+        pipe.execute()
+
+
+def _write_catalog(fn):
+    try:
+        with pipeline() as pipe:
+            fn(pipe)
+    except redis.RedisError:
+        logger.exception('Failed to update catalog card bitmaps')
+
+
+def add_catalog_card(card_id, topic_id, subtitle_id):
+    def apply(pipe):
+        pipe.setbit(topic_key(topic_id), card_id, 1)
+        if subtitle_id is not None:
+            pipe.setbit(subtitle_key(subtitle_id), card_id, 1)
+
+    _write_catalog(apply)
+
+
+def remove_catalog_card(card_id, topic_id, subtitle_id):
+    def apply(pipe):
+        pipe.setbit(topic_key(topic_id), card_id, 0)
+        if subtitle_id is not None:
+            pipe.setbit(subtitle_key(subtitle_id), card_id, 0)
+
+    _write_catalog(apply)
+
+
+def ensure_built(user_id):
+    r = get_redis()
+    user_built, catalog_built = r.exists(user_built_key(user_id)), r.exists(CATALOG_BUILT_KEY)
+    if not catalog_built:
+        rebuild_catalog()
+    if not user_built:
+        rebuild_user(user_id)
+
+
+def viewed_among(user_id, card_ids):
+    """
+    The ids among card_ids the user has viewed, one GETBIT each in a single round trip;
+    None when the user's bitmaps could not be built.
+    """
+    card_ids = list(card_ids)
+    r = get_redis()
+    if not r.exists(user_built_key(user_id)) and not rebuild_user(user_id):
+        return None
+    with r.pipeline(transaction=False) as pipe:
+        for card_id in card_ids:
+            pipe.getbit(viewed_key(user_id), card_id)
+        bits = pipe.execute()
+    return {card_id for card_id, bit in zip(card_ids, bits) if bit}
+
+
+def user_bitmaps(user_id):
+    ensure_built(user_id)
+    viewed, passed = get_redis(binary=True).mget(viewed_key(user_id), passed_key(user_id))
+    return from_bitmap(viewed), from_bitmap(passed)
+
+
+def count_in(user_id, topic_ids=(), subtitle_ids=(), passed=False):
+    # One pipelined BITOP AND + BITCOUNT per scope, a single round trip in total.
+    topic_ids, subtitle_ids = list(topic_ids), list(subtitle_ids)
+    ensure_built(user_id)
+    user_key = passed_key(user_id) if passed else viewed_key(user_id)
+    scope_keys = [topic_key(topic_id) for topic_id in topic_ids] + \
+                 [subtitle_key(subtitle_id) for subtitle_id in subtitle_ids]
+
+    r = get_redis()
+    tmp_key = f"card_bitmaps_tmp_{uuid.uuid4().hex}"
+    with r.pipeline() as pipe:
+        for scope_key in scope_keys:
+            pipe.bitop('AND', tmp_key, user_key, scope_key)
+            pipe.bitcount(tmp_key)
+        pipe.delete(tmp_key)
+        results = pipe.execute()
+
+    counts = results[1:-1:2]
+    topic_counts = {topic_id: count for topic_id, count in zip(topic_ids, counts[:len(topic_ids)])}
+    subtitle_counts = {subtitle_id: count for subtitle_id, count in zip(subtitle_ids, counts[len(topic_ids):])}
+    return topic_counts, subtitle_counts
+
+
+def passed_count(user_id):
+    ensure_built(user_id)
+    return get_redis().bitcount(passed_key(user_id))
@@ -0,0 +1,116 @@
+import logging
+
+import redis
+from django.conf import settings
+from kombu.exceptions import OperationalError
+
+from app import card_bitmaps
+from app.feed import unviewed_cards, topic_cards, subtitle_cards
+from app.models import Card
+from app.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+
+def queue_key(user_id, subtitle_id=None):
+    if subtitle_id is None:
+        return f"user_{user_id}_card_queue"
+    return f"user_{user_id}_subtitle_{subtitle_id}_card_queue"
+
+
+def feed(user_id, subtitle_id=None, after=None):
+    if subtitle_id is None:
+        return topic_cards(user_id, after)
+    return subtitle_cards(user_id, subtitle_id, after)
+
+
+def next_cards(user_id, limit, subtitle_id=None, consume=True):
+    # consume=True pops the ids because the caller records them as viewed; otherwise
+    # they are only peeked and stay queued until a ViewedCard row drops them.
+    key = queue_key(user_id, subtitle_id)
+    try:
+        r = get_redis()
+        if consume:
+            queued_ids = r.lpop(key, limit) or []
+        else:
+            queued_ids = r.lrange(key, 0, limit - 1)
+    except redis.RedisError:
+        logger.exception('Card queue unavailable, falling back to the feed query')
+        return list(feed(user_id, subtitle_id)[:limit])
+
+    queued_ids = [int(card_id) for card_id in queued_ids]
+    cards = _unviewed(user_id, queued_ids)
+
+    try:
+        stale_ids = set(queued_ids) - {card.id for card in cards}
+        if stale_ids and not consume:
+            with r.pipeline() as pipe:
+                for card_id in stale_ids:
+                    pipe.lrem(key, 0, card_id)
+                pipe.execute()
+        if r.llen(key) < settings.CARD_QUEUE_LOW_WATER:
+            schedule_refill(user_id, subtitle_id)
+    except redis.RedisError:
+        logger.exception('Failed to maintain card queue %s', key)
+
+    if len(cards) < limit:
+        cards += list(feed(user_id, subtitle_id).exclude(id__in=queued_ids)[:limit - len(cards)])
+    return cards
+
+
+def _unviewed(user_id, card_ids):
+    # Cards viewed since they were queued are dropped by the viewed bitmap, so only the
+    # rest are fetched by primary key; the anti-join is the fallback.
+    try:
+        viewed_ids = card_bitmaps.viewed_among(user_id, card_ids)
+    except redis.RedisError:
+        logger.exception('Card bitmaps unavailable for user %s, checking the queue in SQL', user_id)
+        viewed_ids = None
+    if viewed_ids is None:
+        return list(unviewed_cards(user_id).filter(id__in=card_ids))
+    return list(Card.objects.filter(id__in=set(card_ids) - viewed_ids).order_by('id'))
+
+
+def refill(user_id, subtitle_id=None):
+    r = get_redis()
+    key = queue_key(user_id, subtitle_id)
+    lock = r.lock(f"{key}_refill", timeout=60, blocking=False)
+    if not lock.acquire():
+        return 0
+
+    try:
+        queued = r.lrange(key, 0, -1)
+        if len(queued) >= settings.CARD_QUEUE_LOW_WATER:
+            return 0
+
+        after = int(queued[-1]) if queued else None
+        card_ids = list(
+            feed(user_id, subtitle_id, after).values_list('id', flat=True)[:settings.CARD_QUEUE_SIZE - len(queued)]
+        )
+        if card_ids:
+            with r.pipeline() as pipe:
+                pipe.rpush(key, *card_ids)
+                pipe.expire(key, settings.CARD_QUEUE_TTL)
+                pipe.execute()
+        return len(card_ids)
+    finally:
+        lock.release()
+
+
+def schedule_refill(user_id, subtitle_id=None):
+    from app.tasks import refill_card_queue
+
+    try:
+        refill_card_queue.delay(user_id, subtitle_id)
+    except OperationalError:
+        # The broker is down; next_cards keeps filling in from the feed query meanwhile.
+        logger.exception('Failed to schedule a refill of the card queue of user %s', user_id)
+
+
+def invalidate(user_id):
+    try:
+        get_redis().delete(queue_key(user_id))
+    except redis.RedisError:
+        logger.exception('Failed to invalidate card queue for user %s', user_id)
+        return
+    schedule_refill(user_id)
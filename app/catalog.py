@@ -0,0 +1,137 @@
+import logging
+
+import redis
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Count, Case, When, Subquery, OuterRef
+from django.db.models.functions import Coalesce, Greatest
+
+from app.models import Card, Subtitle, Topic
+from app import single_flight
+from app.redis_client import get_redis
+from app.serializers import TopicSerializer
+
+logger = logging.getLogger(__name__)
+
+# The catalog changes about once a week. Any Topic, Subtitle or Card change bumps one
+# version counter; the serialized catalog is cached under the version it was read at,
+# so a bump invalidates everything at once and the old copies simply expire.
+VERSION_KEY = 'catalog_version'
+
+
+def _count(cards, field):
+    return Coalesce(
+        Subquery(cards.filter(**{field: OuterRef('pk')}).order_by().values(field).annotate(n=Count('id')).values('n')),
+        0
+    )
+
+
+def adjust_card_counts(topic_id, subtitle_id, delta):
+    """Move the denormalized counters by `delta` cards placed under (topic_id, subtitle_id)."""
+    subtitle_exists = False
+    if subtitle_id is not None:
+        subtitle_exists = Subtitle.objects.filter(id=subtitle_id, exist=True).exists()
+        Subtitle.objects.filter(id=subtitle_id).update(
+            card_count=Greatest(F('card_count') + delta, 0),
+            active_card_count=Case(When(exist=True, then=Greatest(F('card_count') + delta, 0)), default=0),
+        )
+
+    topic_update = {'card_count': Greatest(F('card_count') + delta, 0)}
+    if subtitle_exists:
+        topic_update['active_card_count'] = Greatest(F('active_card_count') + delta, 0)
+    Topic.objects.filter(id=topic_id).update(**topic_update)
+
+
+def subtitle_visibility_changed(subtitle):
+    # Toggling Subtitle.exist adds or removes all of its cards from the topic's active count.
+    card_count = Subtitle.objects.filter(id=subtitle.id).values_list('card_count', flat=True).first() or 0
+    delta = card_count if subtitle.exist else -card_count
+    Subtitle.objects.filter(id=subtitle.id).update(
+        active_card_count=Case(When(exist=True, then=F('card_count')), default=0)
+    )
+    Topic.objects.filter(id=subtitle.topic_id).update(active_card_count=Greatest(F('active_card_count') + delta, 0))
+
+
+def recount(topic_ids=None, subtitle_ids=None):
+    """Recompute the counters from Card; None means every topic/subtitle. Used by bulk ingestion and recount_catalog."""
+    subtitles = Subtitle.objects.all() if subtitle_ids is None else Subtitle.objects.filter(id__in=subtitle_ids)
+    subtitles.update(card_count=_count(Card.objects.all(), 'subtitle'))
+    subtitles.update(active_card_count=Case(When(exist=True, then=F('card_count')), default=0))
+
+    topics = Topic.objects.all() if topic_ids is None else Topic.objects.filter(id__in=topic_ids)
+    topics.update(
+        card_count=_count(Card.objects.all(), 'topic'),
+        active_card_count=_count(Card.objects.filter(subtitle__exist=True), 'topic'),
+    )
+    invalidate()
+
+
+def cards_ingested(cards):
+    """Call after bulk_create of Card rows, which bypasses the post_save signals."""
+    recount(
+        topic_ids={card.topic_id for card in cards},
+        subtitle_ids={card.subtitle_id for card in cards if card.subtitle_id is not None},
+    )
+
+
+def topics_key(version):
+    return f"catalog_v{version}_topics"
+
+
+def subtitles_key(version, topic_id):
+    return f"catalog_v{version}_topic_{topic_id}_subtitles"
+
+
+def etag(version, name):
+    """Strong ETag of a cached catalog response, None when the version is unknown."""
+    return None if version is None else f'"catalog-{version}-{name}"'
+
+
+def version():
+    """Current catalog version, or None if Redis is unavailable."""
+    try:
+        return int(get_redis().get(VERSION_KEY) or 0)
+    except redis.RedisError:
+        logger.exception('Failed to read the catalog version')
+        return None
+
+
+def build_topics():
+    return TopicSerializer(Topic.objects.order_by('id'), many=True).data
+
+
+def build_subtitles(topic_id):
+    """The visible subtitles of a topic that have cards, or None (not cached) if the topic does not exist."""
+    subtitles = list(
+        Subtitle.objects.filter(topic_id=topic_id, exist=True, card_count__gt=0).order_by('id')
+        .values('id', 'title', 'card_count', 'is_free', 'cost', 'image')
+    )
+    if not subtitles and not Topic.objects.filter(id=topic_id).exists():
+        return None
+    return subtitles
+
+
+def _cached(key, build, catalog_version):
+    if catalog_version is None:
+        return build()
+    return single_flight.get('catalog', key, build, settings.CATALOG_CACHE_TTL)
+
+
+def topics(catalog_version):
+    return _cached(topics_key(catalog_version), build_topics, catalog_version)
+
+
+def subtitles(catalog_version, topic_id):
+    return _cached(subtitles_key(catalog_version, topic_id), lambda: build_subtitles(topic_id), catalog_version)
+
+
+def _bump():
+    try:
+        get_redis().incr(VERSION_KEY)
+    except redis.RedisError:
+        logger.exception('Failed to bump the catalog version')
+
+
+def invalidate():
+    # After the commit, otherwise a concurrent read could cache the old rows under the new version.
+    transaction.on_commit(_bump)
@@ -0,0 +1,359 @@
+import logging
+from datetime import datetime, timezone as dt_timezone
+
+import redis
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from app import leaderboard, profiles, write_behind
+from app.models import UserGameState, UserSubtitle
+from app.redis_client import get_redis, register_script, script
+
+logger = logging.getLogger(__name__)
+
+# XP, lives and purchased subtitles of active users live in Redis, where Lua scripts
+# check, debit and record each operation atomically, without Postgres row locks.
+# XP changes are recorded as write-behind deltas (see app/write_behind.py); lives and
+# purchases are written back by flush(). A user's hash is loaded from Postgres plus the
+# pending deltas on first use, while holding the write-behind flush lock.
+
+DIRTY_LIVES_KEY = 'economy_dirty_lives'
+PURCHASES_KEY = 'economy_purchases'
+STATE_TTL = 60 * 60 * 24 * 7
+
+MISSING, REFUSED, DONE, ALREADY_OWNED = -1, 0, 1, 2
+
+REGENERATE = """
+local function regenerate(lives, since, now, cap, interval)
+    if lives >= cap then return lives, now end
+    local gained = math.floor(math.max(now - since, 0) / interval)
+    if lives + gained >= cap then return cap, now end
+    return lives + gained, since + gained * interval
+end
+local function ms(value) return string.format('%.0f', value) end
+"""
+
+# Every script that finds a user's hash keeps it and the purchased subtitles alive for
+# another STATE_TTL, so an active user's unflushed lives and purchases never expire.
+TOUCH = """
+local function touch(ttl, ...)
+    for _, key in ipairs({...}) do redis.call('EXPIRE', key, ttl) end
+end
+"""
+
+register_script('economy_load', """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('EXPIRE', KEYS[1], ARGV[5])
+    redis.call('EXPIRE', KEYS[2], ARGV[5])
+    return 0
+end
+local xp = tonumber(ARGV[1])
+local member = ARGV[4] .. ':xp'
+local applied_count = tonumber(ARGV[6])
+local applied = {}
+for i = 7, 6 + applied_count do applied[ARGV[i]] = true end
+local buffers = redis.call('SMEMBERS', KEYS[4])
+table.insert(buffers, KEYS[3])
+for _, key in ipairs(buffers) do
+    if not applied[key] then
+        xp = xp + (tonumber(redis.call('HGET', key, member)) or 0)
+    end
+end
+redis.call('HSET', KEYS[1], 'xp', xp, 'lives', ARGV[2], 'since', ARGV[3], 'rev', 0)
+redis.call('DEL', KEYS[2])
+redis.call('SADD', KEYS[2], 0)
+for i = 7 + applied_count, #ARGV do redis.call('SADD', KEYS[2], ARGV[i]) end
+for _, entry in ipairs(redis.call('LRANGE', KEYS[5], 0, -1)) do
+    local user_id, subtitle_id = string.match(entry, '^(%d+):(%d+):')
+    if user_id == ARGV[4] then redis.call('SADD', KEYS[2], subtitle_id) end
+end
+redis.call('EXPIRE', KEYS[1], ARGV[5])
+redis.call('EXPIRE', KEYS[2], ARGV[5])
+return 1
+""")
+
+register_script('economy_spend_life', REGENERATE + TOUCH + """
+if redis.call('EXISTS', KEYS[1]) == 0 then return {-1} end
+touch(ARGV[5], KEYS[1], KEYS[3])
+local lives, since = regenerate(tonumber(redis.call('HGET', KEYS[1], 'lives')),
+    tonumber(redis.call('HGET', KEYS[1], 'since')), tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]))
+if lives <= 0 then return {0, lives, ms(since)} end
+redis.call('HSET', KEYS[1], 'lives', lives - 1, 'since', ms(since))
+redis.call('HINCRBY', KEYS[1], 'rev', 1)
+redis.call('SADD', KEYS[2], ARGV[4])
+return {1, lives - 1, ms(since)}
+""")
+
+register_script('economy_buy_lives', REGENERATE + TOUCH + """
+if redis.call('EXISTS', KEYS[1]) == 0 then return {-1} end
+touch(ARGV[5], KEYS[1], KEYS[4])
+local cost, count = tonumber(ARGV[6]), tonumber(ARGV[7])
+local xp = tonumber(redis.call('HGET', KEYS[1], 'xp'))
+local lives, since = regenerate(tonumber(redis.call('HGET', KEYS[1], 'lives')),
+    tonumber(redis.call('HGET', KEYS[1], 'since')), tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]))
+if xp < cost then return {0, xp, lives} end
+xp = redis.call('HINCRBY', KEYS[1], 'xp', -cost)
+redis.call('HINCRBY', KEYS[3], ARGV[4] .. ':xp', -cost)
+redis.call('HSET', KEYS[1], 'lives', lives + count, 'since', ms(since))
+redis.call('HINCRBY', KEYS[1], 'rev', 1)
+redis.call('SADD', KEYS[2], ARGV[4])
+return {1, xp, lives + count}
+""")
+
+register_script('economy_add_xp', TOUCH + """
+local amount = tonumber(ARGV[2])
+local loaded = redis.call('EXISTS', KEYS[1]) == 1
+if loaded then touch(ARGV[3], KEYS[1], KEYS[3]) end
+if amount < 0 then
+    if not loaded then return {-1} end
+    if tonumber(redis.call('HGET', KEYS[1], 'xp')) + amount < 0 then return {0} end
+end
+redis.call('HINCRBY', KEYS[2], ARGV[1] .. ':xp', amount)
+if not loaded then return {1} end
+return {1, redis.call('HINCRBY', KEYS[1], 'xp', amount)}
+""")
+
+register_script('economy_buy_subtitle', TOUCH + """
+if redis.call('EXISTS', KEYS[1]) == 0 then return {-1} end
+touch(ARGV[4], KEYS[1], KEYS[2])
+if redis.call('SISMEMBER', KEYS[2], ARGV[2]) == 1 then return {2} end
+local cost = tonumber(ARGV[3])
+local xp = tonumber(redis.call('HGET', KEYS[1], 'xp'))
+if xp < cost then return {0, xp} end
+xp = redis.call('HINCRBY', KEYS[1], 'xp', -cost)
+redis.call('HINCRBY', KEYS[4], ARGV[1] .. ':xp', -cost)
+redis.call('SADD', KEYS[2], ARGV[2])
+redis.call('RPUSH', KEYS[3], ARGV[1] .. ':' .. ARGV[2] .. ':' .. ARGV[3])
+return {1, xp}
+""")
+
+register_script('economy_lives_written', """
+if redis.call('HGET', KEYS[1], 'rev') == ARGV[2] or redis.call('EXISTS', KEYS[1]) == 0 then
+    redis.call('SREM', KEYS[2], ARGV[1])
+end
+return 1
+""")
+
+
+def enabled():
+    return settings.REDIS_ECONOMY and write_behind.enabled()
+
+
+def state_key(user_id):
+    return f"user_{user_id}_economy"
+
+
+def subtitles_key(user_id):
+    return f"user_{user_id}_purchased_subtitles"
+
+
+def to_ms(moment):
+    return int(moment.timestamp() * 1000)
+
+
+def from_ms(value):
+    return datetime.fromtimestamp(int(value) / 1000, tz=dt_timezone.utc)
+
+
+def _regen_args(user_id):
+    return [to_ms(timezone.now()), settings.LIVES_REGEN_CAP, settings.LIVES_REGEN_INTERVAL * 1000, user_id,
+            STATE_TTL]
+
+
+def load(user_id):
+    """Load a user's economy into Redis unless it is there already; False if the user does not exist."""
+    r = get_redis()
+    if r.exists(state_key(user_id)):
+        return True
+    # The flush lock keeps the batches and their markers as they are while the row is read.
+    with r.lock(write_behind.FLUSH_LOCK, timeout=60, blocking_timeout=10):
+        user = UserGameState.objects.filter(user_id=user_id).values('xp', 'lives', 'last_life_lost_time').first()
+        if user is None:
+            return False
+        subtitle_ids = UserSubtitle.objects.filter(user_id=user_id).values_list('subtitle_id', flat=True)
+        applied = write_behind.applied_batches(r.smembers(write_behind.batches_key(write_behind.USER)))
+        script('economy_load')(
+            keys=[
+                state_key(user_id), subtitles_key(user_id), write_behind.buffer_key(write_behind.USER),
+                write_behind.batches_key(write_behind.USER), PURCHASES_KEY
+            ],
+            args=[user['xp'], user['lives'], to_ms(user['last_life_lost_time']), user_id, STATE_TTL,
+                  len(applied), *applied, *subtitle_ids]
+        )
+    return True
+
+
+def forget(user_id):
+    """
+    Drop a user's economy from Redis, unflushed lives included, so the next operation
+    loads the row again. For edits made to UserGameState outside this module.
+    """
+    r = get_redis()
+    # Under the flush lock, so a flush that has read the old lives does not write them after.
+    with r.lock(write_behind.FLUSH_LOCK, timeout=60, blocking_timeout=10):
+        r.delete(state_key(user_id), subtitles_key(user_id))
+        r.srem(DIRTY_LIVES_KEY, user_id)
+
+
+def _run(name, user_id, keys, args):
+    # A hash that expired between load() and the script is simply loaded again.
+    for _ in range(2):
+        result = script(name)(keys=keys, args=args)
+        if result[0] != MISSING:
+            return result
+        if not load(user_id):
+            return None
+    return result
+
+
+def stored_lives(user_id):
+    """(lives, regeneration start) held in Redis for a user, or None if not loaded."""
+    lives, since = get_redis().hmget(state_key(user_id), 'lives', 'since')
+    if lives is None:
+        return None
+    return int(lives), from_ms(since)
+
+
+def purchased_subtitles(user_id):
+    """
+    Subtitle ids bought according to Redis, including purchases flush() has not written
+    to UserSubtitle yet. Empty when the economy is off or the user is not loaded.
+    """
+    if not enabled():
+        return set()
+    try:
+        subtitle_ids = get_redis().smembers(subtitles_key(user_id))
+    except redis.RedisError:
+        logger.exception('Failed to read the purchased subtitles of user %s', user_id)
+        return set()
+    # 0 only keeps the set from being empty.
+    return {int(subtitle_id) for subtitle_id in subtitle_ids} - {0}
+
+
+def spend_life(user_id):
+    """(spent, lives left), or None if the user does not exist."""
+    result = _run(
+        'economy_spend_life', user_id, [state_key(user_id), DIRTY_LIVES_KEY, subtitles_key(user_id)],
+        _regen_args(user_id)
+    )
+    if result is None:
+        return None
+    profiles.invalidate(user_id)
+    return result[0] == DONE, result[1]
+
+
+def spend_life_on_commit(user_id):
+    # For a life lost inside a transaction (the event batch): the caller has checked that one
+    # is left, and it is taken once the transaction commits, so a batch that fails spends none.
+    def spend():
+        try:
+            spend_life(user_id)
+        except redis.RedisError:
+            logger.exception('Failed to take a life from user %s in Redis', user_id)
+    transaction.on_commit(spend)
+
+
+def buy_lives(user_id, cost, count=1):
+    """(bought, xp, lives), or None if the user does not exist."""
+    result = _run(
+        'economy_buy_lives', user_id,
+        [state_key(user_id), DIRTY_LIVES_KEY, write_behind.buffer_key(write_behind.USER), subtitles_key(user_id)],
+        _regen_args(user_id) + [cost, count]
+    )
+    if result is None:
+        return None
+    if result[0] == DONE:
+        leaderboard.record(user_id, XP=result[1])
+        profiles.invalidate(user_id)
+    return result[0] == DONE, result[1], result[2]
+
+
+def add_xp(user_id, amount, load_state=True):
+    """
+    Credit (or debit) XP; returns (applied, new balance), or None if the user does not
+    exist. Without load_state a credit to a user not loaded only buffers the delta and
+    the balance comes back as None.
+    """
+    if load_state and not load(user_id):
+        return None
+    keys = [state_key(user_id), write_behind.buffer_key(write_behind.USER), subtitles_key(user_id)]
+    result = _run('economy_add_xp', user_id, keys, [user_id, amount, STATE_TTL])
+    if result is None:
+        return None
+    xp = result[1] if len(result) > 1 else None
+    if result[0] == DONE and xp is not None:
+        leaderboard.record(user_id, XP=xp)
+    return result[0] == DONE, xp
+
+
+def credit_on_commit(user_id, amount):
+    # Counter changes made under a row lock (answers, the event batch) reach Redis once they commit.
+    def credit():
+        try:
+            add_xp(user_id, amount, load_state=False)
+        except redis.RedisError:
+            logger.exception('Failed to credit XP to user %s in Redis, buffering it', user_id)
+            write_behind.incr(write_behind.USER, (user_id,), xp=amount)
+    transaction.on_commit(credit)
+
+
+def buy_subtitle(user_id, subtitle_id, cost):
+    """(DONE | REFUSED | ALREADY_OWNED, xp), or None if the user does not exist."""
+    result = _run(
+        'economy_buy_subtitle', user_id,
+        [state_key(user_id), subtitles_key(user_id), PURCHASES_KEY, write_behind.buffer_key(write_behind.USER)],
+        [user_id, subtitle_id, cost, STATE_TTL]
+    )
+    if result is None:
+        return None
+    if result[0] == DONE:
+        leaderboard.record(user_id, XP=result[1])
+    return result[0], result[1] if len(result) > 1 else None
+
+
+def _write_back_lives(r):
+    written = 0
+    for user_id in r.smembers(DIRTY_LIVES_KEY):
+        lives, since, rev = r.hmget(state_key(user_id), 'lives', 'since', 'rev')
+        if lives is not None:
+            UserGameState.objects.filter(user_id=user_id).update(lives=int(lives), last_life_lost_time=from_ms(since))
+            profiles.invalidate(user_id)
+            written += 1
+        script('economy_lives_written')(keys=[state_key(user_id), DIRTY_LIVES_KEY], args=[user_id, rev or ''])
+    return written
+
+
+def _write_back_purchases(r, chunk_size=500):
+    entries = r.lrange(PURCHASES_KEY, 0, chunk_size - 1)
+    if not entries:
+        return 0
+    purchases = {}
+    for entry in entries:
+        user_id, subtitle_id, cost = (int(part) for part in entry.split(':'))
+        purchases[(user_id, subtitle_id)] = cost
+
+    with transaction.atomic():
+        # Inserting twice is what a flush that died before LTRIM would do; skip what is there.
+        existing = set(
+            UserSubtitle.objects.filter(user_id__in={user_id for user_id, _ in purchases})
+            .values_list('user_id', 'subtitle_id')
+        )
+        UserSubtitle.objects.bulk_create([
+            UserSubtitle(user_id=user_id, subtitle_id=subtitle_id, cost_in_xp=cost)
+            for (user_id, subtitle_id), cost in purchases.items() if (user_id, subtitle_id) not in existing
+        ])
+    r.ltrim(PURCHASES_KEY, len(entries), -1)
+    return len(entries)
+
+
+def flush():
+    """Write lives and purchases held in Redis back to Postgres."""
+    r = get_redis()
+    lock = r.lock(write_behind.FLUSH_LOCK, timeout=60, blocking=False)
+    if not lock.acquire():
+        return 0
+    try:
+        return _write_back_lives(r) + _write_back_purchases(r)
+    finally:
+        lock.release()
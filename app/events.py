@@ -0,0 +1,19 @@
+from django.dispatch import Signal
+
+# Domain events sent by the views after their writes are done. Every signal is sent
+# with `user_id` plus the arguments listed next to it.
+
+# card_ids: cards the user has viewed for the first time
+cards_viewed = Signal()
+
+# card_ids, passed: cards whose test_passed flag flipped to `passed`
+cards_passed = Signal()
+
+# count: correct quiz answers recorded for the user
+correct_answers_recorded = Signal()
+
+# subtitle_ids: subtitles whose cards the user has now all viewed
+subtitles_completed = Signal()
+
+# topic_ids: topics where the user has now viewed a card in every subtitle
+topics_completed = Signal()
@@ -0,0 +1,31 @@
+from django.db.models import Exists, OuterRef
+
+from app.models import Card, ViewedCard, Topic
+
+
+def unviewed_cards(user_id, after=None):
+    # NOT EXISTS against the (user, card) unique index keeps the cost independent
+    # of how many cards the user has already viewed; ordering by id gives a stable
+    # keyset cursor for ?after=<card_id>.
+    viewed = ViewedCard.objects.filter(user_id=user_id, card_id=OuterRef('pk'))
+    cards = Card.objects.filter(~Exists(viewed))
+    if after is not None:
+        cards = cards.filter(id__gt=after)
+    return cards.order_by('id')
+
+
+def topic_cards(user_id, after=None):
+    user_topics = Topic.objects.filter(users_interested__id=user_id).values('id')
+    return unviewed_cards(user_id, after).filter(topic_id__in=user_topics)
+
+
+def subtitle_cards(user_id, subtitle_id, after=None):
+    return unviewed_cards(user_id, after).filter(subtitle_id=subtitle_id)
+
+
+def topic_feed(user_id, limit, after=None):
+    return topic_cards(user_id, after)[:limit]
+
+
+def subtitle_feed(user_id, subtitle_id, limit, after=None):
+    return subtitle_cards(user_id, subtitle_id, after)[:limit]
@@ -0,0 +1,341 @@
+import logging
+from datetime import timedelta
+
+import redis
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Q, Subquery, Window
+from django.db.models.functions import Coalesce, DenseRank
+from django.utils import timezone
+
+from kombu.exceptions import OperationalError
+
+from app import single_flight
+from app.models import CustomUser, EarnedBadge, Leaderboard
+from app.redis_client import get_redis, pipeline, register_script, script
+
+logger = logging.getLogger(__name__)
+
+XP, CARDS, BADGES = (category for category, _ in Leaderboard.CATEGORY_CHOICES)
+
+# UsersView sort_by values and the category each one ranks by.
+SORT_CATEGORIES = {
+    'xp': XP,
+    'read_cards': CARDS,
+    'badges': BADGES,
+}
+
+# Bumped when the layout of the sets changes, so the first read after a deploy rebuilds them.
+BUILT_KEY = 'leaderboard_built_v2'
+SNAPSHOT_SCHEDULED_KEY = 'leaderboard_snapshot_scheduled'
+
+# Next to each ranking, a set of the distinct scores in it (member and score alike) gives
+# the same DENSE_RANK as the snapshot: 1 + the number of distinct scores above a user's.
+# Setting a score drops the old one from that set once no user holds it any more.
+register_script('leaderboard_set_score', """
+local old = redis.call('ZSCORE', KEYS[1], ARGV[1])
+if ARGV[2] == '' then
+    redis.call('ZREM', KEYS[1], ARGV[1])
+else
+    redis.call('ZADD', KEYS[1], ARGV[2], ARGV[1])
+    redis.call('ZADD', KEYS[2], ARGV[2], ARGV[2])
+end
+if old and old ~= ARGV[2] and redis.call('ZCOUNT', KEYS[1], old, old) == 0 then
+    redis.call('ZREM', KEYS[2], old)
+end
+return 1
+""")
+
+
+def key(category):
+    return f"leaderboard_{category.lower()}"
+
+
+def scores_key(category):
+    return f"{key(category)}_scores"
+
+
+def _write(fn):
+    try:
+        with pipeline() as pipe:
+            fn(pipe)
+    except redis.RedisError:
+        # The sets drifted from Postgres; the next read rebuilds them.
+        logger.exception('Failed to update leaderboards')
+        invalidate()
+
+
+def _set_score(pipe, category, user_id, score):
+    script('leaderboard_set_score')(keys=[key(category), scores_key(category)], args=[user_id, score], client=pipe)
+
+
+def record(user_id, **scores):
+    """Store the current scores of a user, e.g. record(user.id, XP=user.xp)."""
+    def apply(pipe):
+        for category, score in scores.items():
+            _set_score(pipe, category, user_id, score)
+
+    _write(apply)
+
+
+def record_badges(user_id):
+    record(user_id, BADGES=EarnedBadge.objects.filter(user_id=user_id).count())
+
+
+def remove(user_id):
+    def apply(pipe):
+        for category in (XP, CARDS, BADGES):
+            _set_score(pipe, category, user_id, '')
+
+    _write(apply)
+
+
+def invalidate():
+    try:
+        get_redis().delete(BUILT_KEY)
+    except redis.RedisError:
+        logger.exception('Failed to invalidate leaderboards')
+
+
+def scores_from_db():
+    users = CustomUser.objects.annotate(badges_count=Count('earned_badges')).order_by()
+    rows = users.values_list('id', 'game_state__xp', 'game_state__read_cards', 'badges_count')
+    for user_id, xp, read_cards, badges_count in rows.iterator():
+        # Users whose game state was never created rank with the defaults of a new one.
+        yield user_id, {XP: xp or 0, CARDS: read_cards or 0, BADGES: badges_count}
+
+
+def rebuild(chunk_size=5000):
+    # Fill staging sets and RENAME them over the live ones so readers never see a half-built board.
+    r = get_redis()
+    staging = {}
+    for category in (XP, CARDS, BADGES):
+        staging[key(category)] = f"{key(category)}_staging"
+        staging[scores_key(category)] = f"{scores_key(category)}_staging"
+    r.delete(*staging.values())
+
+    pipe = r.pipeline(transaction=False)
+    for count, (user_id, scores) in enumerate(scores_from_db(), 1):
+        for category, score in scores.items():
+            pipe.zadd(staging[key(category)], {user_id: score})
+            pipe.zadd(staging[scores_key(category)], {score: score})
+        if count % chunk_size == 0:
+            pipe.execute()
+    pipe.execute()
+
+    with r.pipeline() as pipe:
+        for live_key, staging_key in staging.items():
+            # An empty user table leaves no staging set behind, and RENAME needs an existing key.
+            if r.exists(staging_key):
+                pipe.rename(staging_key, live_key)
+            else:
+                pipe.delete(live_key)
+        pipe.set(BUILT_KEY, 1)
+        pipe.execute()
+
+
+def ensure_built():
+    r = get_redis()
+    if r.exists(BUILT_KEY):
+        return
+    # One worker rebuilds; after an invalidation the others keep reading the old sets,
+    # on a cold start they wait for the rebuild for as long as its lock may be held.
+    single_flight.run(
+        'leaderboard', BUILT_KEY, rebuild,
+        ready=lambda: r.exists(BUILT_KEY) or None,
+        stale_available=lambda: r.exists(key(XP)),
+        wait=settings.SINGLE_FLIGHT_LOCK_TIMEOUT,
+    )
+
+
+def top(category, limit):
+    """[(user_id, score)] for the best `limit` users of a category."""
+    ensure_built()
+    entries = get_redis().zrevrange(key(category), 0, limit - 1, withscores=True)
+    return [(int(user_id), int(score)) for user_id, score in entries]
+
+
+def rank(user_id, category):
+    """Dense rank of a user in a category, or None if the user is not ranked."""
+    ensure_built()
+    r = get_redis()
+    score = r.zscore(key(category), user_id)
+    if score is None:
+        return None
+    return r.zcount(scores_key(category), f'({score}', '+inf') + 1
+
+
+def score_expression(category):
+    if category == BADGES:
+        badges_count = EarnedBadge.objects.filter(user=OuterRef('pk')).order_by().values('user') \
+            .annotate(total=Count('id')).values('total')
+        return Coalesce(Subquery(badges_count), 0)
+    return F('game_state__xp') if category == XP else F('game_state__read_cards')
+
+
+def snapshot(category, chunk_size=5000):
+    """
+    Materialize the ranking of a category into Leaderboard with DENSE_RANK, so tied
+    users share a rank. The old rows are replaced inside one transaction, which keeps
+    readers on the previous snapshot until the new one is complete.
+    """
+    snapshot_at = timezone.now()
+    ranked = CustomUser.objects.annotate(
+        score=score_expression(category),
+        position=Window(DenseRank(), order_by=F('score').desc())
+    ).values_list('id', 'score', 'position')
+
+    with transaction.atomic():
+        Leaderboard.objects.filter(category=category).delete()
+        batch = []
+        for user_id, score, position in ranked.iterator(chunk_size=chunk_size):
+            batch.append(Leaderboard(
+                user_id=user_id, category=category, rank=position, score=score, snapshot_at=snapshot_at
+            ))
+            if len(batch) >= chunk_size:
+                Leaderboard.objects.bulk_create(batch)
+                batch = []
+        Leaderboard.objects.bulk_create(batch)
+    return snapshot_at
+
+
+def snapshot_time(category):
+    """Time of the current snapshot of a category, or None before the first one."""
+    return Leaderboard.objects.filter(category=category).order_by('rank') \
+        .values_list('snapshot_at', flat=True).first()
+
+
+def is_fresh(snapshot_at):
+    max_age = timedelta(seconds=settings.LEADERBOARD_SNAPSHOT_MAX_AGE)
+    return snapshot_at is not None and timezone.now() - snapshot_at <= max_age
+
+
+def schedule_snapshot():
+    # Readers that find the snapshot missing or stale queue one new snapshot per
+    # LEADERBOARD_SNAPSHOT_INTERVAL between them, on top of the beat schedule.
+    from app.tasks import snapshot_leaderboards
+
+    try:
+        if get_redis().set(SNAPSHOT_SCHEDULED_KEY, 1, nx=True, ex=settings.LEADERBOARD_SNAPSHOT_INTERVAL):
+            snapshot_leaderboards.delay()
+    except (redis.RedisError, OperationalError):
+        logger.exception('Failed to schedule a leaderboard snapshot')
+
+
+def listing(category, after=None, limit=None):
+    """
+    Snapshot rows of every user with a positive score, best first, as
+    (user_id, username, avatar_url, score, rank). `after` is the (score, user_id)
+    of the last row already sent; the (category, -score, user) index serves each page.
+    """
+    rows = Leaderboard.objects.filter(category=category, score__gt=0).order_by('-score', 'user_id')
+    if after is not None:
+        score, user_id = after
+        rows = rows.filter(Q(score__lt=score) | Q(score=score, user_id__gt=user_id))
+    rows = rows.values_list('user_id', 'user__username', 'user__avatar_url', 'score', 'rank')
+    return rows[:limit] if limit else rows
+
+
+def _live_chunks(r, category, max_score, chunk_size):
+    """Lists of (score, user ids in id order) for the positive scores up to max_score, highest first."""
+    while True:
+        members = r.zrevrangebyscore(key(category), max_score, '(0', start=0, num=chunk_size, withscores=True)
+        if not members:
+            return
+        groups = {}
+        for user_id, score in members:
+            groups.setdefault(int(score), []).append(int(user_id))
+        last_score = int(members[-1][1])
+        if len(members) == chunk_size:
+            # A full chunk may stop partway through the users tied on its lowest score.
+            groups[last_score] = [int(user_id) for user_id in r.zrangebyscore(key(category), last_score, last_score)]
+        yield [(score, sorted(user_ids)) for score, user_ids in groups.items()]
+        max_score = f'({last_score}'
+
+
+def _live_rows(r, category, after, limit, first_rank, chunk_size):
+    sent, next_rank = 0, first_rank
+    for chunk in _live_chunks(r, category, '+inf' if after is None else after[0], chunk_size):
+        # Each distinct score is one rank.
+        ranked = []
+        for score, user_ids in chunk:
+            if after is not None and score == after[0]:
+                user_ids = [user_id for user_id in user_ids if user_id > after[1]]
+            ranked += [(user_id, score, next_rank) for user_id in user_ids]
+            next_rank += 1
+        names = CustomUser.objects.filter(id__in=[user_id for user_id, _, _ in ranked]) \
+            .values_list('id', 'username', 'avatar_url')
+        names = {user_id: (username, avatar_url) for user_id, username, avatar_url in names}
+        for user_id, score, position in ranked:
+            if user_id in names:
+                yield (user_id, *names[user_id], score, position)
+                sent += 1
+                if sent == limit:
+                    return
+
+
+def live_listing(category, after=None, limit=None, chunk_size=500):
+    """listing() read from the live Redis sets, ties ordered by user id like the snapshot."""
+    ensure_built()
+    r = get_redis()
+    first_rank = 1 if after is None else r.zcount(scores_key(category), f'({after[0]}', '+inf') + 1
+    return _live_rows(r, category, after, limit, first_rank, chunk_size)
+
+
+def full_listing(category, after=None, limit=None):
+    """
+    (rows as in listing(), time the ranking was taken) of every ranked user. Like
+    standings(), the snapshot answers while it is fresh and the live sets otherwise,
+    while a new snapshot is taken in the background.
+    """
+    snapshot_at = snapshot_time(category)
+    if is_fresh(snapshot_at):
+        return listing(category, after, limit).iterator(chunk_size=1000), snapshot_at
+    schedule_snapshot()
+    try:
+        return live_listing(category, after, limit), timezone.now()
+    except redis.RedisError:
+        if snapshot_at is None:
+            raise
+        logger.exception('Leaderboards unavailable, serving the %s snapshot past its max age', category)
+        return listing(category, after, limit).iterator(chunk_size=1000), snapshot_at
+
+
+def snapshot_standings(category, limit, user_id=None):
+    rows = Leaderboard.objects.filter(category=category)
+    top_rows = list(rows.order_by('rank', 'user_id').values_list('user_id', 'rank', 'snapshot_at')[:limit])
+    if not top_rows:
+        return None
+    current_rank = rows.filter(user_id=user_id).values_list('rank', flat=True).first() if user_id else None
+    return [(ranked_id, position) for ranked_id, position, _ in top_rows], current_rank, top_rows[0][2]
+
+
+def live_standings(category, limit, user_id=None):
+    ranked, position, previous = [], 0, None
+    for ranked_id, score in top(category, limit):
+        # Dense ranks like the snapshot: tied users share one and the next score gets the next.
+        if score != previous:
+            position, previous = position + 1, score
+        ranked.append((ranked_id, position))
+    ranked.sort(key=lambda entry: (entry[1], entry[0]))
+    current_rank = rank(user_id, category) if user_id else None
+    return ranked, current_rank, timezone.now()
+
+
+def standings(category, limit, user_id=None):
+    """
+    ([(user_id, rank)] for the top `limit` users, rank of `user_id`, time the ranking was taken).
+    The Leaderboard snapshot answers while it is younger than LEADERBOARD_SNAPSHOT_MAX_AGE;
+    past that, or before the first snapshot, the live Redis sets do.
+    """
+    stored = snapshot_standings(category, limit, user_id)
+    if stored and is_fresh(stored[2]):
+        return stored
+    schedule_snapshot()
+    try:
+        return live_standings(category, limit, user_id)
+    except redis.RedisError:
+        if stored is None:
+            raise
+        logger.exception('Leaderboards unavailable, serving the %s snapshot past its max age', category)
+        return stored
@@ -0,0 +1,78 @@
+import logging
+from datetime import timedelta
+
+import redis
+from django.conf import settings
+from django.utils import timezone
+
+from app import economy
+
+logger = logging.getLogger(__name__)
+
+# Lives are not topped up by a job. UserGameState.lives holds the count as of
+# last_life_lost_time, and below LIVES_REGEN_CAP one life comes back every
+# LIVES_REGEN_INTERVAL seconds from then on. Lives above the cap (the sign-up
+# allowance, purchases) never regenerate. Rows are only written when a life
+# is spent or bought. With REDIS_ECONOMY the stored pair of a user active lately
+# lives in Redis, ahead of the row until the next flush.
+
+
+def regenerate(stored_lives, since, now=None):
+    """(lives now, time the next life started regenerating) for a stored count."""
+    now = now or timezone.now()
+    cap, interval = settings.LIVES_REGEN_CAP, settings.LIVES_REGEN_INTERVAL
+    if stored_lives >= cap or since is None:
+        return stored_lives, now
+
+    elapsed = max((now - since).total_seconds(), 0)
+    gained = int(elapsed // interval)
+    if stored_lives + gained >= cap:
+        return cap, now
+    return stored_lives + gained, since + timedelta(seconds=gained * interval)
+
+
+def stored(user_id, stored_lives, since):
+    """The stored (lives, since) of a user, taken from Redis when its economy is loaded there."""
+    if economy.enabled():
+        try:
+            state = economy.stored_lives(user_id)
+        except redis.RedisError:
+            logger.exception('Failed to read the lives of user %s from Redis', user_id)
+            state = None
+        if state is not None:
+            return state
+    return stored_lives, since
+
+
+def current(user, now=None):
+    return regenerate(*stored(user.id, user.lives, user.last_life_lost_time), now)[0]
+
+
+def seconds_until(user, lives, now=None):
+    """Seconds until the user is back to `lives` (at most the cap), 0 if already there."""
+    now = now or timezone.now()
+    count, since = regenerate(*stored(user.id, user.lives, user.last_life_lost_time), now)
+    if count >= min(lives, settings.LIVES_REGEN_CAP):
+        return 0
+    missing = min(lives, settings.LIVES_REGEN_CAP) - count
+    return missing * settings.LIVES_REGEN_INTERVAL - (now - since).total_seconds()
+
+
+def _store(user, lives, since):
+    user.lives = lives
+    user.last_life_lost_time = since
+    user.state.save(update_fields=['lives', 'last_life_lost_time'])
+
+
+def spend(user):
+    """Take one life from a locked user; returns False if none is left."""
+    lives, since = regenerate(user.lives, user.last_life_lost_time)
+    if lives <= 0:
+        return False
+    _store(user, lives - 1, since)
+    return True
+
+
+def add(user, count=1):
+    lives, since = regenerate(user.lives, user.last_life_lost_time)
+    _store(user, lives + count, since)
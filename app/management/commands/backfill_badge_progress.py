@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from app import badges
+from app.models import CustomUser
+
+
+class Command(BaseCommand):
+    help = 'Recompute UserBadgeProgress for existing users and award the badges they have already reached'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user-id', type=int, action='append', dest='user_ids')
+        parser.add_argument('--chunk-size', type=int, default=500)
+        parser.add_argument('--silent', action='store_true',
+                            help='Mark badges awarded by the backfill as already reported to the user')
+
+    def handle(self, *args, **options):
+        user_ids = CustomUser.objects.order_by('id').values_list('id', flat=True)
+        if options['user_ids']:
+            user_ids = user_ids.filter(id__in=options['user_ids'])
+
+        criteria = badges.badge_criteria()
+        catalog = badges.subtitle_catalog()
+
+        processed = 0
+        last_id = 0
+        while True:
+            chunk = list(user_ids.filter(id__gt=last_id)[:options['chunk_size']])
+            if not chunk:
+                break
+            for user_id in chunk:
+                with CaptureQueriesContext(connection) as queries:
+                    badges.recompute(user_id, notify=not options['silent'], criteria=criteria, catalog=catalog)
+                if options['verbosity'] > 1:
+                    self.stdout.write(f'User {user_id}: {len(queries)} queries for {len(criteria)} badges')
+            processed += len(chunk)
+            last_id = chunk[-1]
+            self.stdout.write(f'Backfilled {processed} users')
+
+        self.stdout.write(self.style.SUCCESS(f'Badge progress backfilled for {processed} users'))
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from app.models import CustomUser, UserGameState
+
+GAME_STATE_COLUMNS = ('xp', 'read_cards', 'lives', 'last_life_lost_time')
+
+
+class Command(BaseCommand):
+    help = ('Create the UserGameState row of every user that has none, copying xp, read_cards, lives and '
+            'last_life_lost_time from the CustomUser table while it still has those columns')
+
+    def handle(self, *args, **options):
+        quote = connection.ops.quote_name
+        users, states = CustomUser._meta.db_table, UserGameState._meta.db_table
+        with connection.cursor() as cursor:
+            columns = {column.name for column in connection.introspection.get_table_description(cursor, users)}
+
+        if set(GAME_STATE_COLUMNS) <= columns:
+            copied = ', '.join(quote(column) for column in GAME_STATE_COLUMNS)
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute(
+                    f'INSERT INTO {quote(states)} ({quote("user_id")}, {copied}) '
+                    f'SELECT u.{quote("id")}, {", ".join("u." + quote(c) for c in GAME_STATE_COLUMNS)} '
+                    f'FROM {quote(users)} u WHERE NOT EXISTS '
+                    f'(SELECT 1 FROM {quote(states)} s WHERE s.{quote("user_id")} = u.{quote("id")})'
+                )
+                created = cursor.rowcount
+            self.stdout.write(self.style.SUCCESS(f'Copied the game state of {created} users'))
+            return
+
+        missing = CustomUser.objects.filter(game_state__isnull=True).values_list('id', flat=True)
+        created = len(UserGameState.objects.bulk_create(
+            [UserGameState(user_id=user_id) for user_id in missing.iterator()], batch_size=5000
+        ))
+        self.stdout.write(self.style.SUCCESS(f'Created a default game state for {created} users'))
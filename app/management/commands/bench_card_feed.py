@@ -0,0 +1,80 @@
+import statistics
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from app import catalog
+from app.feed import topic_feed
+from app.models import Topic, Subtitle, Card, CustomUser, ViewedCard
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the card feed query against a synthetic user with a long ViewedCard history'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--viewed', type=int, default=50000)
+        parser.add_argument('--extra-cards', type=int, default=1000)
+        parser.add_argument('--limit', type=int, default=20)
+        parser.add_argument('--runs', type=int, default=20)
+        parser.add_argument('--keep', action='store_true', help='Keep the seeded rows instead of rolling back')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            user = self.seed(options['viewed'], options['extra_cards'])
+            self.stdout.write(f"Seeded user {user.id} with {options['viewed']} viewed cards")
+
+            checkpoints = sorted({1000, 10000, options['viewed']})
+            for viewed in checkpoints:
+                if viewed > options['viewed']:
+                    continue
+                ViewedCard.objects.filter(user=user).delete()
+                cards = Card.objects.filter(topic__in=user.topics.all()).order_by('id').values_list('id', flat=True)
+                ViewedCard.objects.bulk_create(
+                    [ViewedCard(user=user, card_id=card_id) for card_id in cards[:viewed]],
+                    batch_size=5000
+                )
+
+                legacy = self.measure(lambda: self.legacy_feed(user, options['limit']), options['runs'])
+                anti_join = self.measure(lambda: list(topic_feed(user.id, options['limit'])), options['runs'])
+                after = cards[viewed - 1] if viewed else None
+                cursor = self.measure(lambda: list(topic_feed(user.id, options['limit'], after)), options['runs'])
+                self.stdout.write(
+                    f"viewed={viewed:>6}  legacy median={legacy[0]:.2f}ms p95={legacy[1]:.2f}ms  "
+                    f"anti-join median={anti_join[0]:.2f}ms p95={anti_join[1]:.2f}ms  "
+                    f"anti-join+cursor median={cursor[0]:.2f}ms p95={cursor[1]:.2f}ms"
+                )
+
+            if not options['keep']:
+                transaction.set_rollback(True)
+
+    def seed(self, viewed, extra_cards):
+        suffix = uuid.uuid4().hex[:8]
+        topic = Topic.objects.create(title=f'bench-{suffix}')
+        subtitle = Subtitle.objects.create(title=f'bench-{suffix}', topic=topic)
+        cards = Card.objects.bulk_create(
+            [Card(topic=topic, subtitle=subtitle, title=f'bench card {i}', content='', source='bench')
+             for i in range(viewed + extra_cards)],
+            batch_size=5000
+        )
+        catalog.cards_ingested(cards)
+        user = CustomUser.objects.create(username=f'bench-{suffix}', email=f'bench-{suffix}@example.com')
+        user.topics.set([topic])
+        return user
+
+    @staticmethod
+    def legacy_feed(user, limit):
+        user_topics = user.topics.all().values_list('id', flat=True)
+        viewed_card_ids = user.viewed_cards.all().values_list('card_id', flat=True)
+        return list(Card.objects.filter(topic__id__in=user_topics).exclude(id__in=viewed_card_ids)[:limit])
+
+    @staticmethod
+    def measure(fn, runs):
+        timings = []
+        for _ in range(runs):
+            started = time.perf_counter()
+            fn()
+            timings.append((time.perf_counter() - started) * 1000)
+        timings.sort()
+        return statistics.median(timings), timings[int(len(timings) * 0.95) - 1]
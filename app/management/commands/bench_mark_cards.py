@@ -0,0 +1,121 @@
+import statistics
+import time
+import uuid
+
+import fakeredis
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import F
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+
+from app import catalog, card_bitmaps, events, redis_client, services
+from app.models import Topic, Subtitle, Card, CustomUser, ViewedCard, UserQuizStatistics, DailyReadCards
+
+
+class Command(BaseCommand):
+    help = 'Benchmark a MarkCardsAndViewedQuizzes submission: per-card get_or_create against the bulk upsert path'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--cards', type=int, default=20)
+        parser.add_argument('--seen', type=int, default=5, help='How many of the submitted cards were viewed before')
+        parser.add_argument('--runs', type=int, default=20)
+
+    def handle(self, *args, **options):
+        # The bitmaps, leaderboards and caches are written for ids the rollback throws away,
+        # so Redis is a throwaway in-process server (fakeredis, from requirements-dev.txt).
+        server = fakeredis.FakeServer()
+        redis_client.use_clients(
+            fakeredis.FakeRedis(server=server, decode_responses=True), fakeredis.FakeRedis(server=server)
+        )
+        try:
+            self.bench(options)
+        finally:
+            redis_client.reset()
+
+    def bench(self, options):
+        # With write-behind the bulk path would leave its counters in Redis for a flush after
+        # the rollback, so both paths write them to Postgres. Whatever either path queues for
+        # the commit runs inside the measurement, as it would after a real request.
+        with override_settings(WRITE_BEHIND_COUNTERS=False), transaction.atomic():
+            user, card_ids = self.seed(options['cards'])
+            correct_answer_ids = card_ids[::2]
+
+            for name, submit in (('legacy', self.legacy_submit), ('bulk', services.record_quiz_answers)):
+                timings, queries = [], []
+                for _ in range(options['runs']):
+                    ViewedCard.objects.filter(user=user).delete()
+                    ViewedCard.objects.bulk_create(
+                        [ViewedCard(user=user, card_id=card_id, test_passed=True, correct=True)
+                         for card_id in card_ids[:options['seen']]]
+                    )
+                    with CaptureQueriesContext(connection) as context:
+                        started = time.perf_counter()
+                        with TestCase.captureOnCommitCallbacks(execute=True):
+                            submit(user.id, card_ids, correct_answer_ids)
+                        timings.append((time.perf_counter() - started) * 1000)
+                    queries.append(len(context.captured_queries))
+                timings.sort()
+                self.stdout.write(
+                    f"{name:>6}: median={statistics.median(timings):.2f}ms "
+                    f"p95={timings[int(len(timings) * 0.95) - 1]:.2f}ms queries={max(queries)}"
+                )
+
+            transaction.set_rollback(True)
+
+    def seed(self, count):
+        suffix = uuid.uuid4().hex[:8]
+        topic = Topic.objects.create(title=f'bench-{suffix}')
+        subtitle = Subtitle.objects.create(title=f'bench-{suffix}', topic=topic)
+        cards = Card.objects.bulk_create(
+            [Card(topic=topic, subtitle=subtitle, title=f'bench card {i}', content='', source='bench')
+             for i in range(count)]
+        )
+        catalog.cards_ingested(cards)
+        user = CustomUser.objects.create(username=f'bench-{suffix}', email=f'bench-{suffix}@example.com')
+        return user, [card.id for card in cards]
+
+    @staticmethod
+    def legacy_submit(user_id, card_ids, correct_answer_ids):
+        # MarkCardsAndViewedQuizzes as it was before the bulk upsert path.
+        user = CustomUser.objects.get(id=user_id)
+        correct_answers_count = 0
+        incorrect_answers_count = 0
+        created_ids, passed_ids, unpassed_ids = [], [], []
+
+        for card_id in card_ids:
+            viewed_card, created = ViewedCard.objects.get_or_create(
+                user=user,
+                card_id=card_id,
+                defaults={'test_passed': card_id in correct_answer_ids, 'correct': card_id in correct_answer_ids}
+            )
+            if created:
+                created_ids.append(card_id)
+            if card_id in correct_answer_ids:
+                correct_answers_count += 1
+                if created:
+                    passed_ids.append(card_id)
+            else:
+                incorrect_answers_count += 1
+                if not created:
+                    if viewed_card.test_passed:
+                        unpassed_ids.append(card_id)
+                    viewed_card.test_passed = False
+                    viewed_card.correct = False
+                    viewed_card.save()
+        card_bitmaps.record_viewed(user.id, created_ids, passed_ids, unpassed_ids)
+        events.cards_viewed.send(sender=ViewedCard, user_id=user.id, card_ids=created_ids)
+        events.cards_passed.send(sender=ViewedCard, user_id=user.id, card_ids=passed_ids, passed=True)
+        events.cards_passed.send(sender=ViewedCard, user_id=user.id, card_ids=unpassed_ids, passed=False)
+        UserQuizStatistics.objects.get_or_create(user=user)
+        UserQuizStatistics.objects.filter(user=user).update(
+            total_attempts=F('total_attempts') + len(card_ids),
+            correct_attempts=F('correct_attempts') + correct_answers_count,
+            incorrect_attempts=F('incorrect_attempts') + incorrect_answers_count,
+        )
+        events.correct_answers_recorded.send(sender=UserQuizStatistics, user_id=user.id, count=correct_answers_count)
+
+        daily_stat, created = DailyReadCards.objects.get_or_create(user=user, date=timezone.now().date())
+        daily_stat.cards_read = F('cards_read') + len(card_ids)
+        daily_stat.save()
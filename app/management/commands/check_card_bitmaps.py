@@ -0,0 +1,72 @@
+from django.core.management.base import BaseCommand
+
+from app import card_bitmaps
+from app.models import Card, CustomUser, ViewedCard
+from app.redis_client import get_redis
+
+
+class Command(BaseCommand):
+    help = 'Compare the Redis card bitmaps with ViewedCard and Card, and rebuild the ones that drifted'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rebuild', action='store_true', help='Rebuild the bitmaps that do not match')
+        parser.add_argument('--force', action='store_true', help='Rebuild every bitmap without comparing')
+        parser.add_argument('--chunk-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        rebuild = options['rebuild'] or options['force']
+
+        if options['force'] or not self.catalog_matches():
+            if not options['force']:
+                self.stdout.write('Catalog bitmaps drifted from Card')
+            if rebuild:
+                card_bitmaps.rebuild_catalog()
+
+        checked = drifted = 0
+        user_ids = CustomUser.objects.order_by('id').values_list('id', flat=True)
+        for offset in range(0, user_ids.count(), options['chunk_size']):
+            for user_id in user_ids[offset:offset + options['chunk_size']]:
+                checked += 1
+                if options['force'] or not self.user_matches(user_id):
+                    drifted += 1
+                    if rebuild:
+                        card_bitmaps.rebuild_user(user_id)
+
+        action = 'rebuilt' if rebuild else 'found'
+        self.stdout.write(self.style.SUCCESS(f'Checked {checked} users, {action} {drifted} drifted bitmaps'))
+
+    @staticmethod
+    def user_matches(user_id):
+        r = get_redis(binary=True)
+        built, viewed, passed = r.mget(
+            card_bitmaps.user_built_key(user_id),
+            card_bitmaps.viewed_key(user_id),
+            card_bitmaps.passed_key(user_id)
+        )
+        if not built:
+            # Never built (or invalidated): the next read rebuilds it from ViewedCard.
+            return True
+
+        rows = ViewedCard.objects.filter(user_id=user_id).values_list('card_id', 'test_passed')
+        expected_viewed = {card_id for card_id, _ in rows}
+        expected_passed = {card_id for card_id, test_passed in rows if test_passed}
+        return card_bitmaps.from_bitmap(viewed) == expected_viewed and \
+            card_bitmaps.from_bitmap(passed) == expected_passed
+
+    @staticmethod
+    def catalog_matches():
+        r = get_redis(binary=True)
+        if not r.exists(card_bitmaps.CATALOG_BUILT_KEY):
+            return True
+
+        topics, subtitles = {}, {}
+        for card_id, topic_id, subtitle_id in Card.objects.values_list('id', 'topic_id', 'subtitle_id').iterator():
+            topics.setdefault(topic_id, set()).add(card_id)
+            if subtitle_id is not None:
+                subtitles.setdefault(subtitle_id, set()).add(card_id)
+
+        keys = [card_bitmaps.topic_key(topic_id) for topic_id in topics] + \
+               [card_bitmaps.subtitle_key(subtitle_id) for subtitle_id in subtitles]
+        expected = list(topics.values()) + list(subtitles.values())
+        actual = r.mget(keys) if keys else []
+        return all(card_bitmaps.from_bitmap(data) == ids for data, ids in zip(actual, expected))
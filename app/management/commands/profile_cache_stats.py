@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from app import profiles
+
+
+class Command(BaseCommand):
+    help = 'Show the hit rate of the cached user profiles served by GetUserStatsView'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='Reset the counters after printing them')
+
+    def handle(self, *args, **options):
+        hits, misses = profiles.cache_stats()
+        total = hits + misses
+        rate = hits / total * 100 if total else 0
+        self.stdout.write(f'{hits} hits, {misses} misses ({rate:.1f}% hit rate)')
+        if options['reset']:
+            profiles.reset_cache_stats()
+            self.stdout.write(self.style.SUCCESS('Counters reset'))
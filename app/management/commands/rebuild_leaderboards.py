@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from app import leaderboard
+from app.redis_client import get_redis
+
+
+class Command(BaseCommand):
+    help = 'Repopulate the Redis leaderboard sorted sets from Postgres'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        leaderboard.rebuild(chunk_size=options['chunk_size'])
+        r = get_redis()
+        for category in (leaderboard.XP, leaderboard.CARDS, leaderboard.BADGES):
+            self.stdout.write(f'{category}: {r.zcard(leaderboard.key(category))} users')
+        self.stdout.write(self.style.SUCCESS('Leaderboards rebuilt'))
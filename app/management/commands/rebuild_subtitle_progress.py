@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+
+from app import progress
+from app.models import CustomUser
+
+
+class Command(BaseCommand):
+    help = 'Recompute UserSubtitleProgress from ViewedCard, one chunk of users at a time'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user-id', type=int, action='append', dest='user_ids')
+        parser.add_argument('--chunk-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        user_ids = CustomUser.objects.order_by('id').values_list('id', flat=True)
+        if options['user_ids']:
+            user_ids = user_ids.filter(id__in=options['user_ids'])
+
+        processed = 0
+        last_id = 0
+        while True:
+            chunk = list(user_ids.filter(id__gt=last_id)[:options['chunk_size']])
+            if not chunk:
+                break
+            for user_id in chunk:
+                progress.rebuild(user_id)
+            processed += len(chunk)
+            last_id = chunk[-1]
+            self.stdout.write(f'Rebuilt progress for {processed} users')
+
+        self.stdout.write(self.style.SUCCESS(f'Subtitle progress rebuilt for {processed} users'))
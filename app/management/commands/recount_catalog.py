@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from app import catalog
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the denormalized card_count/active_card_count of every Topic and Subtitle'
+
+    def handle(self, *args, **options):
+        catalog.recount()
+        self.stdout.write(self.style.SUCCESS('Catalog card counts rebuilt'))
@@ -0,0 +1,63 @@
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+
+from app import users
+from app.models import CustomUser, UserStreak, CorrectStreak, UserQuizStatistics, DailyReadCards
+
+
+class Command(BaseCommand):
+    help = ('Count the queries of the endpoints that load a user: on a cold process, with the id '
+            'already known to the process, and authenticated as that user')
+
+    ENDPOINTS = [
+        ('GET', '/api/saved-cards/{id}/', None),
+        ('GET', '/api/user-badge-progress/?user_id={id}', None),
+        ('GET', '/api/check-achievements/?user_id={id}', None),
+        ('GET', '/api/topics-progress/{id}/', None),
+        ('GET', '/api/current-streak/{id}/', None),
+        ('GET', '/api/user-stats-full/{id}/', None),
+        ('GET', '/api/get-lives/?user_id={id}', None),
+        ('GET', '/api/check_restore_lives/{id}/', None),
+        ('POST', '/api/update-quiz-streak/', {'streak_count': 1}),
+    ]
+
+    def handle(self, *args, **options):
+        user_table = CustomUser._meta.db_table
+        with transaction.atomic():
+            suffix = uuid.uuid4().hex[:8]
+            user = CustomUser.objects.create(username=f'report-{suffix}', email=f'report-{suffix}@example.com')
+            for model in (UserStreak, CorrectStreak, UserQuizStatistics):
+                model.objects.create(user=user)
+            DailyReadCards.objects.create(user=user, date=timezone.now().date())
+            token = Token.objects.create(user=user)
+            clients = {'anonymous': Client(), 'token': Client(HTTP_AUTHORIZATION=f'Token {token.key}')}
+            # Let the token reach its cache before counting.
+            clients['token'].get(f'/api/current-streak/{user.id}/')
+
+            self.stdout.write(f"{'endpoint':<45} {'cold':>10} {'known id':>10} {'token':>10}   (total/{user_table})")
+            for method, path, data in self.ENDPOINTS:
+                path = path.format(id=user.id)
+                payload = {**data, 'user_id': user.id} if data is not None else None
+                counts = []
+                for name, forget in (('anonymous', True), ('anonymous', False), ('token', True)):
+                    if forget:
+                        users.forget(user.id)
+                    with CaptureQueriesContext(connection) as context:
+                        if method == 'GET':
+                            clients[name].get(path)
+                        else:
+                            clients[name].post(path, payload, content_type='application/json')
+                    user_queries = sum(
+                        1 for query in context.captured_queries
+                        if f'FROM "{user_table}"' in query['sql'] or f'FROM `{user_table}`' in query['sql']
+                    )
+                    counts.append(f'{len(context.captured_queries)}/{user_queries}')
+                self.stdout.write(f'{method} {path:<41} {counts[0]:>10} {counts[1]:>10} {counts[2]:>10}')
+
+            transaction.set_rollback(True)
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from app import single_flight
+
+
+class Command(BaseCommand):
+    help = 'Show how many cache rebuilds were coalesced, per cache, for the catalog, profiles and leaderboards'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='Reset the counters after printing them')
+
+    def handle(self, *args, **options):
+        stats = single_flight.stats()
+        if not stats:
+            self.stdout.write('No rebuilds recorded')
+        for name, counts in sorted(stats.items()):
+            coalesced = counts['stale'] + counts['waited']
+            self.stdout.write(
+                f"{name}: {counts['rebuilt']} rebuilt, {coalesced} coalesced "
+                f"({counts['stale']} served stale, {counts['waited']} waited), {counts['timeout']} timed out"
+            )
+        if options['reset']:
+            single_flight.reset_stats()
+            self.stdout.write(self.style.SUCCESS('Counters reset'))
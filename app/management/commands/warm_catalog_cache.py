@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from app import catalog
+from app.models import Topic
+
+
+class Command(BaseCommand):
+    help = 'Cache the topic list and the subtitles of every topic under the current catalog version, e.g. on deploy'
+
+    def handle(self, *args, **options):
+        catalog_version = catalog.version()
+        if catalog_version is None:
+            raise CommandError('Redis is unavailable')
+
+        catalog.topics(catalog_version)
+        topic_ids = list(Topic.objects.values_list('id', flat=True))
+        for topic_id in topic_ids:
+            catalog.subtitles(catalog_version, topic_id)
+        self.stdout.write(self.style.SUCCESS(
+            f'Catalog version {catalog_version} cached: topic list and {len(topic_ids)} topics'
+        ))
@@ -0,0 +1,21 @@
+# Generated by Django 4.2.6 on 2026-10-18 16:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='card',
+            index=models.Index(fields=['topic', 'id'], name='app_card_topic_i_4b8737_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='card',
+            index=models.Index(fields=['subtitle', 'id'], name='app_card_subtitl_c024ec_idx'),
+        ),
+    ]
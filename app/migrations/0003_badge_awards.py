@@ -0,0 +1,135 @@
+# Generated by Django 4.2.6 on 2026-10-18 16:31
+
+from collections import Counter, defaultdict
+
+from django.db import migrations, models
+from django.db.models import Count, Min, Q, Sum
+
+# Badge criteria as app.badges reads them, frozen here for the historical models.
+READ_CARDS = 'read_cards'
+CORRECT_QUIZ_ANSWERS = 'correct_quiz_answers'
+COMPLETE_SUBTOPICS = 'complete_subtopics'
+COMPLETE_TOPIC = 'complete_topic'
+READ_SPECIFIC_TOPIC = 'read_specific_topic'
+QUIZ_SPECIFIC_TOPIC = 'quiz_specific_topic'
+
+
+def criterion(criteria):
+    if criteria.get(READ_CARDS, False):
+        return READ_CARDS, None, criteria[READ_CARDS]
+    if CORRECT_QUIZ_ANSWERS in criteria:
+        return CORRECT_QUIZ_ANSWERS, None, criteria[CORRECT_QUIZ_ANSWERS]
+    if criteria.get(COMPLETE_SUBTOPICS, False):
+        return COMPLETE_SUBTOPICS, None, criteria[COMPLETE_SUBTOPICS]
+    if COMPLETE_TOPIC in criteria:
+        return COMPLETE_TOPIC, None, criteria[COMPLETE_TOPIC]
+    for kind in (READ_SPECIFIC_TOPIC, QUIZ_SPECIFIC_TOPIC):
+        if kind in criteria:
+            return kind, criteria[kind]['topic_id'], criteria[kind]['count']
+    return None
+
+
+def delete_duplicates(apps, schema_editor):
+    # Keep the first row of each (user, badge) so the unique constraints can be added.
+    for name in ('EarnedBadge', 'UserBadgeProgress'):
+        model = apps.get_model('app', name)
+        first_ids = model.objects.values('user_id', 'badge_id').annotate(first_id=Min('id')).values('first_id')
+        model.objects.exclude(id__in=first_ids).delete()
+
+
+def fill_badge_progress(apps, schema_editor):
+    """
+    Progress now only moves with events, so it starts from what each user has done so
+    far, computed like badges.evaluate(). Badges already reached are awarded unreported,
+    as the achievements check used to do on its next call.
+    """
+    Badge = apps.get_model('app', 'Badge')
+    Card = apps.get_model('app', 'Card')
+    EarnedBadge = apps.get_model('app', 'EarnedBadge')
+    Subtitle = apps.get_model('app', 'Subtitle')
+    UserBadgeProgress = apps.get_model('app', 'UserBadgeProgress')
+    UserQuizStatistics = apps.get_model('app', 'UserQuizStatistics')
+    ViewedCard = apps.get_model('app', 'ViewedCard')
+
+    criteria = {}
+    for badge_id, badge_criteria in Badge.objects.values_list('id', 'criteria'):
+        badge_criterion = criterion(badge_criteria or {})
+        if badge_criterion:
+            criteria[badge_id] = badge_criterion
+    if not criteria:
+        return
+
+    values = defaultdict(Counter)
+    for user_id, topic_id, passed in ViewedCard.objects.values('user_id', 'card__topic_id').order_by() \
+            .annotate(passed=Count('id', filter=Q(test_passed=True))) \
+            .values_list('user_id', 'card__topic_id', 'passed').iterator():
+        values[user_id][(READ_CARDS, None)] += passed
+        values[user_id][(READ_SPECIFIC_TOPIC, topic_id)] += passed
+        values[user_id][(QUIZ_SPECIFIC_TOPIC, topic_id)] += passed
+
+    for user_id, correct in UserQuizStatistics.objects.values('user_id').order_by() \
+            .annotate(correct=Sum('correct_attempts')).values_list('user_id', 'correct').iterator():
+        values[user_id][(CORRECT_QUIZ_ANSWERS, None)] += correct or 0
+
+    totals = dict(
+        Card.objects.filter(subtitle__isnull=False).values('subtitle_id').order_by()
+        .annotate(total=Count('id')).values_list('subtitle_id', 'total')
+    )
+    catalog = list(Subtitle.objects.values_list('id', 'topic_id'))
+    viewed = defaultdict(dict)
+    for user_id, subtitle_id, count in ViewedCard.objects.filter(card__subtitle__isnull=False) \
+            .values('user_id', 'card__subtitle_id').order_by().annotate(viewed=Count('id')) \
+            .values_list('user_id', 'card__subtitle_id', 'viewed').iterator():
+        viewed[user_id][subtitle_id] = count
+    for user_id, user_viewed in viewed.items():
+        topic_touched = {}
+        for subtitle_id, topic_id in catalog:
+            count = user_viewed.get(subtitle_id, 0)
+            if count and count >= totals.get(subtitle_id, 0):
+                values[user_id][(COMPLETE_SUBTOPICS, None)] += 1
+            topic_touched[topic_id] = topic_touched.get(topic_id, True) and count > 0
+        values[user_id][(COMPLETE_TOPIC, None)] = sum(1 for touched in topic_touched.values() if touched)
+
+    UserBadgeProgress.objects.filter(badge_id__in=criteria).update(progress_number=0)
+    progress, earned = [], []
+    for user_id, user_values in values.items():
+        for badge_id, (kind, topic_id, threshold) in criteria.items():
+            value = user_values[(kind, topic_id)]
+            if value:
+                progress.append(UserBadgeProgress(user_id=user_id, badge_id=badge_id, progress_number=value))
+            if value >= threshold:
+                earned.append(EarnedBadge(user_id=user_id, badge_id=badge_id, notified=False))
+    UserBadgeProgress.objects.bulk_create(
+        progress, batch_size=1000, update_conflicts=True, unique_fields=['user', 'badge'],
+        update_fields=['progress_number']
+    )
+    EarnedBadge.objects.bulk_create(earned, batch_size=1000, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0002_card_feed_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='earnedbadge',
+            name='notified',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.RunPython(delete_duplicates, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='earnedbadge',
+            unique_together={('user', 'badge')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='userbadgeprogress',
+            unique_together={('user', 'badge')},
+        ),
+        migrations.AddIndex(
+            model_name='earnedbadge',
+            index=models.Index(fields=['user', 'notified'], name='app_earnedb_user_id_4f7726_idx'),
+        ),
+        migrations.RunPython(fill_badge_progress, migrations.RunPython.noop),
+    ]
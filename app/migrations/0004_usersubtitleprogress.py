@@ -0,0 +1,62 @@
+# Generated by Django 4.2.6 on 2026-10-18 16:31
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Q
+import django.db.models.deletion
+
+
+def fill_subtitle_progress(apps, schema_editor):
+    # What progress.rebuild() computes, for every user at once.
+    Card = apps.get_model('app', 'Card')
+    UserSubtitleProgress = apps.get_model('app', 'UserSubtitleProgress')
+    ViewedCard = apps.get_model('app', 'ViewedCard')
+
+    totals = dict(
+        Card.objects.filter(subtitle__isnull=False).values('subtitle_id').order_by()
+        .annotate(total=Count('id')).values_list('subtitle_id', 'total')
+    )
+    rows = ViewedCard.objects.filter(card__subtitle__isnull=False) \
+        .values('user_id', 'card__subtitle_id', 'card__subtitle__topic_id').order_by() \
+        .annotate(viewed=Count('id'), passed=Count('id', filter=Q(test_passed=True)))
+    batch = []
+    for row in rows.iterator():
+        batch.append(UserSubtitleProgress(
+            user_id=row['user_id'],
+            subtitle_id=row['card__subtitle_id'],
+            topic_id=row['card__subtitle__topic_id'],
+            viewed_count=row['viewed'],
+            passed_count=row['passed'],
+            completed=row['viewed'] >= totals.get(row['card__subtitle_id'], 0),
+        ))
+        if len(batch) >= 1000:
+            UserSubtitleProgress.objects.bulk_create(batch)
+            batch = []
+    UserSubtitleProgress.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0003_badge_awards'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserSubtitleProgress',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('viewed_count', models.PositiveIntegerField(default=0)),
+                ('passed_count', models.PositiveIntegerField(default=0)),
+                ('completed', models.BooleanField(default=False)),
+                ('subtitle', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='user_progress', to='app.subtitle')),
+                ('topic', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='user_subtitle_progress', to='app.topic')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='subtitle_progress', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', 'topic'], name='app_usersub_user_id_ea1a6a_idx')],
+                'unique_together': {('user', 'subtitle')},
+            },
+        ),
+        migrations.RunPython(fill_subtitle_progress, migrations.RunPython.noop),
+    ]
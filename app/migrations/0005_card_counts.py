@@ -0,0 +1,57 @@
+# Generated by Django 4.2.6 on 2026-10-18 16:31
+
+from django.db import migrations, models
+from django.db.models import Case, Count, F, OuterRef, Subquery, When
+from django.db.models.functions import Coalesce
+
+
+def count_cards(cards, field):
+    return Coalesce(
+        Subquery(cards.filter(**{field: OuterRef('pk')}).order_by().values(field).annotate(n=Count('id')).values('n')),
+        0
+    )
+
+
+def fill_card_counts(apps, schema_editor):
+    # catalog.recount() over the whole catalog.
+    Card = apps.get_model('app', 'Card')
+    Subtitle = apps.get_model('app', 'Subtitle')
+    Topic = apps.get_model('app', 'Topic')
+
+    Subtitle.objects.update(card_count=count_cards(Card.objects.all(), 'subtitle'))
+    Subtitle.objects.update(active_card_count=Case(When(exist=True, then=F('card_count')), default=0))
+    Topic.objects.update(
+        card_count=count_cards(Card.objects.all(), 'topic'),
+        active_card_count=count_cards(Card.objects.filter(subtitle__exist=True), 'topic'),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0004_usersubtitleprogress'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='subtitle',
+            name='active_card_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='subtitle',
+            name='card_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='topic',
+            name='active_card_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='topic',
+            name='card_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(fill_card_counts, migrations.RunPython.noop),
+    ]
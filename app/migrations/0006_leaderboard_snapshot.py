@@ -0,0 +1,41 @@
+# Generated by Django 4.2.6 on 2026-10-18 16:31
+
+from django.db import migrations, models
+from django.db.models import Min
+import django.utils.timezone
+
+
+def delete_duplicates(apps, schema_editor):
+    # Nothing wrote the table before; keep one row per (user, category) for the constraint.
+    Leaderboard = apps.get_model('app', 'Leaderboard')
+    first_ids = Leaderboard.objects.values('user_id', 'category').annotate(first_id=Min('id')).values('first_id')
+    Leaderboard.objects.exclude(id__in=first_ids).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0005_card_counts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='leaderboard',
+            name='score',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='leaderboard',
+            name='snapshot_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.RunPython(delete_duplicates, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='leaderboard',
+            unique_together={('user', 'category')},
+        ),
+        migrations.AddIndex(
+            model_name='leaderboard',
+            index=models.Index(fields=['category', 'rank'], name='app_leaderb_categor_36c794_idx'),
+        ),
+    ]
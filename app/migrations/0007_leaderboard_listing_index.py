@@ -0,0 +1,17 @@
+# Generated by Django 4.2.6 on 2026-10-18 16:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0006_leaderboard_snapshot'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='leaderboard',
+            index=models.Index(fields=['category', '-score', 'user'], name='app_leaderb_categor_6d8944_idx'),
+        ),
+    ]
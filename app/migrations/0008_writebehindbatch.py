@@ -0,0 +1,21 @@
+# Generated by Django 4.2.6 on 2026-10-18 16:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0007_leaderboard_listing_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WriteBehindBatch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('batch_id', models.CharField(max_length=100, unique=True)),
+                ('flushed_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 4.2.6 on 2026-10-18 16:16
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0008_writebehindbatch'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserGameState',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='game_state', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('xp', models.PositiveIntegerField(default=0)),
+                ('read_cards', models.PositiveIntegerField(default=0)),
+                ('lives', models.PositiveIntegerField(default=15)),
+                ('last_life_lost_time', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
@@ -0,0 +1,43 @@
+from django.db import migrations
+
+COLUMNS = ('xp', 'read_cards', 'lives', 'last_life_lost_time')
+
+
+def copy_counters(apps, schema_editor):
+    # Runs while CustomUser still has the counter columns; 0004 drops them afterwards.
+    quote = schema_editor.quote_name
+    users = apps.get_model('app', 'CustomUser')._meta.db_table
+    states = apps.get_model('app', 'UserGameState')._meta.db_table
+    columns = ', '.join(quote(column) for column in COLUMNS)
+    schema_editor.execute(
+        f'INSERT INTO {quote(states)} ({quote("user_id")}, {columns}) '
+        f'SELECT u.{quote("id")}, {", ".join("u." + quote(column) for column in COLUMNS)} '
+        f'FROM {quote(users)} u WHERE NOT EXISTS '
+        f'(SELECT 1 FROM {quote(states)} s WHERE s.{quote("user_id")} = u.{quote("id")})'
+    )
+
+
+def copy_counters_back(apps, schema_editor):
+    quote = schema_editor.quote_name
+    users = apps.get_model('app', 'CustomUser')._meta.db_table
+    states = apps.get_model('app', 'UserGameState')._meta.db_table
+    assignments = ', '.join(
+        f'{quote(column)} = (SELECT s.{quote(column)} FROM {quote(states)} s '
+        f'WHERE s.{quote("user_id")} = {quote(users)}.{quote("id")})'
+        for column in COLUMNS
+    )
+    schema_editor.execute(
+        f'UPDATE {quote(users)} SET {assignments} WHERE EXISTS '
+        f'(SELECT 1 FROM {quote(states)} s WHERE s.{quote("user_id")} = {quote(users)}.{quote("id")})'
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0009_usergamestate'),
+    ]
+
+    operations = [
+        migrations.RunPython(copy_counters, copy_counters_back),
+    ]
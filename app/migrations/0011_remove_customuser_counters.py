@@ -0,0 +1,27 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0010_copy_game_state'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='customuser',
+            name='last_life_lost_time',
+        ),
+        migrations.RemoveField(
+            model_name='customuser',
+            name='lives',
+        ),
+        migrations.RemoveField(
+            model_name='customuser',
+            name='read_cards',
+        ),
+        migrations.RemoveField(
+            model_name='customuser',
+            name='xp',
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 4.2.6 on 2026-10-18 16:40
+
+from django.db import migrations, models
+from django.db.models import Count, Min, Sum
+
+
+def merge_duplicates(apps, schema_editor):
+    # Sign-up and the first counted answer could both create a user's row; fold the
+    # counters of every extra row into the first one before the constraint.
+    UserQuizStatistics = apps.get_model('app', 'UserQuizStatistics')
+    duplicates = (
+        UserQuizStatistics.objects.values('user_id')
+        .annotate(
+            rows=Count('id'), first_id=Min('id'), total=Sum('total_attempts'), correct=Sum('correct_attempts'),
+            incorrect=Sum('incorrect_attempts')
+        )
+        .filter(rows__gt=1)
+    )
+    for row in duplicates:
+        UserQuizStatistics.objects.filter(id=row['first_id']).update(
+            total_attempts=row['total'], correct_attempts=row['correct'], incorrect_attempts=row['incorrect']
+        )
+        UserQuizStatistics.objects.filter(user_id=row['user_id']).exclude(id=row['first_id']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0011_remove_customuser_counters'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicates, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='userquizstatistics',
+            constraint=models.UniqueConstraint(fields=('user',), name='unique_user_quiz_statistics'),
+        ),
+    ]
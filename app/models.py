@@ -6,13 +6,29 @@ from django.utils import timezone
 from BrainBites import settings
 
 
+def save_without_card_counts(instance, kwargs):
+    # The card counters are maintained with F() updates by app.catalog; saving an
+    # existing row must not write back the possibly stale copy held in memory.
+    if not instance._state.adding and kwargs.get('update_fields') is None:
+        kwargs['update_fields'] = [
+            field.name for field in instance._meta.concrete_fields
+            if not field.primary_key and field.name not in ('card_count', 'active_card_count')
+        ]
+
+
 class Topic(models.Model):
     title = models.CharField(max_length=255)
     image = models.URLField(blank=True, null=True)
+    card_count = models.PositiveIntegerField(default=0)
+    active_card_count = models.PositiveIntegerField(default=0)  # Cards whose subtitle exists
 
     def __str__(self):
         return f"{self.title}"
 
+    def save(self, *args, **kwargs):
+        save_without_card_counts(self, kwargs)
+        super().save(*args, **kwargs)
+
 
 class Subtitle(models.Model):
     title = models.CharField(max_length=255)
@@ -21,23 +37,70 @@ class Subtitle(models.Model):
     image = models.URLField(blank=True, null=True)
     cost = models.PositiveIntegerField(default=200)
     exist = models.BooleanField(default=True)
+    card_count = models.PositiveIntegerField(default=0)
+    active_card_count = models.PositiveIntegerField(default=0)  # card_count while exist is set, otherwise 0
+
+    def save(self, *args, **kwargs):
+        save_without_card_counts(self, kwargs)
+        super().save(*args, **kwargs)
+
+
+def game_state_field(name):
+    # Lets CustomUser(xp=...), user.xp and user.lives keep working after the split.
+    def get(self):
+        return getattr(self.state, name)
+
+    def set(self, value):
+        setattr(self.state, name, value)
+
+    return property(get, set)
 
 
 class CustomUser(AbstractUser):
     username = models.CharField(max_length=150, unique=True)
     email = models.EmailField(max_length=254, unique=True, blank=False, null=False)
-    xp = models.PositiveIntegerField(default=0)
     saved_cards = models.ManyToManyField('Card', blank=True, related_name='users_saved')
-    read_cards = models.PositiveIntegerField(default=0)
     topics = models.ManyToManyField('Topic', blank=True, related_name='users_interested')
     groups = models.ManyToManyField(Group, related_name="customuser_groups", blank=True)
     user_permissions = models.ManyToManyField(Permission, related_name="customuser_user_permissions", blank=True)
     everyday_cards = models.PositiveIntegerField(default=10)
     purchased_subtitles = models.ManyToManyField(Subtitle, through='UserSubtitle', related_name='purchasers')
     avatar_url = models.URLField(max_length=200, blank=True)
+
+    xp = game_state_field('xp')
+    read_cards = game_state_field('read_cards')
+    lives = game_state_field('lives')
+    last_life_lost_time = game_state_field('last_life_lost_time')
+
+    @property
+    def state(self):
+        """
+        The user's UserGameState; a new unsaved one before the user is first saved (see
+        signals.create_game_state). A user saved without the signal (bulk_create, raw SQL)
+        gets its row on first use.
+        """
+        try:
+            return self.game_state
+        except UserGameState.DoesNotExist:
+            if self._state.adding:
+                self.game_state = UserGameState(user=self)
+            else:
+                self.game_state, _ = UserGameState.objects.get_or_create(user=self)
+            return self.game_state
+
+
+class UserGameState(models.Model):
+    # The counters that change on nearly every request, kept out of the wide auth row.
+    # Save them with update_fields or F() expressions on this table only.
+    user = models.OneToOneField(CustomUser, on_delete=models.CASCADE, primary_key=True, related_name='game_state')
+    xp = models.PositiveIntegerField(default=0)
+    read_cards = models.PositiveIntegerField(default=0)
     lives = models.PositiveIntegerField(default=15)
     last_life_lost_time = models.DateTimeField(default=timezone.now)
 
+    def __str__(self):
+        return f"{self.user_id}: {self.xp} XP, {self.lives} lives"
+
 
 class Card(models.Model):
     topic = models.ForeignKey(Topic, on_delete=models.CASCADE, related_name='cards')
@@ -48,6 +111,12 @@ class Card(models.Model):
     read_count = models.PositiveIntegerField(default=0)  # Tracks how many times the card has been read
     image = models.URLField(blank=True, null=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['topic', 'id']),
+            models.Index(fields=['subtitle', 'id']),
+        ]
+
     def __str__(self):
         return f"{self.title} {self.topic.title}"
 
@@ -79,6 +148,9 @@ class UserQuizStatistics(models.Model):
     correct_attempts = models.PositiveIntegerField(default=0)
     incorrect_attempts = models.PositiveIntegerField(default=0)
 
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['user'], name='unique_user_quiz_statistics')]
+
 
 class Badge(models.Model):
     name = models.CharField(max_length=255)
@@ -92,6 +164,13 @@ class EarnedBadge(models.Model):
     user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='earned_badges')
     badge = models.ForeignKey(Badge, on_delete=models.CASCADE, related_name='earned_by')
     date_earned = models.DateTimeField(auto_now_add=True)
+    notified = models.BooleanField(default=True)  # False until CheckUserAchievementsView has reported it
+
+    class Meta:
+        unique_together = ('user', 'badge')
+        indexes = [
+            models.Index(fields=['user', 'notified']),
+        ]
 
 
 class UserBadgeProgress(models.Model):
@@ -100,6 +179,9 @@ class UserBadgeProgress(models.Model):
     progress_number = models.PositiveIntegerField(default=0)
     progress = models.JSONField(default=dict)
 
+    class Meta:
+        unique_together = ('user', 'badge')
+
     def __str__(self):
         return f"{self.user}'s progress on {self.badge}"
 
@@ -113,6 +195,15 @@ class Leaderboard(models.Model):
     user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='leaderboard_entries')
     category = models.CharField(max_length=10, choices=CATEGORY_CHOICES)
     rank = models.PositiveIntegerField()
+    score = models.PositiveIntegerField(default=0)
+    snapshot_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        unique_together = ('user', 'category')
+        indexes = [
+            models.Index(fields=['category', 'rank']),
+            models.Index(fields=['category', '-score', 'user']),
+        ]
 
 
 class UserSubtitle(models.Model):
@@ -124,6 +215,21 @@ class UserSubtitle(models.Model):
         return f"{self.user.username} purchased {self.subtitle.title} for {self.cost_in_xp} XP"
 
 
+class UserSubtitleProgress(models.Model):
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='subtitle_progress')
+    subtitle = models.ForeignKey(Subtitle, on_delete=models.CASCADE, related_name='user_progress')
+    topic = models.ForeignKey(Topic, on_delete=models.CASCADE, related_name='user_subtitle_progress')
+    viewed_count = models.PositiveIntegerField(default=0)
+    passed_count = models.PositiveIntegerField(default=0)
+    completed = models.BooleanField(default=False)
+
+    class Meta:
+        unique_together = ('user', 'subtitle')
+        indexes = [
+            models.Index(fields=['user', 'topic']),
+        ]
+
+
 class UserStreak(models.Model):
     user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='streaks')
     current_streak = models.PositiveIntegerField(default=0)
@@ -182,3 +288,10 @@ class CorrectStreak(models.Model):
             self.max_streak = self.streak_count
 
         self.save()
+
+
+class WriteBehindBatch(models.Model):
+    # One row per buffered counter batch applied to Postgres; a flush that crashed after its
+    # commit finds its batch here and drops the Redis copy instead of applying it twice.
+    batch_id = models.CharField(max_length=100, unique=True)
+    flushed_at = models.DateTimeField(auto_now_add=True)
@@ -0,0 +1,135 @@
+import json
+import logging
+from collections import defaultdict
+
+import redis
+from django.conf import settings
+from django.db import transaction
+from django.http import HttpResponse
+
+from app.models import Card, Quiz
+from app.redis_client import get_redis, pipeline
+from app.serializers import CardSerializer, QuizSerializer
+
+logger = logging.getLogger(__name__)
+
+# Cards and quizzes do not change once parse_cards has inserted them, so their API payloads
+# are kept in Redis as JSON bytes, one entry per card, and a page of them is a single MGET.
+# Misses are serialized from one select_related query. The signals drop a card's entries
+# when it, its topic or one of its quizzes is saved or deleted, admin edits included.
+
+
+def card_key(card_id):
+    return f"card_{card_id}_payload"
+
+
+def quizzes_key(card_id):
+    return f"card_{card_id}_quizzes"
+
+
+def _encode(data):
+    # Same bytes as DRF's JSONRenderer.
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode()
+
+
+def _build_cards(card_ids):
+    cards = Card.objects.filter(id__in=card_ids).select_related('topic', 'subtitle')
+    return {card['id']: _encode(card) for card in CardSerializer(cards, many=True).data}
+
+
+def _build_quizzes(card_ids):
+    # Cards without quizzes are stored as an empty list too, so they are not queried again.
+    grouped = defaultdict(list)
+    for quiz in QuizSerializer(Quiz.objects.filter(card_id__in=card_ids).order_by('id'), many=True).data:
+        grouped[quiz['card']].append(quiz)
+    return {card_id: _encode(grouped[card_id]) for card_id in card_ids}
+
+
+KINDS = {
+    'card': (card_key, _build_cards),
+    'quizzes': (quizzes_key, _build_quizzes),
+}
+
+
+def _get_many(card_ids, kinds):
+    card_ids = list(dict.fromkeys(card_ids))
+    keys = [(kind, card_id) for kind in kinds for card_id in card_ids]
+    try:
+        cached = get_redis(binary=True).mget([KINDS[kind][0](card_id) for kind, card_id in keys])
+    except redis.RedisError:
+        logger.exception('Failed to read cached card payloads')
+        cached = None
+
+    found = {kind: {} for kind in kinds}
+    for (kind, card_id), payload in zip(keys, cached or ()):
+        if payload is not None:
+            found[kind][card_id] = payload
+
+    built = {}
+    for kind in kinds:
+        key, build = KINDS[kind]
+        missing = [card_id for card_id in card_ids if card_id not in found[kind]]
+        if missing:
+            payloads = build(missing)
+            found[kind].update(payloads)
+            built.update((key(card_id), payload) for card_id, payload in payloads.items())
+
+    if built and cached is not None:
+        try:
+            with pipeline(transaction=False, binary=True) as pipe:
+                for key, payload in built.items():
+                    pipe.set(key, payload, ex=settings.CARD_PAYLOAD_TTL)
+        except redis.RedisError:
+            logger.exception('Failed to cache card payloads')
+    return [found[kind] for kind in kinds]
+
+
+def cards(card_ids):
+    """{card id: CardSerializer JSON bytes} of the cards that exist."""
+    return _get_many(card_ids, ('card',))[0]
+
+
+def quizzes(card_ids):
+    """{card id: JSON bytes of the card's quizzes as QuizSerializer lists}."""
+    return _get_many(card_ids, ('quizzes',))[0]
+
+
+def cards_and_quizzes(card_ids):
+    """Both of the above from one MGET."""
+    return _get_many(card_ids, ('card', 'quizzes'))
+
+
+def card_list_response(card_ids, include_quizzes=False):
+    """The cards as a JSON array in the order of card_ids, each with its quizzes if asked."""
+    if not include_quizzes:
+        found = cards(card_ids)
+        items = [found[card_id] for card_id in card_ids if card_id in found]
+    else:
+        found, found_quizzes = cards_and_quizzes(card_ids)
+        # A card payload is a JSON object, so the quizzes go in before its closing brace.
+        items = [found[card_id][:-1] + b',"quizzes":' + found_quizzes[card_id] + b'}'
+                 for card_id in card_ids if card_id in found]
+    return HttpResponse(b'[' + b','.join(items) + b']', content_type='application/json')
+
+
+def quiz_list_response(card_ids):
+    """The quizzes of the cards as one JSON array, grouped by card in the order of card_ids."""
+    found = quizzes(card_ids)
+    items = [found[card_id][1:-1] for card_id in dict.fromkeys(card_ids) if found[card_id] != b'[]']
+    return HttpResponse(b'[' + b','.join(items) + b']', content_type='application/json')
+
+
+def _delete(card_ids):
+    keys = [key(card_id) for card_id in card_ids for key, _ in KINDS.values()]
+    try:
+        for start in range(0, len(keys), 1000):
+            get_redis(binary=True).delete(*keys[start:start + 1000])
+    except redis.RedisError:
+        logger.exception('Failed to invalidate card payloads')
+
+
+def invalidate(*card_ids):
+    # After the commit, so the next miss reads the new rows.
+    card_ids = [card_id for card_id in card_ids if card_id is not None]
+    if card_ids:
+        transaction.on_commit(lambda: _delete(card_ids))
@@ -0,0 +1,138 @@
+import logging
+from datetime import datetime
+
+import redis
+from django.conf import settings
+from django.contrib.postgres.expressions import ArraySubquery
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce, JSONObject
+
+from app.models import CustomUser, EarnedBadge, Topic, UserGameState
+from app import lives, single_flight, write_behind
+from app.redis_client import get_redis
+from app.serializers import UserStatsSerializer
+
+logger = logging.getLogger(__name__)
+
+STATS_KEY = 'profile_cache_stats'
+
+# CustomUser columns shown in the profile; saves that touch none of them keep the cached copy.
+# Every UserGameState save invalidates it.
+PROFILE_FIELDS = {'username', 'avatar_url'}
+
+
+def version_key(user_id):
+    return f"user_{user_id}_profile_version"
+
+
+def snapshot_key(user_id, version):
+    return f"user_{user_id}_profile_v{version}"
+
+
+def _count(rows, field):
+    return Coalesce(
+        Subquery(rows.filter(**{field: OuterRef('pk')}).order_by().values(field).annotate(n=Count('id')).values('n')),
+        0
+    )
+
+
+def build(user_id):
+    """Profile data for GetUserStatsView in a single query, or None if the user does not exist."""
+    topics = Topic.objects.filter(users_interested=OuterRef('pk')).order_by('id') \
+        .values(json=JSONObject(id='id', title='title'))
+    user = CustomUser.objects.filter(id=user_id).annotate(
+        saved_cards_count=_count(CustomUser.saved_cards.through.objects.all(), 'customuser_id'),
+        earned_badges_count=_count(EarnedBadge.objects.all(), 'user_id'),
+        topic_list=ArraySubquery(topics),
+    ).values(
+        'username', 'avatar_url', 'saved_cards_count', 'earned_badges_count', 'topic_list',
+        xp=F('game_state__xp'), read_cards=F('game_state__read_cards'), lives=F('game_state__lives'),
+        last_life_lost_time=F('game_state__last_life_lost_time'),
+    ).first()
+    if user is None:
+        return None
+    if user['xp'] is None:
+        # No UserGameState row yet, see CustomUser.state.
+        state, _ = UserGameState.objects.get_or_create(user_id=user_id)
+        user.update(xp=state.xp, read_cards=state.read_cards, lives=state.lives,
+                    last_life_lost_time=state.last_life_lost_time)
+
+    data = UserStatsSerializer({
+        'username': user['username'],
+        'xp': user['xp'],
+        'avatar_url': user['avatar_url'],
+        'saved_cards_count': user['saved_cards_count'],
+        'read_cards_count': user['read_cards'],
+        'earned_badges_count': user['earned_badges_count'],
+        'lives': user['lives'],
+        'topics': user['topic_list'],
+    }).data
+    # Lives regenerate over time, so the cached copy keeps what they are derived from.
+    data['last_life_lost_time'] = user['last_life_lost_time'].isoformat()
+    return data
+
+
+def get(user_id):
+    """
+    Cached profile of a user, with lives regenerated up to now and the XP and read
+    cards still buffered by write-behind added.
+    """
+    data = _get(user_id)
+    if data is None:
+        return None
+    since = data.pop('last_life_lost_time', None)
+    stored = lives.stored(user_id, data['lives'], since and datetime.fromisoformat(since))
+    data['lives'] = lives.regenerate(*stored)[0]
+    if write_behind.enabled():
+        pending = write_behind.pending(write_behind.USER, (user_id,))
+        data['xp'] += pending['xp']
+        data['read_cards_count'] += pending['read_cards']
+    return data
+
+
+def _get(user_id):
+    # Snapshots are stored under the user's current version, so invalidating is a
+    # single INCR and stale copies simply expire. Concurrent misses share one build.
+    try:
+        r = get_redis()
+        version = r.get(version_key(user_id)) or 0
+    except redis.RedisError:
+        logger.exception('Failed to read the profile cache for user %s', user_id)
+        return build(user_id)
+
+    missed = False
+
+    def build_missing():
+        nonlocal missed
+        missed = True
+        return build(user_id)
+
+    data = single_flight.get('profile', snapshot_key(user_id, version), build_missing, settings.PROFILE_CACHE_TTL)
+    try:
+        r.hincrby(STATS_KEY, 'misses' if missed else 'hits')
+    except redis.RedisError:
+        logger.exception('Failed to count a profile cache lookup')
+    return data
+
+
+def _bump(user_id):
+    try:
+        get_redis().incr(version_key(user_id))
+    except redis.RedisError:
+        logger.exception('Failed to invalidate the profile cache for user %s', user_id)
+
+
+def invalidate(user_id):
+    # Wait for the commit, otherwise a concurrent read could cache the old row under the new version.
+    transaction.on_commit(lambda: _bump(user_id))
+
+
+def cache_stats():
+    """(hits, misses) counted by get() since the counters were last reset."""
+    stats = get_redis().hgetall(STATS_KEY)
+    return int(stats.get('hits', 0)), int(stats.get('misses', 0))
+
+
+def reset_cache_stats():
+    get_redis().delete(STATS_KEY)
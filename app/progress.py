@@ -0,0 +1,116 @@
+from collections import Counter
+
+from django.db import transaction
+from django.db.models import F, Q, Count
+from django.db.models.functions import Greatest
+from django.dispatch import receiver
+
+from app import events
+from app.models import Card, Subtitle, UserSubtitleProgress, ViewedCard
+
+
+def cards_per_subtitle(card_ids):
+    per_subtitle, topic_of = Counter(), {}
+    for subtitle_id, topic_id in Card.objects.filter(
+        id__in=card_ids, subtitle__isnull=False
+    ).values_list('subtitle_id', 'subtitle__topic_id'):
+        per_subtitle[subtitle_id] += 1
+        topic_of[subtitle_id] = topic_id
+    return per_subtitle, topic_of
+
+
+def subtitle_totals(subtitle_ids):
+    return dict(Subtitle.objects.filter(id__in=subtitle_ids).values_list('id', 'card_count'))
+
+
+def completed_topics(user_id, topic_ids):
+    # A topic is complete once the user has viewed at least one card in each of its subtitles.
+    subtitles = Subtitle.objects.filter(topic_id__in=topic_ids).values('topic_id').annotate(total=Count('id'))
+    touched = dict(
+        UserSubtitleProgress.objects.filter(user_id=user_id, topic_id__in=topic_ids, viewed_count__gt=0)
+        .values('topic_id').annotate(total=Count('id')).values_list('topic_id', 'total')
+    )
+    return [row['topic_id'] for row in subtitles if touched.get(row['topic_id'], 0) >= row['total']]
+
+
+@receiver(events.cards_viewed)
+def record_viewed(sender, user_id, card_ids, **kwargs):
+    per_subtitle, topic_of = cards_per_subtitle(card_ids)
+    if not per_subtitle:
+        return
+    totals = subtitle_totals(per_subtitle)
+
+    with transaction.atomic():
+        UserSubtitleProgress.objects.bulk_create(
+            [
+                UserSubtitleProgress(user_id=user_id, subtitle_id=subtitle_id, topic_id=topic_of[subtitle_id])
+                for subtitle_id in per_subtitle
+            ],
+            ignore_conflicts=True
+        )
+        rows = list(
+            UserSubtitleProgress.objects.select_for_update()
+            .filter(user_id=user_id, subtitle_id__in=per_subtitle)
+        )
+
+        completed_subtitle_ids, touched_topic_ids = [], set()
+        for row in rows:
+            if row.viewed_count == 0:
+                touched_topic_ids.add(row.topic_id)
+            row.viewed_count += per_subtitle[row.subtitle_id]
+            if not row.completed and row.viewed_count >= totals.get(row.subtitle_id, 0):
+                row.completed = True
+                completed_subtitle_ids.append(row.subtitle_id)
+        UserSubtitleProgress.objects.bulk_update(rows, ['viewed_count', 'completed'])
+
+        completed_topic_ids = completed_topics(user_id, touched_topic_ids) if touched_topic_ids else []
+
+    if completed_subtitle_ids:
+        events.subtitles_completed.send(sender=ViewedCard, user_id=user_id, subtitle_ids=completed_subtitle_ids)
+    if completed_topic_ids:
+        events.topics_completed.send(sender=ViewedCard, user_id=user_id, topic_ids=completed_topic_ids)
+
+
+@receiver(events.cards_passed)
+def record_passed(sender, user_id, card_ids, passed, **kwargs):
+    per_subtitle, _ = cards_per_subtitle(card_ids)
+    sign = 1 if passed else -1
+
+    subtitles_by_delta = {}
+    for subtitle_id, count in per_subtitle.items():
+        subtitles_by_delta.setdefault(sign * count, []).append(subtitle_id)
+    for delta, subtitle_ids in subtitles_by_delta.items():
+        UserSubtitleProgress.objects.filter(user_id=user_id, subtitle_id__in=subtitle_ids).update(
+            passed_count=Greatest(F('passed_count') + delta, 0)
+        )
+
+
+def rebuild(user_id):
+    """Recompute a user's UserSubtitleProgress rows from ViewedCard."""
+    rows = list(
+        ViewedCard.objects.filter(user_id=user_id, card__subtitle__isnull=False)
+        .values('card__subtitle_id', 'card__subtitle__topic_id')
+        .annotate(viewed=Count('id'), passed=Count('id', filter=Q(test_passed=True)))
+    )
+    totals = subtitle_totals([row['card__subtitle_id'] for row in rows])
+
+    with transaction.atomic():
+        UserSubtitleProgress.objects.filter(user_id=user_id).exclude(
+            subtitle_id__in=[row['card__subtitle_id'] for row in rows]
+        ).delete()
+        UserSubtitleProgress.objects.bulk_create(
+            [
+                UserSubtitleProgress(
+                    user_id=user_id,
+                    subtitle_id=row['card__subtitle_id'],
+                    topic_id=row['card__subtitle__topic_id'],
+                    viewed_count=row['viewed'],
+                    passed_count=row['passed'],
+                    completed=row['viewed'] >= totals.get(row['card__subtitle_id'], 0),
+                )
+                for row in rows
+            ],
+            update_conflicts=True,
+            unique_fields=['user', 'subtitle'],
+            update_fields=['topic', 'viewed_count', 'passed_count', 'completed']
+        )
@@ -0,0 +1,79 @@
+import os
+from contextlib import contextmanager
+
+import redis
+
+# One connection pool per process and per response mode, shared by the views, the
+# Celery tasks and the caches. redis-py resets a pool it finds in a forked child.
+_pools = {}
+_clients = {}
+_scripts = {}
+_bound_scripts = {}
+
+
+def _pool(binary):
+    if binary not in _pools:
+        _pools[binary] = redis.ConnectionPool(
+            host=os.environ.get('REDIS_HOST'),
+            port=os.environ.get('REDIS_PORT') or 6379,
+            password=os.environ.get('REDIS_PASSWORD'),
+            db=os.environ.get('REDIS_DB') or 0,
+            max_connections=int(os.environ.get('REDIS_MAX_CONNECTIONS', 50)),
+            decode_responses=not binary
+        )
+    return _pools[binary]
+
+
+def get_redis(binary=False):
+    # Bitmaps and other raw payloads need a client that does not decode responses.
+    if binary not in _clients:
+        _clients[binary] = redis.Redis(connection_pool=_pool(binary))
+    return _clients[binary]
+
+
+@contextmanager
+def pipeline(transaction=True, binary=False):
+    """Queue commands and send them in one round trip when the block exits."""
+    with get_redis(binary).pipeline(transaction=transaction) as pipe:
+        yield pipe
+        pipe.execute()
+
+
+def register_script(name, source):
+    """Register a Lua script once at import time; run it later with script(name)(keys=..., args=...)."""
+    _scripts[name] = source
+
+
+def script(name, binary=False):
+    # redis-py's Script runs EVALSHA and reloads the source if the server lost it.
+    if (name, binary) not in _bound_scripts:
+        _bound_scripts[(name, binary)] = get_redis(binary).register_script(_scripts[name])
+    return _bound_scripts[(name, binary)]
+
+
+def pool_stats():
+    """Connection usage of each pool created in this process."""
+    stats = {}
+    for binary, pool in _pools.items():
+        stats['binary' if binary else 'text'] = {
+            'created': pool._created_connections,
+            'in_use': len(pool._in_use_connections),
+            'idle': len(pool._available_connections),
+            'max': pool.max_connections,
+        }
+    return stats
+
+
+def use_clients(text_client, binary_client=None):
+    """Point the module at other clients, e.g. fakeredis in tests."""
+    reset()
+    _clients[False] = text_client
+    _clients[True] = binary_client or text_client
+
+
+def reset():
+    _clients.clear()
+    _bound_scripts.clear()
+    for pool in _pools.values():
+        pool.disconnect()
+    _pools.clear()
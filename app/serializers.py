@@ -1,6 +1,7 @@
 from rest_framework import serializers
 from .models import Topic, CustomUser, Card, Subtitle, Quiz, EarnedBadge, Badge, UserStreak, DailyReadCards, \
     CorrectStreak, UserQuizStatistics
+from app import write_behind
 
 
 class TopicSerializer(serializers.ModelSerializer):
@@ -19,11 +20,29 @@ class UserSerializer(serializers.ModelSerializer):
     saved_cards = serializers.PrimaryKeyRelatedField(many=True, read_only=True)
     topics = TopicSerializer(many=True, read_only=True)
     badges_count = serializers.IntegerField(read_only=True, required=False)
+    # Stored on UserGameState; select_related('game_state') when serializing many users.
+    xp = serializers.IntegerField(read_only=True)
+    read_cards = serializers.IntegerField(read_only=True)
+    lives = serializers.SerializerMethodField()
+    last_life_lost_time = serializers.DateTimeField(read_only=True)
 
     class Meta:
         model = CustomUser
         fields = '__all__'
 
+    def to_representation(self, instance):
+        # The stored counters plus what write-behind still buffers; pass an unmerged user.
+        data = super().to_representation(instance)
+        for field, delta in write_behind.pending(write_behind.USER, (instance.id,)).items():
+            data[field] += delta
+        return data
+
+    def get_lives(self, instance):
+        # With regeneration and the Redis economy the stored column is not the count.
+        # Imported here: lives -> economy -> profiles imports this module.
+        from app import lives
+        return lives.current(instance)
+
 
 class BadgeSerializer(serializers.ModelSerializer):
     class Meta:
@@ -0,0 +1,410 @@
+import logging
+
+import redis
+from django.db import connection, transaction, IntegrityError
+from django.db.models import F
+from django.utils import timezone
+
+from app import badges, card_bitmaps, economy, events, leaderboard, lives, profiles, write_behind
+from app.models import Card, CustomUser, UserGameState, UserSubtitle, ViewedCard, UserQuizStatistics, DailyReadCards, \
+    UserStreak, CorrectStreak
+
+logger = logging.getLogger(__name__)
+
+
+class ServiceError(Exception):
+    """The change cannot be applied to the user's current state; the message is meant for the client."""
+
+
+class ServiceUnavailable(Exception):
+    """The change cannot be applied right now; the client may retry. The message is meant for the client."""
+
+
+def increment(model, lookup, **deltas):
+    """
+    Add `deltas` to the counters of the row matching `lookup`, creating the row on first
+    use. Once the row exists this is a single UPDATE with F() expressions.
+    """
+    if model.objects.filter(**lookup).update(**{field: F(field) + delta for field, delta in deltas.items()}):
+        return
+    try:
+        with transaction.atomic():
+            model.objects.create(**lookup, **deltas)
+    except IntegrityError:
+        # Created concurrently between the UPDATE and the INSERT.
+        model.objects.filter(**lookup).update(**{field: F(field) + delta for field, delta in deltas.items()})
+
+
+def record_viewed(user_id, card_ids):
+    """Mark served cards as viewed; only those not viewed before count towards progress."""
+    with transaction.atomic():
+        already_viewed = set(
+            ViewedCard.objects.select_for_update()
+            .filter(user_id=user_id, card_id__in=card_ids)
+            .values_list('card_id', flat=True)
+        )
+        ViewedCard.objects.bulk_create(
+            [ViewedCard(user_id=user_id, card_id=card_id) for card_id in card_ids],
+            ignore_conflicts=True
+        )
+
+    created_ids = [card_id for card_id in card_ids if card_id not in already_viewed]
+    card_bitmaps.record_viewed(user_id, created_ids)
+    events.cards_viewed.send(sender=ViewedCard, user_id=user_id, card_ids=created_ids)
+
+
+def record_quiz_answers(user_id, card_ids, correct_answer_ids):
+    """
+    Mark the answered cards as viewed and count the answers in the quiz and daily stats.
+
+    New cards are stored as passed when answered correctly. A wrong answer resets an
+    already viewed card to not passed, while a right one leaves it as it was.
+    """
+    correct_answer_ids = set(correct_answer_ids)
+    correct_answers_count = sum(1 for card_id in card_ids if card_id in correct_answer_ids)
+    unique_ids = list(dict.fromkeys(card_ids))
+
+    with transaction.atomic():
+        previously_passed = dict(
+            ViewedCard.objects.select_for_update()
+            .filter(user_id=user_id, card_id__in=unique_ids)
+            .values_list('card_id', 'test_passed')
+        )
+        ViewedCard.objects.bulk_create(
+            [
+                ViewedCard(user_id=user_id, card_id=card_id, test_passed=True, correct=True)
+                for card_id in unique_ids if card_id in correct_answer_ids
+            ],
+            ignore_conflicts=True
+        )
+        ViewedCard.objects.bulk_create(
+            [
+                ViewedCard(user_id=user_id, card_id=card_id, test_passed=False, correct=False)
+                for card_id in unique_ids if card_id not in correct_answer_ids
+            ],
+            update_conflicts=True,
+            unique_fields=['user', 'card'],
+            update_fields=['test_passed', 'correct']
+        )
+        stats = {
+            'total_attempts': len(card_ids),
+            'correct_attempts': correct_answers_count,
+            'incorrect_attempts': len(card_ids) - correct_answers_count,
+        }
+        today = timezone.now().date()
+        if write_behind.enabled():
+            write_behind.incr_on_commit(write_behind.QUIZ_STATS, (user_id,), **stats)
+            write_behind.incr_on_commit(write_behind.DAILY_READS, (user_id, today), cards_read=len(card_ids))
+        else:
+            increment(UserQuizStatistics, {'user_id': user_id}, **stats)
+            increment(DailyReadCards, {'user_id': user_id, 'date': today}, cards_read=len(card_ids))
+
+    created_ids = [card_id for card_id in unique_ids if card_id not in previously_passed]
+    passed_ids = [card_id for card_id in created_ids if card_id in correct_answer_ids]
+    unpassed_ids = [
+        card_id for card_id, test_passed in previously_passed.items()
+        if test_passed and card_id not in correct_answer_ids
+    ]
+
+    transaction.on_commit(lambda: card_bitmaps.record_viewed(user_id, created_ids, passed_ids, unpassed_ids))
+    events.cards_viewed.send(sender=ViewedCard, user_id=user_id, card_ids=created_ids)
+    events.cards_passed.send(sender=ViewedCard, user_id=user_id, card_ids=passed_ids, passed=True)
+    events.cards_passed.send(sender=ViewedCard, user_id=user_id, card_ids=unpassed_ids, passed=False)
+    events.correct_answers_recorded.send(sender=UserQuizStatistics, user_id=user_id, count=correct_answers_count)
+
+
+def locked_user(user_id):
+    """
+    CustomUser locked with select_for_update, with its buffered counters merged in, or
+    None. Counter changes on it go through add_xp/set_read_cards, never a plain save().
+    """
+    # Only the narrow UserGameState row is locked; the counters are read from it.
+    state = UserGameState.objects.select_for_update(of=('self',)).select_related('user') \
+        .filter(user_id=user_id).first()
+    if state is None:
+        return None
+    if write_behind.enabled():
+        write_behind.merge(write_behind.USER, state)
+    return state.user
+
+
+# The functions below take a user from locked_user(), so a batch of events can share
+# one lock and one load of the row.
+
+def _change_counter(user, field, category, delta):
+    setattr(user, field, getattr(user, field) + delta)
+    if not write_behind.enabled():
+        user.state.save(update_fields=[field])
+        return
+    if field == 'xp' and economy.enabled():
+        economy.credit_on_commit(user.id, delta)
+    else:
+        write_behind.incr_on_commit(write_behind.USER, (user.id,), **{field: delta})
+    score = getattr(user, field)
+    transaction.on_commit(lambda: leaderboard.record(user.id, **{category: score}))
+
+
+def add_xp(user, amount):
+    _change_counter(user, 'xp', leaderboard.XP, amount)
+
+
+def set_read_cards(user, count):
+    _change_counter(user, 'read_cards', leaderboard.CARDS, count - user.read_cards)
+
+
+def add_answer_xp(user, correct_answers_count):
+    add_xp(user, correct_answers_count * 10)
+
+
+NO_LIVES_LEFT = "No lives left. Please wait for them to regenerate or purchase more lives."
+ECONOMY_UNAVAILABLE = "Purchases are temporarily unavailable. Please try again."
+
+
+def _economy(operation, user_id, *args):
+    # While Redis holds the user's balance it is the only copy that may be changed, so
+    # when Redis fails (or the flush lock is not free in time) the request is refused.
+    try:
+        return operation(user_id, *args)
+    except redis.RedisError:
+        logger.exception('Redis economy unavailable for user %s', user_id)
+        raise ServiceUnavailable(ECONOMY_UNAVAILABLE)
+
+
+def lives_left(user):
+    """Lives of a locked user, less those lost earlier in the transaction that Redis takes on commit."""
+    return lives.current(user) - getattr(user, '_lives_lost_on_commit', 0)
+
+
+def lose_life(user):
+    if economy.enabled():
+        if lives_left(user) <= 0:
+            raise ServiceError(NO_LIVES_LEFT)
+        user._lives_lost_on_commit = getattr(user, '_lives_lost_on_commit', 0) + 1
+        economy.spend_life_on_commit(user.id)
+    elif not lives.spend(user):
+        raise ServiceError(NO_LIVES_LEFT)
+
+
+# Purchases and XP changes for a user id. With REDIS_ECONOMY they are one Lua script
+# each and take no row lock; otherwise XP is taken with a single conditional UPDATE
+# (debit_xp). They return None when the user does not exist.
+
+def debit_xp(user_id, cost):
+    """
+    Take `cost` XP from the user in one statement if the balance covers it, and return
+    what is left, or None when it does not (or there is no such user). The row stays
+    locked until the surrounding transaction ends. XP still buffered by write-behind
+    only counts once flushed, so a balance is never overdrawn.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'UPDATE {UserGameState._meta.db_table} SET xp = xp - %s WHERE user_id = %s AND xp >= %s RETURNING xp',
+            [cost, user_id, cost]
+        )
+        row = cursor.fetchone()
+    if row is None:
+        return None
+
+    # The UPDATE skips the model signals, so do what they would.
+    xp = row[0] + write_behind.pending(write_behind.USER, (user_id,), ['xp'])['xp']
+    transaction.on_commit(lambda: leaderboard.record(user_id, **{leaderboard.XP: xp}))
+    profiles.invalidate(user_id)
+    return xp
+
+
+def spend_life(user_id):
+    """Lives left after taking one."""
+    if economy.enabled():
+        result = _economy(economy.spend_life, user_id)
+        if result is None:
+            return None
+        spent, lives_left = result
+    else:
+        with transaction.atomic():
+            user = locked_user(user_id)
+            if user is None:
+                return None
+            spent, lives_left = lives.spend(user), user.lives
+    if not spent:
+        raise ServiceError(NO_LIVES_LEFT)
+    return lives_left
+
+
+def purchase_lives(user_id, cost, count=1):
+    """(xp, lives) after trading `cost` XP for `count` lives."""
+    if economy.enabled():
+        result = _economy(economy.buy_lives, user_id, cost, count)
+        if result is None:
+            return None
+        bought, xp, lives_now = result
+    else:
+        with transaction.atomic():
+            xp = debit_xp(user_id, cost)
+            bought = xp is not None
+            if bought:
+                # Locked by the debit already.
+                user = CustomUser.objects.select_related('game_state').get(id=user_id)
+                lives.add(user, count)
+                lives_now = user.lives
+            elif not CustomUser.objects.filter(id=user_id).exists():
+                return None
+    if not bought:
+        raise ServiceError("Not enough XP to purchase lives.")
+    return xp, lives_now
+
+
+def purchase_subtitle(user_id, subtitle):
+    """XP left after buying a subtitle; nothing is charged for one bought before."""
+    if economy.enabled():
+        result = _economy(economy.buy_subtitle, user_id, subtitle.id, subtitle.cost)
+        if result is None:
+            return None
+        outcome, xp = result
+    else:
+        with transaction.atomic():
+            xp = debit_xp(user_id, subtitle.cost)
+            # Checked after the debit, which waits for a concurrent purchase by the same user to commit.
+            if UserSubtitle.objects.filter(user_id=user_id, subtitle=subtitle).exists():
+                transaction.set_rollback(True)
+                outcome = economy.ALREADY_OWNED
+            elif xp is None:
+                if not CustomUser.objects.filter(id=user_id).exists():
+                    return None
+                outcome = economy.REFUSED
+            else:
+                UserSubtitle.objects.create(user_id=user_id, subtitle=subtitle, cost_in_xp=subtitle.cost)
+                outcome = economy.DONE
+    if outcome == economy.ALREADY_OWNED:
+        raise ServiceError('Subtitle already purchased.')
+    if outcome == economy.REFUSED:
+        raise ServiceError('Insufficient XP.')
+    return xp
+
+
+def change_xp(user_id, amount):
+    """XP after adding `amount`, which may be negative but not below zero."""
+    if economy.enabled():
+        result = _economy(economy.add_xp, user_id, amount)
+        if result is None:
+            return None
+        applied, xp = result
+    elif amount < 0:
+        with transaction.atomic():
+            xp = debit_xp(user_id, -amount)
+            applied = xp is not None
+            if not applied and not CustomUser.objects.filter(id=user_id).exists():
+                return None
+    else:
+        with transaction.atomic():
+            user = locked_user(user_id)
+            if user is None:
+                return None
+            add_xp(user, amount)
+            applied, xp = True, user.xp
+    if not applied:
+        raise ServiceError('Not enough XP.')
+    return xp
+
+
+def update_streak(user_id):
+    """Returns the UserStreak and whether the streak had been broken."""
+    # Sign-up does not create the row; the first update does.
+    user_streak, _ = UserStreak.objects.select_for_update().get_or_create(user_id=user_id)
+    streak_broken = user_streak.update_streak()
+    return user_streak, streak_broken
+
+
+def update_quiz_streak(user_id, streak_count_current, all_cards_bool):
+    if not streak_count_current:
+        raise ServiceError('Quizzes results are required')
+
+    streak_record, _ = CorrectStreak.objects.get_or_create(user_id=user_id)
+    if streak_record.last_quiz_fully_correct:
+        new_streak = streak_record.streak_count + streak_count_current
+    else:
+        new_streak = streak_count_current
+    streak_record.streak_count = new_streak
+    if streak_record.max_streak < new_streak:
+        streak_record.max_streak = new_streak
+    streak_record.last_quiz_fully_correct = bool(all_cards_bool)
+    streak_record.save()
+    return streak_record
+
+
+# Event type -> {field: (type, default)}; fields without a default are required.
+BATCH_EVENTS = {
+    'mark_cards': {'card_ids': (list, None), 'correct_answer_ids': (list, [])},
+    'add_answer_xp': {'correct_answers_count': (int, None)},
+    'update_quiz_streak': {'streak_count': (int, None), 'all_cards_bool': (bool, False)},
+    'update_streak': {},
+    'lose_life': {},
+}
+
+
+def parse_events(batch):
+    """Validate a batch of client events before anything is applied; returns (type, fields) pairs."""
+    parsed = []
+    for index, event in enumerate(batch):
+        event_type = event.get('type') if isinstance(event, dict) else None
+        if event_type not in BATCH_EVENTS:
+            raise ServiceError(f'Event {index}: unknown type {event_type!r}')
+        fields = {}
+        for name, (field_type, default) in BATCH_EVENTS[event_type].items():
+            value = event.get(name, default)
+            if value is None:
+                raise ServiceError(f'Event {index} ({event_type}): {name} is required')
+            if not isinstance(value, field_type) or (field_type is int and isinstance(value, bool)):
+                raise ServiceError(f'Event {index} ({event_type}): {name} must be of type {field_type.__name__}')
+            # The only lists are card ids.
+            if field_type is list and not all(type(card_id) is int for card_id in value):
+                raise ServiceError(f'Event {index} ({event_type}): {name} must be a list of card ids')
+            fields[name] = value
+        parsed.append((event_type, fields))
+    _check_cards_exist(parsed)
+    return parsed
+
+
+def _check_cards_exist(parsed):
+    # One query for the whole batch, so an unknown id is a 400 rather than a failed insert.
+    card_ids = {card_id for _, fields in parsed for value in fields.values() if isinstance(value, list)
+                for card_id in value}
+    known_ids = set(Card.objects.filter(id__in=card_ids).values_list('id', flat=True)) if card_ids else set()
+    for index, (event_type, fields) in enumerate(parsed):
+        for name, value in fields.items():
+            unknown_ids = sorted(set(value) - known_ids) if isinstance(value, list) else []
+            if unknown_ids:
+                raise ServiceError(f'Event {index} ({event_type}): unknown {name} {unknown_ids}')
+
+
+def apply_event(user, event_type, fields):
+    if event_type == 'mark_cards':
+        record_quiz_answers(user.id, fields['card_ids'], fields['correct_answer_ids'])
+    elif event_type == 'add_answer_xp':
+        add_answer_xp(user, fields['correct_answers_count'])
+    elif event_type == 'update_quiz_streak':
+        update_quiz_streak(user.id, fields['streak_count'], fields['all_cards_bool'])
+    elif event_type == 'update_streak':
+        update_streak(user.id)
+    elif event_type == 'lose_life':
+        lose_life(user)
+
+
+def apply_events(user, parsed):
+    """Apply parsed events in order and return the resulting state of the user."""
+    for index, (event_type, fields) in enumerate(parsed):
+        try:
+            apply_event(user, event_type, fields)
+        except ServiceError as e:
+            raise ServiceError(f'Event {index} ({event_type}): {e}')
+
+    user_streak = UserStreak.objects.filter(user_id=user.id).first()
+    quiz_streak = CorrectStreak.objects.filter(user_id=user.id).first()
+    return {
+        'xp': user.xp,
+        'lives': lives_left(user),
+        'current_streak': user_streak.current_streak if user_streak else 0,
+        'longest_streak': user_streak.longest_streak if user_streak else 0,
+        'quiz_streak': quiz_streak.streak_count if quiz_streak else 0,
+        'max_quiz_streak': quiz_streak.max_streak if quiz_streak else 0,
+        'earned_badges': badges.pop_pending_awards(user.id),
+    }
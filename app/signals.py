@@ -0,0 +1,169 @@
+import logging
+
+import redis
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+
+from app import card_bitmaps, catalog, economy, leaderboard, payloads, profiles, users, write_behind
+from app.models import Card, CustomUser, Quiz, Subtitle, Topic, UserGameState
+
+logger = logging.getLogger(__name__)
+
+
+@receiver(pre_save, sender=Card)
+def remember_card_placement(sender, instance, **kwargs):
+    # Keep the placement the row had before this save so a move can be undone in the indexes.
+    instance._previous_placement = None
+    if instance.pk:
+        instance._previous_placement = Card.objects.filter(pk=instance.pk).values_list(
+            'topic_id', 'subtitle_id'
+        ).first()
+
+
+@receiver(post_save, sender=Card)
+def index_card(sender, instance, created, **kwargs):
+    previous = getattr(instance, '_previous_placement', None)
+    placement = (instance.topic_id, instance.subtitle_id)
+    if previous and previous != placement:
+        card_bitmaps.remove_catalog_card(instance.id, *previous)
+        catalog.adjust_card_counts(*previous, delta=-1)
+    card_bitmaps.add_catalog_card(instance.id, *placement)
+    if previous != placement:
+        catalog.adjust_card_counts(*placement, delta=1)
+
+
+@receiver(post_delete, sender=Card)
+def unindex_card(sender, instance, **kwargs):
+    card_bitmaps.remove_catalog_card(instance.id, instance.topic_id, instance.subtitle_id)
+    catalog.adjust_card_counts(instance.topic_id, instance.subtitle_id, delta=-1)
+
+
+@receiver(post_save, sender=Topic)
+@receiver(post_delete, sender=Topic)
+@receiver(post_save, sender=Subtitle)
+@receiver(post_delete, sender=Subtitle)
+@receiver(post_save, sender=Card)
+@receiver(post_delete, sender=Card)
+def invalidate_catalog(sender, **kwargs):
+    catalog.invalidate()
+
+
+@receiver(post_save, sender=Card)
+@receiver(post_delete, sender=Card)
+def invalidate_card_payload(sender, instance, **kwargs):
+    payloads.invalidate(instance.id)
+
+
+@receiver(pre_save, sender=Quiz)
+def remember_quiz_card(sender, instance, **kwargs):
+    instance._previous_card_id = None
+    if instance.pk:
+        instance._previous_card_id = Quiz.objects.filter(pk=instance.pk).values_list('card_id', flat=True).first()
+
+
+@receiver(post_save, sender=Quiz)
+@receiver(post_delete, sender=Quiz)
+def invalidate_quiz_payload(sender, instance, **kwargs):
+    # A quiz moved to another card leaves the old card's list too.
+    payloads.invalidate(*{instance.card_id, getattr(instance, '_previous_card_id', None)})
+
+
+@receiver(pre_save, sender=Topic)
+def remember_topic_title(sender, instance, **kwargs):
+    instance._previous_title = None
+    if instance.pk:
+        instance._previous_title = Topic.objects.filter(pk=instance.pk).values_list('title', flat=True).first()
+
+
+@receiver(post_save, sender=Topic)
+def invalidate_topic_card_payloads(sender, instance, created, **kwargs):
+    # Card payloads show the topic by title.
+    previous = getattr(instance, '_previous_title', None)
+    if previous is not None and previous != instance.title:
+        payloads.invalidate(*Card.objects.filter(topic=instance).values_list('id', flat=True))
+
+
+@receiver(pre_save, sender=Subtitle)
+def remember_subtitle_visibility(sender, instance, **kwargs):
+    instance._previous_exist = None
+    if instance.pk:
+        instance._previous_exist = Subtitle.objects.filter(pk=instance.pk).values_list('exist', flat=True).first()
+
+
+@receiver(post_save, sender=Subtitle)
+def update_subtitle_visibility(sender, instance, created, **kwargs):
+    previous = getattr(instance, '_previous_exist', None)
+    if previous is not None and previous != instance.exist:
+        catalog.subtitle_visibility_changed(instance)
+
+
+@receiver(post_save, sender=CustomUser)
+def create_game_state(sender, instance, created, **kwargs):
+    # Saves the counters passed to CustomUser(...) or set before the first save.
+    if created:
+        instance.state.save()
+
+
+@receiver(post_save, sender=UserGameState)
+def update_leaderboard_scores(sender, instance, update_fields=None, **kwargs):
+    # Lives changes save only lives; skip the round trip when no score column was written.
+    if update_fields is not None and not {'xp', 'read_cards'} & set(update_fields):
+        return
+    user_id, xp, read_cards = instance.user_id, instance.xp, instance.read_cards
+
+    def record():
+        pending = write_behind.pending(write_behind.USER, (user_id,))
+        leaderboard.record(user_id, XP=xp + pending['xp'], CARDS=read_cards + pending['read_cards'])
+
+    transaction.on_commit(record)
+
+
+@receiver(post_save, sender=UserGameState)
+def reload_economy(sender, instance, created, **kwargs):
+    # The economy never saves the row (flush() writes lives with UPDATE), so a save is an
+    # edit from the admin or a shell. Redis would go on serving the old balance and flush
+    # its lives over the edit; drop it instead. Edits in raw SQL call economy.forget().
+    if created or not economy.enabled():
+        return
+    user_id = instance.user_id
+
+    def forget():
+        try:
+            economy.forget(user_id)
+        except redis.RedisError:
+            logger.exception('Failed to drop the Redis economy of user %s', user_id)
+
+    transaction.on_commit(forget)
+
+
+@receiver(post_delete, sender=CustomUser)
+def remove_from_leaderboard(sender, instance, **kwargs):
+    leaderboard.remove(instance.id)
+
+
+@receiver(post_delete, sender=CustomUser)
+def forget_user(sender, instance, **kwargs):
+    users.invalidate(instance.id)
+
+
+@receiver(post_save, sender=CustomUser)
+def invalidate_profile(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and not profiles.PROFILE_FIELDS & set(update_fields):
+        return
+    profiles.invalidate(instance.id)
+
+
+@receiver(post_save, sender=UserGameState)
+def invalidate_profile_game_state(sender, instance, **kwargs):
+    profiles.invalidate(instance.user_id)
+
+
+@receiver(m2m_changed, sender=CustomUser.saved_cards.through)
+@receiver(m2m_changed, sender=CustomUser.topics.through)
+def invalidate_profile_relations(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    # From the Card/Topic side the changed users are in pk_set (unknown after a clear).
+    for user_id in (pk_set or ()) if reverse else (instance.id,):
+        profiles.invalidate(user_id)
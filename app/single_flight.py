@@ -0,0 +1,130 @@
+import json
+import logging
+import time
+
+import redis
+from django.conf import settings
+
+from app.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+# When a hot cache entry is cold or expiring, one worker holds a Redis lock and rebuilds
+# it; the others serve the stale copy if there is one, otherwise wait up to
+# SINGLE_FLIGHT_WAIT seconds for the rebuilt value instead of all querying Postgres.
+# Entries are written with SINGLE_FLIGHT_STALE_TTL seconds on top of their TTL and count
+# as stale during that tail, so a copy is still around while it is being replaced.
+
+STATS_KEY = 'single_flight_stats'
+
+# Outcomes counted per cache name: rebuilt by this worker, served stale while another
+# worker rebuilt, served after waiting for another worker, or rebuilt after the wait ran out.
+OUTCOMES = ('rebuilt', 'stale', 'waited', 'timeout')
+
+# Returned by run() to a worker that should serve its stale copy.
+STALE = object()
+
+
+def lock_key(key):
+    return f"{key}_rebuild_lock"
+
+
+def _count(name, outcome):
+    try:
+        get_redis().hincrby(STATS_KEY, f'{name}:{outcome}')
+    except redis.RedisError:
+        logger.exception('Failed to count a single-flight outcome')
+
+
+def _wait(name, lock, ready, wait):
+    # Poll for the other worker's result; stop early if it gave up without producing one.
+    r = get_redis()
+    deadline = time.monotonic() + wait
+    while time.monotonic() < deadline:
+        time.sleep(settings.SINGLE_FLIGHT_POLL_INTERVAL)
+        result = ready()
+        if result is not None:
+            _count(name, 'waited')
+            return result
+        if not r.exists(lock.name):
+            break
+    _count(name, 'timeout')
+    return None
+
+
+def run(name, key, rebuild, ready, stale_available=lambda: False, wait=None):
+    """
+    Run rebuild() in one worker at a time for `key`. A worker that does not get the lock
+    returns STALE at once when stale_available(), otherwise the first non-None ready()
+    within `wait` seconds (SINGLE_FLIGHT_WAIT by default); if that never comes it
+    rebuilds itself. The caller checks whether a rebuild is needed before calling.
+    """
+    lock = get_redis().lock(lock_key(key), timeout=settings.SINGLE_FLIGHT_LOCK_TIMEOUT)
+    if lock.acquire(blocking=False):
+        try:
+            _count(name, 'rebuilt')
+            return rebuild()
+        finally:
+            try:
+                lock.release()
+            except redis.exceptions.LockError:
+                # Held past its timeout; another worker may already be rebuilding.
+                pass
+    if stale_available():
+        _count(name, 'stale')
+        return STALE
+    result = _wait(name, lock, ready, settings.SINGLE_FLIGHT_WAIT if wait is None else wait)
+    return result if result is not None else rebuild()
+
+
+def get(name, key, build, ttl):
+    """
+    The JSON value cached at `key`, built by build() and cached for `ttl` seconds on a
+    miss. Concurrent misses are coalesced as described above. build() returning None
+    is not cached.
+    """
+    stale_ttl = settings.SINGLE_FLIGHT_STALE_TTL
+    try:
+        with get_redis().pipeline(transaction=False) as pipe:
+            pipe.get(key)
+            pipe.ttl(key)
+            cached, remaining = pipe.execute()
+    except redis.RedisError:
+        logger.exception('Failed to read the cache entry %s', key)
+        return build()
+    # remaining is -1 for an entry without expiry, which never goes stale.
+    if cached is not None and (remaining == -1 or remaining > stale_ttl):
+        return json.loads(cached)
+
+    def rebuild():
+        data = build()
+        if data is not None:
+            try:
+                get_redis().set(key, json.dumps(data), ex=ttl + stale_ttl)
+            except redis.RedisError:
+                logger.exception('Failed to write the cache entry %s', key)
+        return data
+
+    def ready():
+        value = get_redis().get(key)
+        return None if value is None else json.loads(value)
+
+    try:
+        data = run(name, key, rebuild, ready, stale_available=lambda: cached is not None)
+    except redis.RedisError:
+        logger.exception('Failed to coalesce the rebuild of %s', key)
+        return build()
+    return json.loads(cached) if data is STALE else data
+
+
+def stats():
+    """{cache name: {outcome: count}} since the counters were last reset."""
+    result = {}
+    for field, count in get_redis().hgetall(STATS_KEY).items():
+        name, outcome = field.rsplit(':', 1)
+        result.setdefault(name, dict.fromkeys(OUTCOMES, 0))[outcome] = int(count)
+    return result
+
+
+def reset_stats():
+    get_redis().delete(STATS_KEY)
@@ -2,20 +2,29 @@ from celery import shared_task
 from django.utils import timezone
 from datetime import timedelta
 from .models import CustomUser
+from . import card_queue, economy, leaderboard, write_behind
 
 
 @shared_task
-def restore_lives():
-    now = timezone.now()
-    minute_ago = now - timedelta(seconds=50)
-    users_to_restore = CustomUser.objects.filter(last_life_lost_time__lte=minute_ago, lives__lt=5)
+def clean_up_old_life_data():
+    cutoff_date = timezone.now() - timedelta(days=1)
+    CustomUser.objects.filter(game_state__last_life_lost_time__lt=cutoff_date, game_state__lives=5).delete()
 
-    for user in users_to_restore:
-        user.lives += 5
-        user.save()
+
+@shared_task
+def refill_card_queue(user_id, subtitle_id=None):
+    return card_queue.refill(user_id, subtitle_id)
 
 
 @shared_task
-def clean_up_old_life_data():
-    cutoff_date = timezone.now() - timedelta(days=1)
-    CustomUser.objects.filter(last_life_lost_time__lt=cutoff_date, lives=5).delete()
+def snapshot_leaderboards():
+    for category in (leaderboard.XP, leaderboard.CARDS, leaderboard.BADGES):
+        leaderboard.snapshot(category)
+
+
+@shared_task
+def flush_write_behind():
+    flushed = write_behind.flush()
+    if economy.enabled():
+        flushed += economy.flush()
+    return flushed
@@ -1,3 +1,804 @@
-from django.test import TestCase
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+import fakeredis
+import redis
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.db import connection
+from django.db.models import QuerySet
+from django.test import (
+    RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings, skipUnlessDBFeature
+)
+from django.utils import timezone
+from kombu.exceptions import OperationalError
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.renderers import JSONRenderer
+
+from app import (
+    authentication, badges, card_bitmaps, card_queue, catalog, economy, events, feed, leaderboard, lives, payloads,
+    redis_client, services, users, write_behind
+)
+from app.models import (
+    Badge, Card, CustomUser, DailyReadCards, EarnedBadge, Leaderboard, Quiz, Subtitle, Topic, UserBadgeProgress,
+    UserGameState, UserQuizStatistics, UserStreak, UserSubtitle, ViewedCard, WriteBehindBatch
+)
+from app.redis_client import get_redis
+from app.serializers import CardSerializer, UserSerializer
+
+
+def use_fake_redis(test):
+    """Point app.redis_client at a fresh in-process Redis (fakeredis) for one test."""
+    server = fakeredis.FakeServer()
+    redis_client.use_clients(
+        fakeredis.FakeRedis(server=server, decode_responses=True), fakeredis.FakeRedis(server=server)
+    )
+    test.addCleanup(redis_client.reset)
+
+
+class CardQueueRefillTests(SimpleTestCase):
+
+    def test_broker_outage(self):
+        # The queue refill is best effort; a request must not fail because it cannot be scheduled.
+        with mock.patch('app.tasks.refill_card_queue.delay', side_effect=OperationalError('broker down')), \
+                self.assertLogs('app.card_queue', 'ERROR'):
+            card_queue.schedule_refill(1)
+
+
+@override_settings(CARD_QUEUE_SIZE=3, CARD_QUEUE_LOW_WATER=2)
+class CardQueueTests(TestCase):
+
+    def setUp(self):
+        use_fake_redis(self)
+        self.user = CustomUser.objects.create(username='reader', email='reader@example.com')
+        topic = Topic.objects.create(title='Topic')
+        self.user.topics.add(topic)
+        self.cards = [
+            Card.objects.create(topic=topic, title=f'Card {number}', content='', source='') for number in range(6)
+        ]
+        ViewedCard.objects.create(user=self.user, card=self.cards[1])
+        self.key = card_queue.queue_key(self.user.id)
+
+    def queued(self):
+        return [int(card_id) for card_id in get_redis().lrange(self.key, 0, -1)]
+
+    def test_refill(self):
+        self.assertEqual(card_queue.refill(self.user.id), 3)
+        self.assertEqual(self.queued(), [self.cards[0].id, self.cards[2].id, self.cards[3].id])
+        self.assertGreater(get_redis().ttl(self.key), 0)
+        # At the low-water mark or above nothing is added.
+        self.assertEqual(card_queue.refill(self.user.id), 0)
+
+        # Below it, the queue is topped up after its last card.
+        get_redis().lpop(self.key, 2)
+        self.assertEqual(card_queue.refill(self.user.id), 2)
+        self.assertEqual(self.queued(), [self.cards[3].id, self.cards[4].id, self.cards[5].id])
+
+    def test_refill_in_progress(self):
+        get_redis().set(f"{self.key}_refill", 'other worker')
+        self.assertEqual(card_queue.refill(self.user.id), 0)
+        self.assertEqual(self.queued(), [])
+
+    def test_next_cards_pops_and_schedules_refill(self):
+        card_queue.refill(self.user.id)
+        with mock.patch.object(card_queue, 'schedule_refill') as schedule:
+            cards = card_queue.next_cards(self.user.id, 2)
+        self.assertEqual(cards, [self.cards[0], self.cards[2]])
+        self.assertEqual(self.queued(), [self.cards[3].id])
+        schedule.assert_called_once_with(self.user.id, None)
+
+    def test_empty_queue_served_from_feed(self):
+        with mock.patch.object(card_queue, 'schedule_refill') as schedule:
+            cards = card_queue.next_cards(self.user.id, 2)
+        self.assertEqual(cards, [self.cards[0], self.cards[2]])
+        schedule.assert_called_once_with(self.user.id, None)
+
+
+@override_settings(REDIS_ECONOMY=True, WRITE_BEHIND_COUNTERS=True)
+class RedisEconomyTests(TestCase):
+
+    def setUp(self):
+        use_fake_redis(self)
+        self.user = CustomUser.objects.create(username='player', email='player@example.com', xp=100)
+
+    def test_activity_refreshes_ttl(self):
+        r = get_redis()
+        economy.load(self.user.id)
+        for key in (economy.state_key(self.user.id), economy.subtitles_key(self.user.id)):
+            r.expire(key, 60)
+        economy.spend_life(self.user.id)
+        for key in (economy.state_key(self.user.id), economy.subtitles_key(self.user.id)):
+            self.assertGreater(r.ttl(key), 60)
+
+    def test_load_skips_flushed_batch(self):
+        # A flush that committed a batch and died before dropping it from Redis.
+        r = get_redis()
+        batch_key = f"{write_behind.buffer_key(write_behind.USER)}_crashed"
+        r.hset(batch_key, write_behind.member((self.user.id,), 'xp'), 5)
+        r.sadd(write_behind.batches_key(write_behind.USER), batch_key)
+        WriteBehindBatch.objects.create(batch_id=batch_key)
+        UserGameState.objects.filter(user=self.user).update(xp=105)
+
+        write_behind.incr(write_behind.USER, (self.user.id,), xp=1)
+        economy.load(self.user.id)
+        self.assertEqual(int(r.hget(economy.state_key(self.user.id), 'xp')), 106)
+
+    def test_purchase_shows_before_flush(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            topic = Topic.objects.create(title='Topic')
+            subtitle = Subtitle.objects.create(title='Subtitle', topic=topic, cost=50)
+            Card.objects.create(topic=topic, subtitle=subtitle, title='Card', content='', source='')
+        response = self.client.post('/api/purchase-subtitle/', {'user_id': self.user.id, 'subtitle_id': subtitle.id})
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.get(f'/api/subtitles-progress/{self.user.id}/topic/{topic.id}/')
+        self.assertTrue(response.json()['subtitles_progress'][0]['is_purchased'])
+        self.assertFalse(UserSubtitle.objects.exists())
+
+    def test_unknown_user(self):
+        for data in ({}, {'user_id': 'abc'}, {'user_id': self.user.id + 1}):
+            with self.subTest(data=data):
+                self.assertEqual(self.client.post('/api/lose-life/', data).status_code, 404)
+                self.assertEqual(self.client.post('/api/purchase-lives/', data).status_code, 404)
+
+    def test_edit_outside_economy_drops_hash(self):
+        economy.spend_life(self.user.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            state = UserGameState.objects.get(user=self.user)
+            state.xp, state.lives = 7, 3
+            state.save()
+        self.assertFalse(get_redis().exists(economy.state_key(self.user.id)))
+        self.assertFalse(get_redis().sismember(economy.DIRTY_LIVES_KEY, self.user.id))
+
+        self.assertEqual(economy.spend_life(self.user.id), (True, 2))
+        self.assertEqual(int(get_redis().hget(economy.state_key(self.user.id), 'xp')), 7)
+
+    def test_redis_failure_is_503(self):
+        requests = (
+            ('/api/lose-life/', {'user_id': self.user.id}),
+            ('/api/purchase-lives/', {'user_id': self.user.id}),
+            ('/api/add-xp/', {'user_id': self.user.id, 'xp_amount': 5}),
+            ('/api/purchase-subtitle/', {'user_id': self.user.id, 'subtitle_id': self.subtitle().id}),
+        )
+        for error in (redis.ConnectionError, redis.exceptions.LockError):
+            for url, data in requests:
+                with self.subTest(url=url, error=error), mock.patch.object(economy, 'load', side_effect=error):
+                    self.assertEqual(self.client.post(url, data).status_code, 503)
+        self.assertEqual(UserGameState.objects.get(user=self.user).xp, 100)
+
+    def subtitle(self):
+        topic = Topic.objects.create(title='Topic')
+        return Subtitle.objects.create(title='Subtitle', topic=topic, cost=50)
+
+
+class LeaderboardTests(TestCase):
+
+    def setUp(self):
+        use_fake_redis(self)
+        self.users = [
+            CustomUser.objects.create(username=f'player{number}', email=f'player{number}@example.com', xp=xp)
+            for number, xp in enumerate((30, 50, 30, 10))
+        ]
+        patcher = mock.patch('app.tasks.snapshot_leaderboards.delay')
+        self.schedule = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_live_ranks_are_dense(self):
+        ranked, _, _ = leaderboard.live_standings(leaderboard.XP, 4)
+        self.assertEqual([position for _, position in ranked], [1, 2, 2, 3])
+        self.assertEqual(leaderboard.rank(self.users[3].id, leaderboard.XP), 3)
+
+        # The last user holding a score takes it out of the ranking.
+        leaderboard.record(self.users[1].id, XP=30)
+        self.assertEqual(leaderboard.rank(self.users[3].id, leaderboard.XP), 2)
+        leaderboard.remove(self.users[3].id)
+        self.assertIsNone(leaderboard.rank(self.users[3].id, leaderboard.XP))
+
+    def test_full_listing_matches_snapshot(self):
+        live, _ = leaderboard.full_listing(leaderboard.XP)
+        live = list(live)
+        self.schedule.assert_called_once_with()
+        leaderboard.snapshot(leaderboard.XP)
+        stored, _ = leaderboard.full_listing(leaderboard.XP)
+        self.assertEqual(live, list(stored))
+        self.assertEqual([row[4] for row in live], [1, 2, 2, 3])
+
+        first_page, _ = leaderboard.full_listing(leaderboard.XP, limit=2)
+        *_, (user_id, _, _, score, _) = first_page
+        self.assertEqual(list(leaderboard.live_listing(leaderboard.XP, after=(score, user_id))), live[2:])
+
+    def test_live_listing_pages_ties_across_chunks(self):
+        # bulk_create skips the signal that gives a user a game state.
+        stateless, = CustomUser.objects.bulk_create([CustomUser(username='stateless', email='stateless@example.com')])
+        leaderboard.invalidate()
+        rows = list(leaderboard.live_listing(leaderboard.XP, chunk_size=2))
+        self.assertEqual(get_redis().zscore(leaderboard.key(leaderboard.XP), stateless.id), 0)
+        self.assertEqual([row[4] for row in rows], [1, 2, 2, 3])
+        self.assertEqual(rows[1:3], [(user.id, user.username, user.avatar_url, 30, 2) for user in self.users[::2]])
+
+        user_id, _, _, score, _ = rows[1]
+        self.assertEqual(list(leaderboard.live_listing(leaderboard.XP, after=(score, user_id), chunk_size=1)), rows[2:])
+
+    def test_stale_snapshot(self):
+        leaderboard.snapshot(leaderboard.XP)
+        Leaderboard.objects.update(snapshot_at=timezone.now() - timedelta(
+            seconds=settings.LEADERBOARD_SNAPSHOT_MAX_AGE + 1
+        ))
+        leaderboard.ensure_built()
+        leaderboard.record(self.users[3].id, XP=100)
+        rows, ranked_at = leaderboard.full_listing(leaderboard.XP)
+        self.assertEqual(next(rows)[0], self.users[3].id)
+        self.assertGreater(ranked_at, timezone.now() - timedelta(seconds=1))
+        leaderboard.full_listing(leaderboard.XP)
+        self.schedule.assert_called_once_with()
+
+
+class UserLoaderTests(TestCase):
+
+    def setUp(self):
+        use_fake_redis(self)
+        self.user = CustomUser.objects.create(username='known', email='known@example.com')
+
+    def request(self):
+        request = RequestFactory().get('/')
+        request.user = AnonymousUser()
+        return request
+
+    def test_deleted_in_another_process(self):
+        users.load(self.request(), self.user.id)
+        with self.assertNumQueries(0):
+            users.load(self.request(), self.user.id)
+
+        date_joined = users._known[self.user.id]
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.delete()
+        # As remembered by a process that did not run the delete.
+        users._known[self.user.id] = date_joined
+        with self.assertRaises(CustomUser.DoesNotExist):
+            users.load(self.request(), self.user.id)
+
+
+@override_settings(WRITE_BEHIND_COUNTERS=True)
+class WriteBehindTests(TestCase):
+
+    def setUp(self):
+        use_fake_redis(self)
+        self.user = CustomUser.objects.create(username='player', email='player@example.com', xp=100)
+        self.row = (self.user.id,)
+
+    def crashed_batch(self, **deltas):
+        # What a flush leaves behind when it dies after moving the buffer aside.
+        r = get_redis()
+        batch_key = f"{write_behind.buffer_key(write_behind.USER)}_crashed"
+        for field, delta in deltas.items():
+            r.hset(batch_key, write_behind.member(self.row, field), delta)
+        r.sadd(write_behind.batches_key(write_behind.USER), batch_key)
+        return batch_key
+
+    def test_flush(self):
+        today = timezone.now().date()
+        write_behind.incr(write_behind.USER, self.row, xp=5, read_cards=2)
+        write_behind.incr(write_behind.USER, self.row, xp=3)
+        write_behind.incr(write_behind.QUIZ_STATS, self.row, total_attempts=4, correct_attempts=1)
+        write_behind.incr(write_behind.DAILY_READS, (self.user.id, today), cards_read=4)
+        self.assertEqual(write_behind.pending(write_behind.USER, self.row), {'xp': 8, 'read_cards': 2})
+        self.assertEqual(UserGameState.objects.get(user=self.user).xp, 100)
+
+        write_behind.flush()
+        state = UserGameState.objects.get(user=self.user)
+        self.assertEqual((state.xp, state.read_cards), (108, 2))
+        self.assertEqual(
+            UserQuizStatistics.objects.values_list('total_attempts', 'correct_attempts').get(user=self.user), (4, 1)
+        )
+        self.assertEqual(DailyReadCards.objects.get(user=self.user, date=today).cards_read, 4)
+        self.assertEqual(write_behind.pending(write_behind.USER, self.row), {'xp': 0, 'read_cards': 0})
+        self.assertFalse(get_redis().keys('write_behind_*'))
+
+    def test_crash_before_commit(self):
+        self.crashed_batch(xp=5)
+        self.assertEqual(write_behind.pending(write_behind.USER, self.row)['xp'], 5)
+        write_behind.flush()
+        self.assertEqual(UserGameState.objects.get(user=self.user).xp, 105)
+
+    def test_crash_after_commit(self):
+        batch_key = self.crashed_batch(xp=5)
+        UserGameState.objects.filter(user=self.user).update(xp=105)
+        WriteBehindBatch.objects.create(batch_id=batch_key)
+        self.assertEqual(write_behind.pending(write_behind.USER, self.row)['xp'], 0)
+
+        write_behind.flush()
+        self.assertEqual(UserGameState.objects.get(user=self.user).xp, 105)
+        self.assertFalse(get_redis().exists(batch_key, write_behind.batches_key(write_behind.USER)))
+
+    def test_redis_down_writes_through(self):
+        with mock.patch.object(write_behind, 'pipeline', side_effect=redis.ConnectionError), \
+                self.assertLogs('app.write_behind', 'ERROR'):
+            write_behind.incr(write_behind.USER, self.row, xp=5)
+        self.assertEqual(UserGameState.objects.get(user=self.user).xp, 105)
+
+
+class TokenCacheTests(TestCase):
+
+    def setUp(self):
+        use_fake_redis(self)
+        authentication._local.clear()
+        self.addCleanup(authentication._local.clear)
+        self.user = CustomUser.objects.create(username='player', email='player@example.com')
+        self.token = Token.objects.create(user=self.user)
+        self.auth = authentication.CachedTokenAuthentication()
+
+    def logout(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post('/api/logout/', HTTP_AUTHORIZATION=f'Token {self.token.key}')
+
+    def test_cached_after_first_request(self):
+        with self.assertNumQueries(1):
+            user, _ = self.auth.authenticate_credentials(self.token.key)
+        self.assertEqual(user.id, self.user.id)
+        with self.assertNumQueries(0):
+            self.auth.authenticate_credentials(self.token.key)
+
+        # Another process, without the local copy, is served from Redis.
+        authentication._local.clear()
+        with self.assertNumQueries(0):
+            self.auth.authenticate_credentials(self.token.key)
+        self.assertNotIn(self.token.key, get_redis().get(authentication.cache_key(self.token.key)))
+
+    def test_logout_forgets_token(self):
+        self.auth.authenticate_credentials(self.token.key)
+        self.assertEqual(self.logout().status_code, 200)
+        self.assertFalse(get_redis().exists(authentication.cache_key(self.token.key)))
+        self.assertEqual(self.logout().status_code, 401)
+
+    def test_account_deletion_forgets_token(self):
+        self.auth.authenticate_credentials(self.token.key)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/delete_account/', {'user_id': self.user.id})
+        self.assertEqual(response.status_code, 200)
+        with self.assertRaises(AuthenticationFailed):
+            self.auth.authenticate_credentials(self.token.key)
+
+    def test_redis_down(self):
+        with mock.patch.object(authentication, 'get_redis', side_effect=redis.ConnectionError), \
+                self.assertLogs('app.authentication', 'ERROR'):
+            user, _ = self.auth.authenticate_credentials(self.token.key)
+        self.assertEqual(user.id, self.user.id)
+
+
+class CardPayloadCacheTests(TestCase):
+
+    def setUp(self):
+        use_fake_redis(self)
+        self.topic = Topic.objects.create(title='Topic')
+        self.cards = [
+            Card.objects.create(topic=self.topic, title=f'Card {number}', content='', source='') for number in range(2)
+        ]
+        self.quiz = Quiz.objects.create(card=self.cards[0], question='Question', correct_answer='A', answers=['A'])
+
+    def card(self, card):
+        return json.loads(payloads.cards([card.id])[card.id])
+
+    def quiz_ids(self, card):
+        return [quiz['id'] for quiz in json.loads(payloads.quizzes([card.id])[card.id])]
+
+    def test_served_from_redis(self):
+        with self.assertNumQueries(1):
+            payload = payloads.cards([card.id for card in self.cards])
+        with self.assertNumQueries(0):
+            self.assertEqual(payloads.cards([card.id for card in self.cards]), payload)
+        self.assertEqual(payload[self.cards[0].id], JSONRenderer().render(CardSerializer(self.cards[0]).data))
+
+    def test_card_edit(self):
+        self.card(self.cards[0])
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.cards[0].title = 'Edited'
+            self.cards[0].save()
+        # Dropped only once the edit commits, so a concurrent miss cannot cache the old row again.
+        self.assertEqual(self.card(self.cards[0])['title'], 'Card 0')
+        for callback in callbacks:
+            callback()
+        self.assertEqual(self.card(self.cards[0])['title'], 'Edited')
+
+    def test_topic_rename(self):
+        self.card(self.cards[1])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.topic.title = 'Renamed'
+            self.topic.save()
+        self.assertEqual(self.card(self.cards[1])['topic'], 'Renamed')
+
+    def test_quiz_moved(self):
+        self.assertEqual((self.quiz_ids(self.cards[0]), self.quiz_ids(self.cards[1])), ([self.quiz.id], []))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.quiz.card = self.cards[1]
+            self.quiz.save()
+        self.assertEqual((self.quiz_ids(self.cards[0]), self.quiz_ids(self.cards[1])), ([], [self.quiz.id]))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.quiz.delete()
+        self.assertEqual(self.quiz_ids(self.cards[1]), [])
+
+
+class CatalogETagTests(TestCase):
+
+    def setUp(self):
+        use_fake_redis(self)
+        Topic.objects.create(title='Topic')
+
+    def test_revalidation(self):
+        response = self.client.get('/api/topics/')
+        self.assertEqual(response.status_code, 200)
+        tag = response['ETag']
+
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/topics/', HTTP_IF_NONE_MATCH=tag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Topic.objects.create(title='New topic')
+        response = self.client.get('/api/topics/', HTTP_IF_NONE_MATCH=tag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], tag)
+        self.assertEqual([topic['title'] for topic in response.json()], ['Topic', 'New topic'])
+
+    def test_redis_down(self):
+        with mock.patch.object(catalog, 'get_redis', side_effect=redis.ConnectionError), \
+                self.assertLogs('app.catalog', 'ERROR'):
+            response = self.client.get('/api/topics/', HTTP_IF_NONE_MATCH='"catalog-0-topics"')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('ETag', response)
+
+
+class CardBitmapRebuildTests(TestCase):
+
+    def setUp(self):
+        use_fake_redis(self)
+        self.user = CustomUser.objects.create(username='viewer', email='viewer@example.com')
+        topic = Topic.objects.create(title='Topic')
+        self.cards = [
+            Card.objects.create(topic=topic, title=f'Card {number}', content='', source='') for number in range(2)
+        ]
+        ViewedCard.objects.create(user=self.user, card=self.cards[0])
+
+    def test_view_during_rebuild(self):
+        to_bitmap = card_bitmaps.to_bitmap
+
+        def view_meanwhile(card_ids):
+            # A card viewed after the rebuild read ViewedCard but before it wrote the bitmaps.
+            if not ViewedCard.objects.filter(card=self.cards[1]).exists():
+                ViewedCard.objects.create(user=self.user, card=self.cards[1])
+                card_bitmaps.record_viewed(self.user.id, [self.cards[1].id])
+            return to_bitmap(card_ids)
+
+        with mock.patch('app.card_bitmaps.to_bitmap', side_effect=view_meanwhile):
+            self.assertTrue(card_bitmaps.rebuild_user(self.user.id))
+        viewed, _ = card_bitmaps.user_bitmaps(self.user.id)
+        self.assertEqual(viewed, {card.id for card in self.cards})
+
+    def test_card_queue_skips_viewed_cards(self):
+        r = get_redis()
+        r.rpush(card_queue.queue_key(self.user.id), *[card.id for card in self.cards])
+
+        with mock.patch.object(card_queue, 'schedule_refill'), \
+                mock.patch.object(card_queue, 'unviewed_cards') as anti_join:
+            self.assertEqual(card_queue.next_cards(self.user.id, 2, consume=False), [self.cards[1]])
+        anti_join.assert_not_called()
+
+
+class BadgeEvaluationQueryTests(TestCase):
+    """Evaluating a user's badges costs the same number of queries whatever the number of badges."""
+
+    TOPICS = 3
+
+    def setUp(self):
+        self.user = CustomUser.objects.create(username='reader', email='reader@example.com')
+        self.topics = []
+        for number in range(self.TOPICS):
+            topic = Topic.objects.create(title=f'Topic {number}')
+            subtitle = Subtitle.objects.create(title=f'Subtitle {number}', topic=topic)
+            card = Card.objects.create(topic=topic, subtitle=subtitle, title='Card', content='', source='')
+            ViewedCard.objects.create(user=self.user, card=card, test_passed=True)
+            self.topics.append(topic)
+        UserQuizStatistics.objects.create(user=self.user, total_attempts=1, correct_attempts=1)
+
+    def create_badges(self, count):
+        # Every kind of criteria, the topic-specific ones spread over all topics; all reached.
+        kinds = [
+            lambda number: {badges.READ_CARDS: 1},
+            lambda number: {badges.CORRECT_QUIZ_ANSWERS: 1},
+            lambda number: {badges.COMPLETE_SUBTOPICS: 1},
+            lambda number: {badges.COMPLETE_TOPIC: 1},
+            lambda number: {badges.READ_SPECIFIC_TOPIC: {
+                'topic_id': self.topics[number % self.TOPICS].id, 'count': 1
+            }},
+            lambda number: {badges.QUIZ_SPECIFIC_TOPIC: {
+                'topic_id': self.topics[number % self.TOPICS].id, 'count': 1
+            }},
+        ]
+        Badge.objects.all().delete()
+        Badge.objects.bulk_create([
+            Badge(name=f'Badge {number}', description='', criteria=kinds[number % len(kinds)](number))
+            for number in range(count)
+        ])
+
+    def test_evaluate(self):
+        for count in (3, 30):
+            with self.subTest(badges=count):
+                self.create_badges(count)
+                criteria = badges.badge_criteria()
+                # Viewed cards, quiz statistics and the subtitle catalog.
+                with self.assertNumQueries(3):
+                    badges.evaluate(self.user.id, criteria)
+
+    def test_recompute(self):
+        for count in (3, 30):
+            with self.subTest(badges=count):
+                self.create_badges(count)
+                # The badges, the three reads of evaluate(), the progress upsert, the earned
+                # badges insert and the earned badge count for the leaderboard.
+                with self.assertNumQueries(7):
+                    badges.recompute(self.user.id)
+                self.assertEqual(UserBadgeProgress.objects.filter(user=self.user).count(), count)
+                self.assertEqual(EarnedBadge.objects.filter(user=self.user).count(), count)
+
+
+@override_settings(WRITE_BEHIND_COUNTERS=False)
+class BadgeEngineTests(TestCase):
+    """Badge progress and awards follow the domain events sent for answered cards."""
+
+    def setUp(self):
+        use_fake_redis(self)
+        self.user = CustomUser.objects.create(username='reader', email='reader@example.com')
+        topic = Topic.objects.create(title='Topic')
+        self.cards = [
+            Card.objects.create(topic=topic, title=f'Card {number}', content='', source='') for number in range(2)
+        ]
+        self.badges = {
+            name: Badge.objects.create(name=name, description='', criteria=criteria) for name, criteria in (
+                ('Two cards', {badges.READ_CARDS: 2}),
+                ('First answer', {badges.CORRECT_QUIZ_ANSWERS: 1}),
+                ('Topic', {badges.READ_SPECIFIC_TOPIC: {'topic_id': topic.id, 'count': 1}}),
+            )
+        }
+
+    def progress(self, name):
+        return UserBadgeProgress.objects.get(user=self.user, badge=self.badges[name]).progress_number
+
+    def test_answers_advance_and_award(self):
+        services.record_quiz_answers(self.user.id, [self.cards[0].id], [self.cards[0].id])
+        self.assertEqual(self.progress('Two cards'), 1)
+        self.assertEqual(
+            sorted(award['name'] for award in badges.pop_pending_awards(self.user.id)), ['First answer', 'Topic']
+        )
+
+        services.record_quiz_answers(self.user.id, [self.cards[1].id], [self.cards[1].id])
+        self.assertEqual(badges.pop_pending_awards(self.user.id), [{'name': 'Two cards'}])
+        self.assertEqual(badges.pop_pending_awards(self.user.id), [])
+
+        # A wrong answer takes a passed card back; earned badges stay.
+        services.record_quiz_answers(self.user.id, [self.cards[0].id], [])
+        self.assertEqual(self.progress('Two cards'), 1)
+        self.assertEqual(EarnedBadge.objects.filter(user=self.user).count(), 3)
+
+
+@override_settings(REDIS_ECONOMY=False)
+class LivesRegenerationTests(TestCase):
+    """Lives come back with the passing of time alone; no job writes them."""
+
+    def setUp(self):
+        use_fake_redis(self)
+        self.interval = timedelta(seconds=settings.LIVES_REGEN_INTERVAL)
+        # Two lives regenerated and one second into the third.
+        self.since = timezone.now() - self.interval * 2 - timedelta(seconds=1)
+        self.user = CustomUser.objects.create(
+            username='player', email='player@example.com', lives=0, last_life_lost_time=self.since
+        )
+
+    def test_regenerate(self):
+        cap, now = settings.LIVES_REGEN_CAP, self.since + self.interval * 2 + timedelta(seconds=1)
+        self.assertEqual(lives.regenerate(0, self.since, now), (2, self.since + self.interval * 2))
+        self.assertEqual(lives.regenerate(cap - 1, self.since, now), (cap, now))
+        # Bought lives above the cap do not regenerate.
+        self.assertEqual(lives.regenerate(cap + 3, self.since, now), (cap + 3, now))
+
+    def test_no_beat_job(self):
+        tasks = [entry['task'] for entry in settings.CELERY_BEAT_SCHEDULE.values()]
+        self.assertFalse([task for task in tasks if 'lives' in task])
+
+    def test_get_lives(self):
+        response = self.client.get('/api/get-lives/', {'user_id': self.user.id})
+        self.assertEqual(response.json()['lives_remaining'], 2)
+        self.assertAlmostEqual(response.json()['next_life_in'], settings.LIVES_REGEN_INTERVAL - 1, delta=5)
+        self.assertEqual(UserGameState.objects.get(user=self.user).lives, 0)
+
+    def test_spending_keeps_the_regeneration_clock(self):
+        self.assertEqual(services.spend_life(self.user.id), 1)
+        state = UserGameState.objects.get(user=self.user)
+        self.assertEqual((state.lives, state.last_life_lost_time), (1, self.since + self.interval * 2))
+
+    def test_user_serializer_counts_regenerated_lives(self):
+        self.assertEqual(UserSerializer(self.user).data['lives'], 2)
+
+
+class CardFeedTests(TestCase):
+
+    def setUp(self):
+        use_fake_redis(self)
+        self.user = CustomUser.objects.create(username='reader', email='reader@example.com')
+        topic = Topic.objects.create(title='Topic')
+        self.subtitle = Subtitle.objects.create(title='Subtitle', topic=topic)
+        self.cards = [
+            Card.objects.create(topic=topic, subtitle=self.subtitle, title=f'Card {number}', content='', source='')
+            for number in range(3)
+        ]
+        self.user.topics.add(topic)
+
+    def test_progress_counts_new_views_only(self):
+        ViewedCard.objects.create(user=self.user, card=self.cards[0])
+        receiver = mock.Mock()
+        events.cards_viewed.connect(receiver)
+        self.addCleanup(events.cards_viewed.disconnect, receiver)
+
+        services.record_viewed(self.user.id, [card.id for card in self.cards[:2]])
+        receiver.assert_called_once_with(
+            signal=events.cards_viewed, sender=ViewedCard, user_id=self.user.id, card_ids=[self.cards[1].id]
+        )
+        self.assertEqual(ViewedCard.objects.filter(user=self.user).count(), 2)
+
+        response = self.client.get(f'/api/cards/{self.user.id}/', {'after': 0})
+        self.assertEqual([card['id'] for card in response.json()], [self.cards[2].id])
+        self.assertEqual(ViewedCard.objects.filter(user=self.user).count(), 3)
+
+    def test_cursor_skips_viewed_cards(self):
+        Card.objects.create(topic=Topic.objects.create(title='Not followed'), title='Other', content='', source='')
+        ViewedCard.objects.create(user=self.user, card=self.cards[1])
+
+        pages, after = [], 0
+        while True:
+            response = self.client.get(f'/api/cards_subtitle/{self.subtitle.id}/{self.user.id}/1/', {'after': after})
+            page = [card['id'] for card in response.json()]
+            if not page:
+                break
+            pages.append(page)
+            after = page[-1]
+        self.assertEqual(pages, [[self.cards[0].id], [self.cards[2].id]])
+
+        response = self.client.get(f'/api/cards/{self.user.id}/', {'after': 0, 'limit': 10})
+        self.assertEqual([card['id'] for card in response.json()], [self.cards[0].id, self.cards[2].id])
+
+    def test_viewed_cards_excluded_with_not_exists(self):
+        sql = str(feed.topic_cards(self.user.id, after=self.cards[0].id).query)
+        self.assertIn('NOT EXISTS', sql)
+        self.assertTrue(sql.endswith('ORDER BY "app_card"."id" ASC'))
+
+
+class CounterIncrementTests(TestCase):
+
+    def test_row_created_concurrently(self):
+        # The row appears between the UPDATE that found none and the INSERT.
+        user = CustomUser.objects.create(username='player', email='player@example.com')
+        UserQuizStatistics.objects.create(user=user, total_attempts=1)
+        update = QuerySet.update
+        missed = []
+
+        def miss_once(queryset, **kwargs):
+            if not missed:
+                missed.append(True)
+                return 0
+            return update(queryset, **kwargs)
+
+        with mock.patch.object(QuerySet, 'update', autospec=True, side_effect=miss_once):
+            services.increment(UserQuizStatistics, {'user_id': user.id}, total_attempts=2)
+        self.assertEqual(list(UserQuizStatistics.objects.values_list('total_attempts', flat=True)), [3])
+
+
+class EventsBatchTests(TestCase):
+
+    def setUp(self):
+        use_fake_redis(self)
+        self.user = CustomUser.objects.create(username='player', email='player@example.com')
+        self.card = Card.objects.create(topic=Topic.objects.create(title='Topic'), title='Card', content='', source='')
+
+    def post(self, *events):
+        return self.client.post(
+            '/api/events/batch/', {'user_id': self.user.id, 'events': list(events)}, content_type='application/json'
+        )
+
+    def test_first_streak_update(self):
+        # Sign-up creates no UserStreak row.
+        response = self.post({'type': 'update_streak'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['current_streak'], 1)
+        self.assertEqual(self.client.post('/api/update-streak/', {'user_id': self.user.id + 1}).status_code, 404)
+
+    def test_invalid_card_ids(self):
+        for card_ids in (['1'], [True], [self.card.id, self.card.id + 1]):
+            with self.subTest(card_ids=card_ids):
+                self.assertEqual(self.post({'type': 'mark_cards', 'card_ids': card_ids}).status_code, 400)
+        response = self.post({'type': 'mark_cards', 'card_ids': [self.card.id], 'correct_answer_ids': [0]})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(ViewedCard.objects.exists())
+
+    def test_batch_applied_in_one_request(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.post(
+                {'type': 'mark_cards', 'card_ids': [self.card.id], 'correct_answer_ids': [self.card.id]},
+                {'type': 'add_answer_xp', 'correct_answers_count': 1},
+                {'type': 'update_quiz_streak', 'streak_count': 1, 'all_cards_bool': True},
+                {'type': 'lose_life'},
+            )
+        self.assertEqual(response.status_code, 200)
+        state = response.json()
+        self.assertEqual((state['xp'], state['lives'], state['quiz_streak']), (10, 14, 1))
+        self.assertTrue(ViewedCard.objects.get(user=self.user, card=self.card).test_passed)
+        self.assertEqual(write_behind.pending(write_behind.USER, (self.user.id,))['xp'], 10)
+
+    def test_failing_event_rolls_back_batch(self):
+        UserGameState.objects.filter(user=self.user).update(lives=0, last_life_lost_time=timezone.now())
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.post(
+                {'type': 'mark_cards', 'card_ids': [self.card.id], 'correct_answer_ids': [self.card.id]},
+                {'type': 'add_answer_xp', 'correct_answers_count': 1},
+                {'type': 'lose_life'},
+            )
+        self.assertEqual(response.status_code, 400)
+        self.assertTrue(response.json()['error'].startswith('Event 2 (lose_life)'))
+        self.assertFalse(ViewedCard.objects.exists())
+        self.assertEqual(write_behind.pending(write_behind.USER, (self.user.id,))['xp'], 0)
+        self.assertEqual(write_behind.pending(write_behind.QUIZ_STATS, (self.user.id,))['total_attempts'], 0)
+
+
+class ConcurrentLifePurchaseTests(TransactionTestCase):
+    """100 purchases fired at once must spend the balance exactly once, on both economy paths."""
+
+    PURCHASES = 100
+    COST = 10
+    START_XP = 500  # Covers exactly half of the purchases.
+    # Above the regeneration cap lives only change when bought.
+    START_LIVES = settings.LIVES_REGEN_CAP + 1
+
+    def setUp(self):
+        use_fake_redis(self)
+        self.user = CustomUser.objects.create(
+            username='buyer', email='buyer@example.com', xp=self.START_XP, lives=self.START_LIVES
+        )
+
+    def purchase_concurrently(self, workers):
+        start = threading.Barrier(min(workers, self.PURCHASES))
+
+        def purchase(_):
+            try:
+                start.wait()
+                services.purchase_lives(self.user.id, self.COST)
+                return True
+            except services.ServiceError:
+                return False
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return sum(pool.map(purchase, range(self.PURCHASES)))
+
+    def assert_final_balance(self, bought):
+        state = UserGameState.objects.get(user=self.user)
+        self.assertEqual(bought, self.START_XP // self.COST)
+        self.assertEqual(state.xp, self.START_XP - bought * self.COST)
+        self.assertEqual(state.xp, 0)
+        self.assertEqual(state.lives, self.START_LIVES + bought)
+
+    @skipUnlessDBFeature('has_select_for_update')
+    @override_settings(REDIS_ECONOMY=False, WRITE_BEHIND_COUNTERS=False)
+    def test_conditional_update(self):
+        # Every worker holds a connection; stay below Postgres' default max_connections.
+        self.assert_final_balance(self.purchase_concurrently(workers=50))
+
+    @override_settings(REDIS_ECONOMY=True, WRITE_BEHIND_COUNTERS=True)
+    def test_redis_economy(self):
+        bought = self.purchase_concurrently(workers=self.PURCHASES)
+        write_behind.flush()
+        economy.flush()
+        self.assert_final_balance(bought)
@@ -10,7 +10,7 @@ from .views import CheckUsernameUniqueView, GetAllTopicsView, CreateUserView, Ge
     CardsForSubtitleView, QuizByCardsView, GetQuizzesByCardIdsView, MarkCardsAndViewedQuizzes, SubtopicPurchaseView, \
     GetLivesView, LoseLifeView, LoginUserView, LogoutUserView, GetStreakView, UpdateStreakView, GoogleSignInView, \
     UpdateQuizStreakView, UserStatsView, PurchaseLivesView, MainView, AddXPView, CheckRestoreLivesView, \
-    ReportLifeLossView, DeleteAccountView, AppleSignInView
+    ReportLifeLossView, DeleteAccountView, AppleSignInView, EventsBatchView, RedisPoolStatsView
 
 urlpatterns = [
     path('check_unique/<str:username>/', CheckUsernameUniqueView.as_view(), name='check-username-unique'),
@@ -54,6 +54,8 @@ urlpatterns = [
     path('report_life_loss/<int:user_id>/', ReportLifeLossView.as_view(), name='report-life-loss'),
     path('delete_account/', DeleteAccountView.as_view(), name='delete_account'),
     path('apple-signin/', AppleSignInView.as_view(), name='apple-signin'),
+    path('events/batch/', EventsBatchView.as_view(), name='events-batch'),
+    path('redis-pool-stats/', RedisPoolStatsView.as_view(), name='redis-pool-stats'),
 ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
 
 if settings.DEBUG:
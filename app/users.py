@@ -0,0 +1,120 @@
+import logging
+import threading
+
+import redis
+from cachetools import TTLCache
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.http import Http404
+
+from app.models import CustomUser
+from app.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+# The user a view acts on, loaded at most once per request with only the columns it reads.
+# Most requests are about the authenticated user, whom the token cache already built.
+# Ids seen to exist are kept per process with their immutable columns, so views that
+# only need the id skip the query. A deletion bumps a version in Redis, which every
+# process reads once per request before trusting these ids and empties them when it
+# has moved, so no process acts on a deleted user it still remembers.
+
+IMMUTABLE_FIELDS = ('id', 'date_joined')
+ALL_FIELDS = tuple(field.attname for field in CustomUser._meta.concrete_fields)
+
+DELETED_VERSION_KEY = 'users_deleted_version'
+
+_known = TTLCache(maxsize=settings.USER_CACHE_SIZE, ttl=settings.USER_CACHE_TTL)
+_known_version = None
+_known_lock = threading.Lock()
+
+
+def _covers(user, fields, related):
+    if not fields.isdisjoint(user.get_deferred_fields()):
+        return False
+    return all(CustomUser._meta.get_field(name).is_cached(user) for name in related)
+
+
+def _loaded(request):
+    if '_loaded_users' not in request.__dict__:
+        request._loaded_users = {}
+    return request._loaded_users
+
+
+def _known_is_current(request):
+    global _known_version
+    if '_known_is_current' not in request.__dict__:
+        try:
+            version = get_redis().get(DELETED_VERSION_KEY)
+        except redis.RedisError:
+            # Without the version a remembered id may be stale; query instead.
+            logger.exception('Failed to read the user deletion version')
+            request._known_is_current = False
+        else:
+            with _known_lock:
+                if version != _known_version:
+                    _known.clear()
+                    _known_version = version
+            request._known_is_current = True
+    return request._known_is_current
+
+
+def load(request, user_id, fields=(), related=()):
+    """
+    The CustomUser `user_id` for this request with `fields` loaded (every other column
+    loads on first access) and the one-to-one relations in `related` joined. Raises
+    CustomUser.DoesNotExist like CustomUser.objects.get().
+    """
+    try:
+        user_id = int(user_id)
+    except (TypeError, ValueError):
+        raise CustomUser.DoesNotExist
+    fields, loaded = set(fields), _loaded(request)
+
+    candidates = [loaded.get(user_id)]
+    if getattr(request.user, 'is_authenticated', False) and request.user.id == user_id:
+        candidates.append(request.user)
+    for user in candidates:
+        if user is not None and _covers(user, fields, related):
+            return user
+
+    if not fields and not related and _known_is_current(request):
+        with _known_lock:
+            date_joined = _known.get(user_id)
+        if date_joined is not None:
+            user = CustomUser.from_db(DEFAULT_DB_ALIAS, IMMUTABLE_FIELDS, (user_id, date_joined))
+            loaded[user_id] = user
+            return user
+
+    user = CustomUser.objects.select_related(*related) \
+        .only(*IMMUTABLE_FIELDS, *fields, *related).filter(id=user_id).first()
+    if user is None:
+        raise CustomUser.DoesNotExist
+    loaded[user_id] = user
+    with _known_lock:
+        _known[user_id] = user.date_joined
+    return user
+
+
+def load_or_404(request, user_id, fields=(), related=()):
+    try:
+        return load(request, user_id, fields, related)
+    except CustomUser.DoesNotExist:
+        raise Http404
+
+
+def forget(user_id):
+    with _known_lock:
+        _known.pop(user_id, None)
+
+
+def invalidate(user_id):
+    """Forget a deleted user here at once and in every other process after the commit."""
+    forget(user_id)
+
+    def bump():
+        try:
+            get_redis().incr(DELETED_VERSION_KEY)
+        except redis.RedisError:
+            logger.exception('Failed to publish the deletion of user %s', user_id)
+    transaction.on_commit(bump)
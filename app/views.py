@@ -1,37 +1,40 @@
+import json
 import os
 import random
 import string
 import uuid
-from datetime import timedelta
 
-import redis
+from django.conf import settings
 from django.contrib.auth import authenticate
 from django.contrib.auth.hashers import make_password
 from django.core.exceptions import ObjectDoesNotExist
 from django.db import transaction, IntegrityError
-from django.db.models import Subquery, Count, Window, F
-from django.db.models.functions import DenseRank
-from django.http import JsonResponse, HttpResponse
-from django.shortcuts import get_object_or_404
+from django.db.models import Subquery, OuterRef, Count, Sum
+from django.db.models.functions import Coalesce
+from django.http import JsonResponse, HttpResponse, StreamingHttpResponse, Http404
 from django.utils import timezone
+from django.utils.cache import get_conditional_response
 from django.utils.decorators import method_decorator
 from django.views import View
 from django.contrib.auth.models import User
 from django.views.decorators.csrf import csrf_exempt
 from rest_framework import status
 from rest_framework.authtoken.models import Token
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAuthenticated, IsAdminUser
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from google.oauth2 import id_token
 from google.auth.transport import requests
 import jwt
 
+from app import authentication, card_queue, card_bitmaps, catalog, badges, economy, events, leaderboard, lives, \
+    payloads, profiles, services, users, write_behind
+from app.feed import topic_feed, subtitle_feed
+from app.redis_client import pool_stats
 from app.models import CustomUser, Topic, ViewedCard, Card, Quiz, UserBadgeProgress, Badge, EarnedBadge, Subtitle, \
-    UserSubtitle, UserQuizStatistics, UserStreak, DailyReadCards, CorrectStreak
-from app.serializers import TopicSerializer, UserSerializer, BadgeSerializer, UserStatsSerializer, CardSerializer, \
-    QuizSerializer, EarnedBadgeSerializer, UserStreakSerializer, DailyReadCardsSerializer, CorrectStreakSerializer, \
-    UserQuizStatisticsSerializer, CustomUserSerializer
+    UserSubtitle, UserQuizStatistics, UserStreak, DailyReadCards, CorrectStreak, UserSubtitleProgress
+from app.serializers import UserSerializer, BadgeSerializer, QuizSerializer, UserStreakSerializer, \
+    DailyReadCardsSerializer, CorrectStreakSerializer, UserQuizStatisticsSerializer, CustomUserSerializer
 
 
 class CheckUsernameUniqueView(APIView):
@@ -44,11 +47,24 @@ class CheckUsernameUniqueView(APIView):
         return Response({'isUnique': is_unique}, status=status.HTTP_200_OK)
 
 
+def catalog_response(request, catalog_version, name, build):
+    # Clients revalidate with If-None-Match and get a 304 without the catalog being read.
+    tag = catalog.etag(catalog_version, name)
+    if tag is not None:
+        not_modified = get_conditional_response(request, etag=tag)
+        if not_modified is not None:
+            return not_modified
+    response = build()
+    if tag is not None and response.status_code == status.HTTP_200_OK:
+        response['ETag'] = tag
+    return response
+
+
 class GetAllTopicsView(APIView):
     def get(self, request, *args, **kwargs):
-        topics = Topic.objects.all()
-        serializer = TopicSerializer(topics, many=True)
-        return Response(serializer.data)
+        catalog_version = catalog.version()
+        return catalog_response(request, catalog_version, 'topics',
+                                lambda: Response(catalog.topics(catalog_version)))
 
 
 def generate_random_username(length=8):
@@ -196,36 +212,13 @@ class LoginUserView(APIView):
 class GetUserStatsView(APIView):
     def get(self, request, *args, **kwargs):
         user_id = kwargs.get('user_id')
-        try:
-            user = CustomUser.objects.get(id=user_id)
-            saved_cards_count = user.saved_cards.count()
-            read_cards_count = user.read_cards  # Count of read cards
-            earned_badges = user.earned_badges.all()
-            earned_badges_count = earned_badges.count()
-            topics = user.topics.all()
-
-            earned_badges = user.earned_badges.all()
-            earned_badges_serialized = EarnedBadgeSerializer(earned_badges, many=True).data
-
-            user_data = {
-                'username': user.username,
-                'xp': user.xp,
-                'avatar_url': user.avatar_url,
-                'saved_cards_count': saved_cards_count,
-                'read_cards_count': read_cards_count,
-                'earned_badges_count': earned_badges_count,
-                'lives': user.lives,
-                # 'earned_badges': earned_badges_serialized,
-                'topics': TopicSerializer(topics, many=True).data
-            }
-            serializer = UserStatsSerializer(user_data)
-            return Response(serializer.data, status=status.HTTP_200_OK)
-
-        except CustomUser.DoesNotExist:
+        user_data = profiles.get(user_id)
+        if user_data is None:
             return Response(
                 {"error": "User not found."},
                 status=status.HTTP_404_NOT_FOUND
             )
+        return Response(user_data, status=status.HTTP_200_OK)
 
 
 class UpdateUserTopicsView(APIView):
@@ -240,7 +233,7 @@ class UpdateUserTopicsView(APIView):
             )
 
         try:
-            user = CustomUser.objects.get(id=user_id)
+            user = users.load(request, user_id, users.ALL_FIELDS, related=('game_state',))
         except CustomUser.DoesNotExist:
             return Response(
                 {"error": "User not found."},
@@ -257,7 +250,7 @@ class UpdateUserTopicsView(APIView):
         try:
             with transaction.atomic():
                 user.topics.set(topics)
-                user.save()
+                transaction.on_commit(lambda: card_queue.invalidate(user.id))
 
                 # Serialize the updated user data
                 user_serializer = UserSerializer(user)
@@ -270,6 +263,13 @@ class UpdateUserTopicsView(APIView):
             )
 
 
+def card_list_response(request, cards):
+    # ?include=quizzes embeds each card's quizzes, saving the client a
+    # get-quizzes-by-card-ids round trip.
+    include = request.query_params.get('include', '').split(',')
+    return payloads.card_list_response([card.id for card in cards], include_quizzes='quizzes' in include)
+
+
 class CardListView(APIView):
 
     def get(self, request, *args, **kwargs):
@@ -278,46 +278,50 @@ class CardListView(APIView):
             return Response({'error': 'User ID must be provided'}, status=400)
 
         try:
-            user = CustomUser.objects.get(id=user_id)
+            user = users.load(request, user_id)
         except CustomUser.DoesNotExist:
             return Response({'error': 'User not found'}, status=404)
 
-        user_topics = user.topics.all().values_list('id', flat=True)
-
         limit = request.query_params.get('limit', 20)
         try:
             limit = int(limit)
         except ValueError:
             return Response({'error': 'Invalid limit value'}, status=400)
 
-        viewed_card_ids = user.viewed_cards.all().values_list('card_id', flat=True)
+        after = request.query_params.get('after')
+        try:
+            after = int(after) if after is not None else None
+        except ValueError:
+            return Response({'error': 'Invalid after value'}, status=400)
 
-        cards = Card.objects.filter(topic__id__in=user_topics).exclude(id__in=viewed_card_ids)[:limit]
+        if after is None:
+            cards = card_queue.next_cards(user.id, limit)
+        else:
+            cards = list(topic_feed(user.id, limit, after))
 
-        ViewedCard.objects.bulk_create(
-            [ViewedCard(user=user, card=card) for card in cards],
-            ignore_conflicts=True
-        )
-        serializer = CardSerializer(cards, many=True)
+        services.record_viewed(user.id, [card.id for card in cards])
 
-        return Response(serializer.data)
+        return card_list_response(request, cards)
 
 
 class CardsForSubtitleView(APIView):
     def get(self, request, subtitle_id, user_id, num_cards):
+        after = request.query_params.get('after')
+        try:
+            after = int(after) if after is not None else None
+        except ValueError:
+            return Response({'error': 'Invalid after value'}, status=status.HTTP_400_BAD_REQUEST)
+
         try:
             subtitle = Subtitle.objects.get(id=subtitle_id)
-            user = CustomUser.objects.get(id=user_id)
-            viewed_cards = ViewedCard.objects.filter(user=user).values_list('card', flat=True)
+            user = users.load(request, user_id)
 
-            available_cards = Card.objects.filter(subtitle=subtitle).exclude(id__in=viewed_cards)
-            if available_cards.count() < num_cards:
-                cards = available_cards
+            if after is None:
+                cards = card_queue.next_cards(user.id, num_cards, subtitle_id=subtitle.id, consume=False)
             else:
-                cards = available_cards[:num_cards]
+                cards = subtitle_feed(user.id, subtitle.id, num_cards, after)
 
-            serializer = CardSerializer(cards, many=True)
-            return Response(serializer.data)
+            return card_list_response(request, cards)
 
         except Subtitle.DoesNotExist:
             return Response({"error": "Subtitle not found"}, status=status.HTTP_404_NOT_FOUND)
@@ -327,13 +331,11 @@ class CardsForSubtitleView(APIView):
 
 class QuizByCardsView(APIView):
     def get(self, request, *args, **kwargs):
-        card_ids = self.kwargs.get('card_ids').split(',')
         try:
-            quizzes = Quiz.objects.filter(card__id__in=card_ids).distinct()
-            serializer = QuizSerializer(quizzes, many=True)
-            return Response(serializer.data)
-        except Quiz.DoesNotExist:
-            return Response({"error": "Quiz not found"}, status=status.HTTP_404_NOT_FOUND)
+            card_ids = [int(card_id) for card_id in self.kwargs.get('card_ids').split(',')]
+        except ValueError:
+            return Response({'error': 'Invalid card ID format.'}, status=status.HTTP_400_BAD_REQUEST)
+        return payloads.quiz_list_response(card_ids)
 
 
 class QuizListView(APIView):
@@ -344,9 +346,9 @@ class QuizListView(APIView):
         if not user_id:
             return Response({'error': 'User ID must be provided'}, status=400)
 
-        viewed_cards = ViewedCard.objects.filter(user_id=user_id, test_passed=False)
-
-        quizzes = Quiz.objects.filter(card__in=[view.card for view in viewed_cards])
+        # One join through the (user, card) unique index instead of a query per viewed card.
+        quizzes = Quiz.objects.filter(card__viewed_by_users__user_id=user_id,
+                                      card__viewed_by_users__test_passed=False)
         serializer = QuizSerializer(quizzes, many=True)
 
         return Response(serializer.data)
@@ -360,12 +362,13 @@ class MarkCardsAsTestPassed(APIView):
         if not user_id:
             return Response({'error': 'User ID must be provided'}, status=400)
 
-        updated_cards_count = ViewedCard.objects.filter(
-            user_id=user_id,
-            test_passed=False
-        ).update(test_passed=True)
+        unpassed_cards = ViewedCard.objects.filter(user_id=user_id, test_passed=False)
+        card_ids = list(unpassed_cards.values_list('card_id', flat=True))
+        updated_cards_count = unpassed_cards.filter(card_id__in=card_ids).update(test_passed=True)
 
         if updated_cards_count > 0:
+            card_bitmaps.record_all_passed(user_id)
+            events.cards_passed.send(sender=ViewedCard, user_id=user_id, card_ids=card_ids, passed=True)
             return Response({'message': f'{updated_cards_count} cards marked as test passed.'}, status=200)
         else:
             return Response({'message': 'No cards needed to be updated. All cards are already marked as test passed.'},
@@ -393,15 +396,15 @@ class IncrementReadCards(APIView):
             return Response({'error': str(e)}, status=status.HTTP_200_OK)
 
         try:
-            user = CustomUser.objects.get(id=user_id)
-            user.read_cards = cards_count
-            user.save()
+            with transaction.atomic():
+                user = services.locked_user(user_id)
+                if user is None:
+                    return Response({'error': 'User does not exist'}, status=status.HTTP_404_NOT_FOUND)
+                services.set_read_cards(user, cards_count)
 
             return Response(
                 {'message': f'User read_cards count updated by {cards_count}. New total: {user.read_cards}'},
                 status=status.HTTP_200_OK)
-        except CustomUser.DoesNotExist:
-            return Response({'error': 'User does not exist'}, status=status.HTTP_404_NOT_FOUND)
         except Exception as e:
             return Response({'error': 'An unexpected error occurred'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -419,17 +422,16 @@ class SaveCard(APIView):
             return Response({'error': 'Card ID must be provided'}, status=status.HTTP_400_BAD_REQUEST)
 
         try:
-            user = CustomUser.objects.get(id=user_id)
+            user = users.load(request, user_id)
             card = Card.objects.get(id=card_id)
             # Check if the card is already saved, if so, remove it
-            if card in user.saved_cards.all():
+            if user.saved_cards.filter(id=card.id).exists():
                 user.saved_cards.remove(card)
                 action = 'removed from'
             else:
                 # If the card is not already saved, save it
                 user.saved_cards.add(card)
                 action = 'saved to'
-            user.save()
             return Response(
                 {'message': f'Card {card_id} {action} user {user_id}.'},
                 status=status.HTTP_200_OK
@@ -451,12 +453,10 @@ class SavedCards(APIView):
             return Response({'error': 'User ID must be provided'}, status=status.HTTP_400_BAD_REQUEST)
 
         try:
-            user = CustomUser.objects.get(id=user_id)
-            # Get all saved cards for the user
-            saved_cards = user.saved_cards.all()
-            # Serialize the card data
-            serializer = CardSerializer(saved_cards, many=True)
-            return Response(serializer.data, status=status.HTTP_200_OK)
+            user = users.load(request, user_id)
+            # Ids from the join table, payloads from the card cache
+            saved_card_ids = list(user.saved_cards.values_list('id', flat=True))
+            return payloads.card_list_response(saved_card_ids)
 
         except CustomUser.DoesNotExist:
             return Response({'error': 'User does not exist'}, status=status.HTTP_404_NOT_FOUND)
@@ -464,6 +464,19 @@ class SavedCards(APIView):
             return Response({'error': 'An unexpected error occurred'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+def stream_leaderboard(rows, limit):
+    # Rows are serialized one at a time, so memory does not grow with the number of users.
+    yield '{"results": ['
+    last = None
+    for count, (user_id, username, avatar_url, score, rank) in enumerate(rows):
+        yield (', ' if count else '') + json.dumps({
+            'id': user_id, 'username': username, 'avatar': avatar_url, 'score': score, 'rank': rank
+        })
+        last = (score, user_id, count + 1)
+    next_cursor = f'{last[0]}:{last[1]}' if limit and last and last[2] == limit else None
+    yield '], "next": ' + json.dumps(next_cursor) + '}'
+
+
 class UsersView(APIView):
 
     def get(self, request, *args, **kwargs):
@@ -475,43 +488,26 @@ class UsersView(APIView):
             if user_id is not None:
                 user_id = int(user_id)
 
-            users_query = CustomUser.objects.annotate(badges_count=Count('xp'))
+            users_query = CustomUser.objects.select_related('game_state').annotate(badges_count=Count('earned_badges'))
 
             if return_all:
-                if sort_by in ['xp', 'read_cards', 'badges']:
-                    order_by_field = '-badges_count' if sort_by == 'badges' else f'-{sort_by}'
-                    users_query = users_query.filter(xp__gt=0).order_by(order_by_field)
-
-                users_data = UserSerializer(users_query, many=True).data
+                return self.list_all(request, leaderboard.SORT_CATEGORIES.get(sort_by, leaderboard.XP))
 
             else:
-                if sort_by not in ['xp', 'read_cards', 'badges']:
+                if sort_by not in leaderboard.SORT_CATEGORIES:
                     return Response({'error': 'Invalid sort parameter'}, status=status.HTTP_400_BAD_REQUEST)
 
-                order_by_field = '-badges_count' if sort_by == 'badges' else f'-{sort_by}'
-                users = users_query.order_by(order_by_field)
-                top_users = list(users[:3])
-
-                current_user_rank = None
-                if user_id is not None:
-                    current_user = users_query.filter(id=user_id).first()
-                    if current_user:
-                        if sort_by == 'badges':
-                            user_value = current_user.badges_count
-                            field_for_rank = 'badges_count'
-                        else:
-                            user_value = getattr(current_user, sort_by)
-                            field_for_rank = sort_by
-
-                        current_user_rank = CustomUser.objects.annotate(badges_count=Count('xp')).filter(
-                            **{f'{field_for_rank}__gte': user_value}).count()
-
-                        if not any(user.id == user_id for user in top_users):
-                            top_users.append(current_user)
+                ranked, current_user_rank, ranked_at = leaderboard.standings(
+                    leaderboard.SORT_CATEGORIES[sort_by], 3, user_id
+                )
+                ranks = dict(ranked)
+                if user_id is not None and user_id not in ranks:
+                    ranks[user_id] = None
 
+                ranked_users = users_query.filter(id__in=ranks).prefetch_related('saved_cards', 'topics').in_bulk()
                 users_data = [
-                    {**UserSerializer(user).data, 'user_rank': i + 1}
-                    for i, user in enumerate(top_users)
+                    {**UserSerializer(ranked_users[ranked_id]).data, 'user_rank': position}
+                    for ranked_id, position in ranks.items() if ranked_id in ranked_users
                 ]
 
                 if current_user_rank is not None:
@@ -520,11 +516,29 @@ class UsersView(APIView):
                             user_data['user_rank'] = current_user_rank
                             break
 
-            return Response(users_data, status=status.HTTP_200_OK)
+                return Response(users_data, status=status.HTTP_200_OK,
+                                headers={'X-Leaderboard-Ranked-At': ranked_at.isoformat()})
 
         except Exception as e:
             return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+    @staticmethod
+    def list_all(request, category):
+        limit = request.query_params.get('limit')
+        cursor = request.query_params.get('cursor')
+        try:
+            limit = int(limit) if limit is not None else None
+            after = tuple(int(part) for part in cursor.split(':')) if cursor else None
+        except ValueError:
+            return Response({'error': 'Invalid limit or cursor value'}, status=status.HTTP_400_BAD_REQUEST)
+        if (limit is not None and limit <= 0) or (after is not None and len(after) != 2):
+            return Response({'error': 'Invalid limit or cursor value'}, status=status.HTTP_400_BAD_REQUEST)
+
+        rows, ranked_at = leaderboard.full_listing(category, after, limit)
+        response = StreamingHttpResponse(stream_leaderboard(rows, limit), content_type='application/json')
+        response['X-Leaderboard-Ranked-At'] = ranked_at.isoformat()
+        return response
+
 
 class SaveAnswersView(APIView):
 
@@ -537,15 +551,12 @@ class SaveAnswersView(APIView):
                 return Response({'error': 'User ID and Correct Answers Count are required.'},
                                 status=status.HTTP_400_BAD_REQUEST)
 
-            user = CustomUser.objects.filter(id=user_id).first()
-            if not user:
-                return Response({'error': 'User not found.'}, status=status.HTTP_404_NOT_FOUND)
-
-            xp_to_add = correct_answers_count * 10
-
-            CustomUser.objects.filter(id=user_id).update(xp=F('xp') + xp_to_add)
+            with transaction.atomic():
+                user = services.locked_user(user_id)
+                if not user:
+                    return Response({'error': 'User not found.'}, status=status.HTTP_404_NOT_FOUND)
 
-            user.refresh_from_db()
+                services.add_answer_xp(user, correct_answers_count)
 
             return Response({'message': 'XP updated successfully.', 'new_xp': user.xp}, status=status.HTTP_200_OK)
 
@@ -563,7 +574,7 @@ class UserBadgeProgressView(APIView):
             if user_id is None:
                 return Response({'error': 'User ID is required.'}, status=status.HTTP_400_BAD_REQUEST)
 
-            user = get_object_or_404(CustomUser, id=user_id)
+            user = users.load_or_404(request, user_id)
 
             all_badges = Badge.objects.all()
             user_progress = UserBadgeProgress.objects.filter(user=user)
@@ -610,161 +621,59 @@ class UserBadgeProgressView(APIView):
 
 class CheckUserAchievementsView(APIView):
 
-    def get_completed_subtopics_count(self, user):
-        viewed_subtitles = Subtitle.objects.filter(subtitle__viewed_by_users__user=user).distinct()
-        completed_subtitles_count = 0
-
-        for subtitle in viewed_subtitles:
-            total_cards = Card.objects.filter(subtitle=subtitle).count()
-            viewed_cards_count = ViewedCard.objects.filter(user=user, card__subtitle=subtitle).count()
-            if viewed_cards_count >= total_cards:
-                completed_subtitles_count += 1
-
-        return completed_subtitles_count
-
-    def get_completed_topics_count(self, user):
-        completed_topics_count = 0
-        for topic in Topic.objects.all():
-            if self.is_topic_completed(user, topic):
-                completed_topics_count += 1
-        return completed_topics_count
-
-    def is_topic_completed(self, user, topic):
-        for subtitle in topic.topic.all():
-            if not ViewedCard.objects.filter(user=user, card__subtitle=subtitle).exists():
-                return False
-        return True
-
     def get(self, request, *args, **kwargs):
         user_id = request.query_params.get('user_id')
         if user_id is None:
             return Response({'error': 'User ID is required.'}, status=status.HTTP_400_BAD_REQUEST)
 
-        user = get_object_or_404(CustomUser, id=user_id)
-
-        earned_badges = []
-        all_badges = Badge.objects.all()
-        user_progress = UserBadgeProgress.objects.filter(user=user)
-        for badge in all_badges:
-
-            already_earned = EarnedBadge.objects.filter(user=user, badge=badge).exists()
-
-            if already_earned:
-                print('already_earned', already_earned)
-                continue
-
-            if badge.criteria.get('read_cards', False):
-                user_progress = UserBadgeProgress.objects.get_or_create(user=user, badge=badge)
-                viewed_cards = ViewedCard.objects.filter(user=user, test_passed=True)
-                user_progress[0].progress_number = viewed_cards.count()
-                user_progress[0].save()
-                if user_progress[0].progress_number >= badge.criteria['read_cards']:
-                    already_earned = EarnedBadge.objects.filter(user=user, badge=badge).exists()
-                    if not already_earned:
-                        earned_badge, badge_created = EarnedBadge.objects.get_or_create(user=user, badge=badge)
-                        if badge_created:
-                            earned_badges.append({
-                                'name': badge.name,
-                            })
-            elif 'correct_quiz_answers' in badge.criteria:
-                user_quiz_stats = UserQuizStatistics.objects.filter(user=user).first()
-                correct_answers_count = user_quiz_stats.correct_attempts if user_quiz_stats else 0
-                user_progress, created = UserBadgeProgress.objects.get_or_create(user=user, badge=badge)
-                user_progress.progress_number = correct_answers_count
-                user_progress.save()
-
-                if correct_answers_count >= badge.criteria['correct_quiz_answers']:
-                    already_earned = EarnedBadge.objects.filter(user=user, badge=badge).exists()
-                    if not already_earned:
-                        earned_badge, badge_created = EarnedBadge.objects.get_or_create(user=user, badge=badge)
-                        if badge_created:
-                            earned_badges.append({
-                                'name': badge.name,
-                            })
-            elif badge.criteria.get('complete_subtopics', False):
-                completed_subtopics_count = self.get_completed_subtopics_count(user)
-                user_progress, created = UserBadgeProgress.objects.get_or_create(user=user, badge=badge)
-                user_progress.progress_number = completed_subtopics_count
-                user_progress.save()
-                if completed_subtopics_count >= badge.criteria['complete_subtopics']:
-                    already_earned = EarnedBadge.objects.filter(user=user, badge=badge).exists()
-                    if not already_earned:
-                        earned_badge, badge_created = EarnedBadge.objects.get_or_create(user=user, badge=badge)
-                        if badge_created:
-                            earned_badges.append({
-                                'name': badge.name,
-                            })
-
-            elif 'complete_topic' in badge.criteria:
-                completed_topics_count = self.get_completed_topics_count(user)
-                user_progress, created = UserBadgeProgress.objects.get_or_create(user=user, badge=badge)
-                user_progress.progress_number = completed_topics_count
-                user_progress.save()
-
-                if completed_topics_count >= badge.criteria['complete_topic']:
-                    already_earned = EarnedBadge.objects.filter(user=user, badge=badge).exists()
-                    if not already_earned:
-                        earned_badge, badge_created = EarnedBadge.objects.get_or_create(user=user, badge=badge)
-                        if badge_created:
-                            earned_badges.append({
-                                'name': badge.name,
-                            })
-
-            elif 'read_specific_topic' in badge.criteria:
-                user_progress = UserBadgeProgress.objects.get_or_create(user=user, badge=badge)
-                topic_id = badge.criteria['read_specific_topic']['topic_id']
-                viewed_cards = ViewedCard.objects.filter(user=user, card__topic_id=topic_id, test_passed=True)
-                user_progress[0].progress_number = viewed_cards.count()
-                user_progress[0].save()
-
-                if user_progress[0].progress_number >= badge.criteria['read_specific_topic']['count']:
-                    already_earned = EarnedBadge.objects.filter(user=user, badge=badge).exists()
-                    if not already_earned:
-                        earned_badge, badge_created = EarnedBadge.objects.get_or_create(user=user, badge=badge)
-                        if badge_created:
-                            earned_badges.append({
-                                'name': badge.name,
-
-                            })
-
-            elif 'quiz_specific_topic' in badge.criteria:
-                user_progress = UserBadgeProgress.objects.get_or_create(user=user, badge=badge)
-
-                passed_viewed_cards = ViewedCard.objects.filter(
-                    user=user,
-                    test_passed=True,
-                    card__topic_id=badge.criteria["quiz_specific_topic"]["topic_id"]
-                )
+        user = users.load_or_404(request, user_id)
 
-                passed_quizzes_count = passed_viewed_cards.values('card').distinct().count()
-                user_progress[0].progress_number = passed_quizzes_count
-                user_progress[0].save()
-
-                if user_progress[0].progress_number >= badge.criteria['quiz_specific_topic']['count']:
-                    already_earned = EarnedBadge.objects.filter(user=user, badge=badge).exists()
-                    if not already_earned:
-                        earned_badge, badge_created = EarnedBadge.objects.get_or_create(user=user, badge=badge)
-                        if badge_created:
-                            earned_badges.append({
-                                'name': badge.name,
-                            })
+        earned_badges = badges.pop_pending_awards(user.id)
         return Response({'earned_badges': earned_badges}, status=status.HTTP_200_OK)
 
 
+class EventsBatchView(APIView):
+
+    def post(self, request, *args, **kwargs):
+        user_id = request.data.get('user_id')
+        batch = request.data.get('events')
+
+        if not user_id:
+            return Response({'error': 'User ID must be provided'}, status=status.HTTP_400_BAD_REQUEST)
+        if not isinstance(batch, list) or not batch:
+            return Response({'error': 'Events must be provided'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            parsed = services.parse_events(batch)
+            with transaction.atomic():
+                user = services.locked_user(user_id)
+                if user is None:
+                    return Response({'error': 'User not found'}, status=status.HTTP_404_NOT_FOUND)
+                state = services.apply_events(user, parsed)
+        except services.ServiceError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(state, status=status.HTTP_200_OK)
+
+
 class UserTopicProgressView(APIView):
     def get(self, request, user_id):
         try:
-            user = CustomUser.objects.get(id=user_id)
+            user = users.load(request, user_id)
         except CustomUser.DoesNotExist:
             return Response({"error": "User not found."}, status=status.HTTP_404_NOT_FOUND)
 
-        user_topics = Topic.objects.filter(users_interested=user)
+        viewed_cards = UserSubtitleProgress.objects.filter(user=user, topic=OuterRef('pk')).values('topic').annotate(
+            total=Sum('viewed_count')
+        ).values('total')
+        user_topics = Topic.objects.filter(users_interested=user).annotate(
+            viewed_cards=Coalesce(Subquery(viewed_cards), 0),
+        )
         topics_data = []
 
         for topic in user_topics:
-            viewed_cards = ViewedCard.objects.filter(user=user, card__topic=topic)
-            total_viewed = viewed_cards.count()
-            total_cards = Card.objects.filter(topic=topic, subtitle__exist=True).count()
+            total_viewed = topic.viewed_cards
+            total_cards = topic.active_card_count
             progress = total_viewed / total_cards if total_cards > 0 else 0
 
             image_url = topic.image if topic.image else None
@@ -784,35 +693,43 @@ class UserTopicProgressView(APIView):
 class UserSubtitleProgressView(APIView):
     def get(self, request, topic_id, user_id):
         try:
-            user = CustomUser.objects.get(id=user_id)
-            topic = Topic.objects.get(id=topic_id)
+            user = users.load(request, user_id)
         except ObjectDoesNotExist:
             return Response({"error": "User or Topic not found."}, status=status.HTTP_404_NOT_FOUND)
+        # The topic's subtitles come from the catalog cache; only the user's rows are queried.
+        subtitles = catalog.subtitles(catalog.version(), topic_id)
+        if subtitles is None:
+            return Response({"error": "User or Topic not found."}, status=status.HTTP_404_NOT_FOUND)
 
-        cards_in_topic = Card.objects.filter(topic=topic)
-        subtitles = Subtitle.objects.filter(id__in=cards_in_topic.values('subtitle_id'), exist=True).distinct()
-        purchased_subtitles = UserSubtitle.objects.filter(user=user).values_list('subtitle', flat=True)
+        subtitle_ids = [subtitle['id'] for subtitle in subtitles]
+        viewed_cards = dict(
+            UserSubtitleProgress.objects.filter(user=user, subtitle_id__in=subtitle_ids)
+            .values_list('subtitle_id', 'viewed_count')
+        )
+        purchased_subtitles = set(
+            UserSubtitle.objects.filter(user=user, subtitle_id__in=subtitle_ids).values_list('subtitle', flat=True)
+        )
+        # Purchases made through the Redis economy reach UserSubtitle on the next flush.
+        purchased_subtitles |= economy.purchased_subtitles(user.id)
 
         subtitle_data = []
 
         for subtitle in subtitles:
-            cards_in_subtitle = cards_in_topic.filter(subtitle=subtitle)
-            viewed_cards = ViewedCard.objects.filter(user=user, card__in=cards_in_subtitle)
-            total_viewed = viewed_cards.count()
-            total_cards = cards_in_subtitle.count()
+            total_viewed = viewed_cards.get(subtitle['id'], 0)
+            total_cards = subtitle['card_count']
             progress = total_viewed / total_cards if total_cards > 0 else 0
 
-            image_url = subtitle.image if subtitle.image else None
+            image_url = subtitle['image'] if subtitle['image'] else None
 
             subtitle_data.append({
-                'subtitle_id': subtitle.id,
-                'subtitle_name': subtitle.title,
+                'subtitle_id': subtitle['id'],
+                'subtitle_name': subtitle['title'],
                 'progress': progress,
                 'viewed_cards': total_viewed,
                 'total_cards': total_cards,
-                'is_free': subtitle.is_free,
-                'is_purchased': subtitle.id in purchased_subtitles,
-                'cost': subtitle.cost,
+                'is_free': subtitle['is_free'],
+                'is_purchased': subtitle['id'] in purchased_subtitles,
+                'cost': subtitle['cost'],
                 'image': image_url,
             })
 
@@ -833,21 +750,21 @@ class GetQuizzesByCardIdsView(APIView):
             if not all(isinstance(id, int) for id in card_ids):
                 return Response({'error': 'Invalid card ID format.'}, status=status.HTTP_400_BAD_REQUEST)
 
-            cards = Card.objects.filter(id__in=card_ids)
-
-            quizzes = Quiz.objects.filter(card__in=cards).select_related('card')
+            cards, quizzes = payloads.cards_and_quizzes(card_ids)
 
             quizzes_data = []
-            for quiz in quizzes:
-                quiz_data = {
-                    'quiz_id': quiz.id,
-                    'card_id': quiz.card.id,
-                    'question': quiz.question,
-                    'correct_answer': quiz.correct_answer,
-                    'answers': quiz.answers,
-                    'card_title': quiz.card.title
-                }
-                quizzes_data.append(quiz_data)
+            for card_id, card in cards.items():
+                card_title = json.loads(card)['title']
+                for quiz in json.loads(quizzes[card_id]):
+                    quiz_data = {
+                        'quiz_id': quiz['id'],
+                        'card_id': card_id,
+                        'question': quiz['question'],
+                        'correct_answer': quiz['correct_answer'],
+                        'answers': quiz['answers'],
+                        'card_title': card_title
+                    }
+                    quizzes_data.append(quiz_data)
 
             return Response({'quizzes': quizzes_data}, status=status.HTTP_200_OK)
 
@@ -868,40 +785,11 @@ class MarkCardsAndViewedQuizzes(APIView):
             return Response({'error': 'Card IDs must be provided'}, status=400)
 
         try:
-            user = CustomUser.objects.get(id=user_id)
+            user = users.load(request, user_id)
         except CustomUser.DoesNotExist:
             return Response({'error': 'User not found'}, status=404)
 
-        correct_answers_count = 0
-        incorrect_answers_count = 0
-
-        for card_id in card_ids:
-            viewed_card, created = ViewedCard.objects.get_or_create(
-                user=user,
-                card_id=card_id,
-                defaults={'test_passed': card_id in correct_answer_ids, 'correct': card_id in correct_answer_ids}
-            )
-            if card_id in correct_answer_ids:
-                correct_answers_count += 1
-            else:
-                incorrect_answers_count += 1
-                if not created:
-                    viewed_card.test_passed = False
-                    viewed_card.correct = False
-                    viewed_card.save()
-        stats, created = UserQuizStatistics.objects.get_or_create(user=user)
-
-        if stats:
-            UserQuizStatistics.objects.filter(user=user).update(
-                total_attempts=F('total_attempts') + len(card_ids),
-                correct_attempts=F('correct_attempts') + correct_answers_count,
-                incorrect_attempts=F('incorrect_attempts') + incorrect_answers_count,
-            )
-
-        today = timezone.now().date()
-        daily_stat, created = DailyReadCards.objects.get_or_create(user=user, date=today)
-        daily_stat.cards_read = F('cards_read') + len(card_ids)
-        daily_stat.save()
+        services.record_quiz_answers(user.id, card_ids, correct_answer_ids)
         return Response({'message': 'Correctly answered cards marked as viewed.'}, status=200)
 
 
@@ -914,48 +802,34 @@ class SubtopicPurchaseView(APIView):
             return Response({'error': 'User ID and Subtitle ID must be provided'}, status=status.HTTP_400_BAD_REQUEST)
 
         try:
-            user = CustomUser.objects.get(id=user_id)
             subtitle = Subtitle.objects.get(id=subtitle_id)
-
-            if user.xp >= subtitle.cost:
-                user.xp -= subtitle.cost
-                user.save()
-
-                user_subtitle, created = UserSubtitle.objects.get_or_create(
-                    user=user,
-                    subtitle=subtitle,
-                    defaults={'cost_in_xp': subtitle.cost}
-                )
-
-                if created:
-                    return Response({'message': 'Subtitle purchased successfully.'}, status=status.HTTP_200_OK)
-                else:
-                    return Response({'error': 'Subtitle already purchased.'}, status=status.HTTP_400_BAD_REQUEST)
-            else:
-                return Response({'error': 'Insufficient XP.'}, status=status.HTTP_400_BAD_REQUEST)
-
-        except CustomUser.DoesNotExist:
-            return Response({'error': 'User not found'}, status=status.HTTP_404_NOT_FOUND)
         except Subtitle.DoesNotExist:
             return Response({'error': 'Subtitle not found'}, status=status.HTTP_404_NOT_FOUND)
 
+        user = users.load_or_404(request, user_id)
+        try:
+            if services.purchase_subtitle(user.id, subtitle) is None:
+                return Response({'error': 'User not found'}, status=status.HTTP_404_NOT_FOUND)
+        except services.ServiceError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except services.ServiceUnavailable as e:
+            return Response({'error': str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        return Response({'message': 'Subtitle purchased successfully.'}, status=status.HTTP_200_OK)
+
 
 class LoseLifeView(APIView):
     def post(self, request, *args, **kwargs):
-        user_id = request.data.get('user_id')
+        user = users.load_or_404(request, request.data.get('user_id'))
         try:
-            user = CustomUser.objects.get(id=user_id)
-            if user.lives > 0:
-                user.lives -= 1
-                user.last_life_lost_time = timezone.now()
-                user.save()
-                return Response({"message": "Life lost. Please be careful next time.", "lives_remaining": user.lives},
-                                status=status.HTTP_200_OK)
-            else:
-                return Response({"error": "No lives left. Please wait for them to regenerate or purchase more lives."},
-                                status=status.HTTP_400_BAD_REQUEST)
-        except CustomUser.DoesNotExist:
+            lives_left = services.spend_life(user.id)
+        except services.ServiceError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except services.ServiceUnavailable as e:
+            return Response({"error": str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        if lives_left is None:
             return Response({"error": "User not found."}, status=status.HTTP_404_NOT_FOUND)
+        return Response({"message": "Life lost. Please be careful next time.", "lives_remaining": lives_left},
+                        status=status.HTTP_200_OK)
 
 
 class GetLivesView(APIView):
@@ -965,8 +839,10 @@ class GetLivesView(APIView):
             return Response({"error": "User ID must be provided."}, status=status.HTTP_400_BAD_REQUEST)
 
         try:
-            user = CustomUser.objects.get(id=user_id)
-            return Response({"lives_remaining": user.lives}, status=status.HTTP_200_OK)
+            user = users.load(request, user_id, related=('game_state',))
+            return Response({"lives_remaining": lives.current(user),
+                             "next_life_in": lives.seconds_until(user, lives.current(user) + 1)},
+                            status=status.HTTP_200_OK)
         except CustomUser.DoesNotExist:
             return Response({"error": "User not found."}, status=status.HTTP_404_NOT_FOUND)
 
@@ -978,7 +854,9 @@ class LogoutUserView(APIView):
         try:
             with transaction.atomic():
                 token = Token.objects.get(user=request.user)
+                key = token.key
                 token.delete()
+                transaction.on_commit(lambda: authentication.forget(key))
 
                 return Response({"success": "Successfully logged out."}, status=status.HTTP_200_OK)
         except Token.DoesNotExist:
@@ -993,8 +871,9 @@ class UpdateStreakView(APIView):
         if not user_id:
             return Response({"error": "User ID must be provided."}, status=status.HTTP_400_BAD_REQUEST)
 
-        user_streak = get_object_or_404(UserStreak, user_id=user_id)
-        streak_broken = user_streak.update_streak()
+        user = users.load_or_404(request, user_id)
+        with transaction.atomic():
+            user_streak, streak_broken = services.update_streak(user.id)
 
         if streak_broken:
             message = "Streak was broken, but now it's started again!"
@@ -1007,7 +886,7 @@ class UpdateStreakView(APIView):
 
 class GetStreakView(APIView):
     def get(self, request, user_id, *args, **kwargs):
-        get_object_or_404(CustomUser, id=user_id)
+        users.load_or_404(request, user_id)
 
         user_streak, created = UserStreak.objects.get_or_create(user_id=user_id)
 
@@ -1068,35 +947,37 @@ class UpdateQuizStreakView(APIView):
         if not user_id:
             return Response({'error': 'User ID must be provided'}, status=status.HTTP_400_BAD_REQUEST)
 
-        user = CustomUser.objects.filter(id=user_id).first()
-        if not user:
+        try:
+            user = users.load(request, user_id)
+        except CustomUser.DoesNotExist:
             return Response({'error': 'User not found'}, status=status.HTTP_404_NOT_FOUND)
-        if not streak_count_current:
-            return Response({'error': 'Quizzes results are required'}, status=status.HTTP_400_BAD_REQUEST)
-
-        streak_record, _ = CorrectStreak.objects.get_or_create(user=user)
-        if streak_record.last_quiz_fully_correct:
-            new_streak = streak_record.streak_count + streak_count_current
-        else:
-            new_streak = streak_count_current
-        streak_record.streak_count = new_streak
-        if streak_record.max_streak < new_streak:
-            streak_record.max_streak = new_streak
-        if all_cards_bool:
-            streak_record.last_quiz_fully_correct = True
-        else:
-            streak_record.last_quiz_fully_correct = False
-        streak_record.save()
+        try:
+            services.update_quiz_streak(user.id, streak_count_current, all_cards_bool)
+        except services.ServiceError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
         return Response({'message': 'Streak updated successfully'}, status=status.HTTP_200_OK)
 
 
 class UserStatsView(APIView):
     def get(self, request, user_id, format=None):
-        user = get_object_or_404(CustomUser, id=user_id)
-        daily_read_cards = DailyReadCards.objects.filter(user=user)
+        user = users.load_or_404(request, user_id)
+        daily_read_cards = list(DailyReadCards.objects.filter(user=user))
         correct_streak = CorrectStreak.objects.filter(user=user)
-        user_quiz_statistics = UserQuizStatistics.objects.filter(user=user)
+        user_quiz_statistics = list(UserQuizStatistics.objects.filter(user=user))
+
+        if write_behind.enabled():
+            today = timezone.now().date()
+            if not any(daily.date == today for daily in daily_read_cards):
+                daily_read_cards.append(DailyReadCards(user=user, date=today))
+            for daily in daily_read_cards:
+                write_behind.merge(write_behind.DAILY_READS, daily)
+            daily_read_cards = [daily for daily in daily_read_cards if daily.pk or daily.cards_read]
+            if not user_quiz_statistics:
+                user_quiz_statistics.append(UserQuizStatistics(user=user))
+            for stats in user_quiz_statistics:
+                write_behind.merge(write_behind.QUIZ_STATS, stats)
+            user_quiz_statistics = [stats for stats in user_quiz_statistics if stats.pk or stats.total_attempts]
 
         daily_read_cards_serializer = DailyReadCardsSerializer(daily_read_cards, many=True)
         correct_streak_serializer = CorrectStreakSerializer(correct_streak, many=True)
@@ -1114,17 +995,25 @@ class PurchaseLivesView(APIView):
         user_id = request.data.get('user_id')
         lives_cost = request.data.get('cost', 15)
 
-        user = get_object_or_404(CustomUser, id=user_id)
-
-        if user.xp < lives_cost:
-            return Response({"error": "Not enough XP to purchase lives."}, status=status.HTTP_400_BAD_REQUEST)
-
-        user.xp -= lives_cost
-        user.lives += 1
-        user.save()
+        # A whole number of XP above zero, as a JSON integer or a form string.
+        if isinstance(lives_cost, str) and lives_cost.isdigit():
+            lives_cost = int(lives_cost)
+        if type(lives_cost) is not int or lives_cost <= 0:
+            return Response({"error": "'cost' must be a positive integer."}, status=status.HTTP_400_BAD_REQUEST)
 
+        user = users.load_or_404(request, user_id)
+        try:
+            result = services.purchase_lives(user.id, lives_cost)
+        except services.ServiceError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except services.ServiceUnavailable as e:
+            return Response({"error": str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        if result is None:
+            raise Http404
+
+        current_xp, current_lives = result
         return Response({"success": "Life successfully purchased.",
-                         "current_xp": user.xp, "current_lives": user.lives},
+                         "current_xp": current_xp, "current_lives": current_lives},
                         status=status.HTTP_200_OK)
 
 
@@ -1159,57 +1048,34 @@ class AddXPView(APIView):
         except ValueError:
             return Response({"error": "'xp_amount' must be an integer."}, status=status.HTTP_400_BAD_REQUEST)
 
-        user = get_object_or_404(CustomUser, id=user_id)
-        user.xp += xp_amount
-        user.save()
+        user = users.load_or_404(request, user_id)
+        try:
+            current_xp = services.change_xp(user.id, xp_amount)
+        except services.ServiceError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except services.ServiceUnavailable as e:
+            return Response({"error": str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        if current_xp is None:
+            raise Http404
 
-        return Response({"success": "XP successfully added.", "current_xp": user.xp}, status=status.HTTP_200_OK)
+        return Response({"success": "XP successfully added.", "current_xp": current_xp}, status=status.HTTP_200_OK)
 
 
 class ReportLifeLossView(APIView):
     def post(self, request, user_id):
-        user = get_object_or_404(CustomUser, pk=user_id)
-        r = redis.Redis(
-            host=os.environ.get('REDIS_HOST'),
-            port=os.environ.get('REDIS_PORT'),
-            password=os.environ.get('REDIS_PASSWORD'),
-            db=os.environ.get('REDIS_DB'),
-            decode_responses=True
-        )
-        key = f"user_{user_id}_restore_lives"
-
-        r.set(key, timezone.now().isoformat())
-        return Response({"current_lives": user.lives, "message": "Life loss recorded and lives updated."})
+        # The loss itself is recorded by lose-life; its time is where regeneration starts from.
+        user = users.load_or_404(request, user_id, related=('game_state',))
+        return Response({"current_lives": lives.current(user), "message": "Life loss recorded and lives updated."})
 
 
 class CheckRestoreLivesView(APIView):
     def get(self, request, user_id):
-        user = get_object_or_404(CustomUser, pk=user_id)
-        r = redis.Redis(
-            host=os.environ.get('REDIS_HOST'),
-            port=os.environ.get('REDIS_PORT'),
-            password=os.environ.get('REDIS_PASSWORD'),
-            db=os.environ.get('REDIS_DB'),
-            decode_responses=True
-        )
-        key = f"user_{user_id}_restore_lives"
-        last_life_lost_time = r.get(key)
-        print('last_life_lost_time', last_life_lost_time)
-
-        if last_life_lost_time:
-            last_life_lost_time = timezone.datetime.fromisoformat(last_life_lost_time)
-            if timezone.now() >= last_life_lost_time + timedelta(hours=1):
-                user.lives = 5
-                user.save()
-                r.delete(key)
-                return Response({"current_lives": user.lives, "message": "Lives restored."})
-
-            time_left = (last_life_lost_time + timedelta(hours=1) - timezone.now()).total_seconds()
+        user = users.load_or_404(request, user_id, related=('game_state',))
+        time_left = lives.seconds_until(user, settings.LIVES_REGEN_CAP)
+        if time_left:
             return Response({"time_left": time_left, "message": "Lives will be restored soon."})
-        else:
-            # Обработка случая, когда нет данных о последней потере жизни
-            return Response(
-                {"current_lives": user.lives, "message": "No life loss recorded or lives already restored."})
+        return Response(
+            {"current_lives": lives.current(user), "message": "No life loss recorded or lives already restored."})
 
 
 class DeleteAccountView(APIView):
@@ -1217,9 +1083,11 @@ class DeleteAccountView(APIView):
         user_id = request.data.get('user_id')
         if user_id is None:
             return Response({"error": "Missing 'user_id'."}, status=status.HTTP_400_BAD_REQUEST)
-        user = get_object_or_404(CustomUser, pk=user_id)
+        user = users.load_or_404(request, user_id)
 
+        token_keys = list(Token.objects.filter(user=user).values_list('key', flat=True))
         user.delete()
+        authentication.forget(*token_keys)
         return Response({"success": "User account successfully deleted."}, status=status.HTTP_200_OK)
 
 
@@ -1275,4 +1143,12 @@ class AppleSignInView(APIView):
         except jwt.InvalidTokenError:
             return Response({'error': 'Неверный токен'}, status=status.HTTP_400_BAD_REQUEST)
         except Exception as e:
-            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
\ No newline at end of file
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+
+class RedisPoolStatsView(APIView):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, *args, **kwargs):
+        # Usage of the Redis connection pools of the worker process serving this request.
+        return Response({'pid': os.getpid(), 'pools': pool_stats()}, status=status.HTTP_200_OK)
@@ -0,0 +1,229 @@
+import logging
+import uuid
+from datetime import date, timedelta
+from functools import reduce
+from operator import or_
+
+import redis
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, Q, Value, When
+from django.utils import timezone
+
+from app.models import DailyReadCards, UserGameState, UserQuizStatistics, WriteBehindBatch
+from app.redis_client import get_redis, pipeline, register_script, script
+
+logger = logging.getLogger(__name__)
+
+USER = 'user'
+QUIZ_STATS = 'quiz_stats'
+DAILY_READS = 'daily_reads'
+
+# Buffered counters per table: the key columns of a row (with the parser for their
+# string form), the counter columns, and whether a missing row is created on flush.
+BUFFERS = {
+    USER: {
+        'model': UserGameState,
+        'key': (('user_id', int),),
+        'fields': ('xp', 'read_cards'),
+        'create': False,
+    },
+    QUIZ_STATS: {
+        'model': UserQuizStatistics,
+        'key': (('user_id', int),),
+        'fields': ('total_attempts', 'correct_attempts', 'incorrect_attempts'),
+        'create': True,
+    },
+    DAILY_READS: {
+        'model': DailyReadCards,
+        'key': (('user_id', int), ('date', date.fromisoformat)),
+        'fields': ('cards_read',),
+        'create': True,
+    },
+}
+
+FLUSH_CHUNK_SIZE = 500
+FLUSH_LOCK = 'write_behind_flush'
+
+# The buffered deltas of the given hash fields, read atomically: the live buffer's
+# totals, then the name and deltas of each batch a flush has taken out of it but not
+# deleted yet that holds any of them.
+PENDING_SCRIPT = """
+local result = redis.call('HMGET', KEYS[1], unpack(ARGV))
+for i = 1, #ARGV do result[i] = tonumber(result[i]) or 0 end
+for _, key in ipairs(redis.call('SMEMBERS', KEYS[2])) do
+    local values = redis.call('HMGET', key, unpack(ARGV))
+    local found = false
+    for i = 1, #ARGV do
+        values[i] = tonumber(values[i]) or 0
+        found = found or values[i] ~= 0
+    end
+    if found then
+        table.insert(result, key)
+        for i = 1, #ARGV do table.insert(result, values[i]) end
+    end
+end
+return result
+"""
+register_script('write_behind_pending', PENDING_SCRIPT)
+
+
+def enabled():
+    return settings.WRITE_BEHIND_COUNTERS
+
+
+def buffer_key(name):
+    return f"write_behind_{name}"
+
+
+def batches_key(name):
+    return f"write_behind_{name}_batches"
+
+
+def member(row, field):
+    return ':'.join(str(value) for value in row) + ':' + field
+
+
+def parse_member(name, member_name):
+    row, field = member_name.rsplit(':', 1)
+    parsers = [parse for _, parse in BUFFERS[name]['key']]
+    return tuple(parse(value) for parse, value in zip(parsers, row.split(':'))), field
+
+
+def _apply(name, deltas):
+    """Add {row: {field: delta}} to Postgres with one UPDATE per chunk of rows."""
+    spec = BUFFERS[name]
+    model, key_names = spec['model'], [key_name for key_name, _ in spec['key']]
+    rows = list(deltas.items())
+    for start in range(0, len(rows), FLUSH_CHUNK_SIZE):
+        chunk = rows[start:start + FLUSH_CHUNK_SIZE]
+        lookups = {row: Q(**dict(zip(key_names, row))) for row, _ in chunk}
+        matching = model.objects.filter(reduce(or_, lookups.values()))
+
+        if spec['create']:
+            existing = set(matching.values_list(*key_names))
+            model.objects.bulk_create(
+                [model(**dict(zip(key_names, row))) for row in lookups if row not in existing]
+            )
+
+        updates = {}
+        for field in spec['fields']:
+            whens = [When(lookups[row], then=Value(changes[field])) for row, changes in chunk if changes.get(field)]
+            if whens:
+                updates[field] = F(field) + Case(*whens, default=Value(0))
+        if updates:
+            matching.update(**updates)
+
+
+def incr(name, row, **deltas):
+    """Buffer counter deltas for a row; falls back to a direct UPDATE when Redis is unavailable."""
+    try:
+        with pipeline() as pipe:
+            for field, delta in deltas.items():
+                pipe.hincrby(buffer_key(name), member(row, field), delta)
+    except redis.RedisError:
+        logger.exception('Failed to buffer %s counters, writing them through', name)
+        with transaction.atomic():
+            _apply(name, {row: deltas})
+
+
+def incr_on_commit(name, row, **deltas):
+    # Buffered deltas cannot be rolled back, so they are only handed over once the request commits.
+    transaction.on_commit(lambda: incr(name, row, **deltas))
+
+
+def applied_batches(batch_keys):
+    """
+    The batches among `batch_keys` already in Postgres. A flush commits a batch together
+    with its marker and only then drops it from Redis, so a batch still listed but marked
+    must not be counted on top of the row again.
+    """
+    if not batch_keys:
+        return set()
+    return set(WriteBehindBatch.objects.filter(batch_id__in=batch_keys).values_list('batch_id', flat=True))
+
+
+def pending(name, row, fields=None):
+    """{field: delta} still buffered for a row, or zeros when write-behind is off."""
+    fields = fields or BUFFERS[name]['fields']
+    if not enabled():
+        return dict.fromkeys(fields, 0)
+    try:
+        result = script('write_behind_pending')(
+            keys=[buffer_key(name), batches_key(name)],
+            args=[member(row, field) for field in fields]
+        )
+    except redis.RedisError:
+        logger.exception('Failed to read buffered %s counters', name)
+        return dict.fromkeys(fields, 0)
+
+    totals = [int(total) for total in result[:len(fields)]]
+    batches = {}
+    for start in range(len(fields), len(result), len(fields) + 1):
+        batches[result[start]] = [int(delta) for delta in result[start + 1:start + 1 + len(fields)]]
+    if batches:
+        # Read after the row (and under its lock, for locked_user and debit_xp), the
+        # markers agree with the row the caller has.
+        applied = applied_batches(batches)
+        for batch_key, deltas in batches.items():
+            if batch_key not in applied:
+                totals = [total + delta for total, delta in zip(totals, deltas)]
+    return dict(zip(fields, totals))
+
+
+def merge(name, instance):
+    """Add the buffered deltas of a row to a model instance in memory. Never save() it afterwards."""
+    row = tuple(getattr(instance, key_name) for key_name, _ in BUFFERS[name]['key'])
+    for field, delta in pending(name, row).items():
+        setattr(instance, field, getattr(instance, field) + delta)
+    return instance
+
+
+def _flush_batch(r, name, batch_key):
+    deltas = {}
+    for member_name, delta in r.hgetall(batch_key).items():
+        row, field = parse_member(name, member_name)
+        deltas.setdefault(row, {})[field] = int(delta)
+
+    with transaction.atomic():
+        _, created = WriteBehindBatch.objects.get_or_create(batch_id=batch_key)
+        if created:
+            _apply(name, deltas)
+            if name == USER:
+                from app import profiles
+                for (user_id,) in deltas:
+                    profiles.invalidate(user_id)
+
+    with r.pipeline() as pipe:
+        pipe.delete(batch_key)
+        pipe.srem(batches_key(name), batch_key)
+        pipe.execute()
+    return len(deltas)
+
+
+def flush():
+    """
+    Move every buffer aside with RENAME and apply it to Postgres. A batch stays listed in
+    Redis until its rows are committed, together with a WriteBehindBatch marker, so a
+    crash at any point is either retried on the next flush or recognised as done.
+    """
+    r = get_redis()
+    lock = r.lock(FLUSH_LOCK, timeout=60, blocking=False)
+    if not lock.acquire():
+        return 0
+
+    flushed = 0
+    try:
+        for name in BUFFERS:
+            if r.exists(buffer_key(name)):
+                batch_key = f"{buffer_key(name)}_{uuid.uuid4().hex}"
+                with r.pipeline() as pipe:
+                    pipe.rename(buffer_key(name), batch_key)
+                    pipe.sadd(batches_key(name), batch_key)
+                    pipe.execute()
+            for batch_key in r.smembers(batches_key(name)):
+                flushed += _flush_batch(r, name, batch_key)
+        WriteBehindBatch.objects.filter(flushed_at__lt=timezone.now() - timedelta(days=1)).delete()
+    finally:
+        lock.release()
+    return flushed